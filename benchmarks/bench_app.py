@@ -0,0 +1,212 @@
+"""
+Load test of the whole application, against ``showergel.fake_liquidsoap``.
+
+Showergel is served by Paste (as by ``showergel serve``), with a temporary
+SQLite database, and connected to a fake Liquidsoap over telnet. Then:
+
+ * ``clients`` threads request ``GET /live`` for ``duration`` seconds ;
+ * ``clients`` threads post metadata to ``POST /metadata_log`` for
+   ``duration`` seconds ;
+ * a few commands are scheduled, and we measure how late the fake Liquidsoap
+   receives them.
+
+For each phase it reports throughput and latency percentiles, followed by
+statistics of the link to Liquidsoap (see ``GET /live/link_stats``).
+
+Run from the repository's root::
+
+    python -m benchmarks.bench_app --clients 8 --duration 10 --latency 0.002
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import statistics
+import tempfile
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Event, Lock
+from time import monotonic, sleep
+
+from paste import httpserver
+
+from showergel import app
+from showergel.db import Base
+from showergel.metadata import MetadataWriter
+from showergel.liquidsoap_connector import Connection
+from showergel.fake_liquidsoap import FakeLiquidsoap
+
+
+class Results:
+
+    def __init__(self):
+        self._lock = Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def add(self, latency:float, ok:bool):
+        with self._lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+    def report(self, name:str, elapsed:float):
+        latencies = sorted(self.latencies)
+        if len(latencies) < 2:
+            print(f"{name:<22} not enough samples")
+            return
+        percentiles = statistics.quantiles(latencies, n=100, method='inclusive')
+        print(f"{name:<22} {len(latencies):>8} {len(latencies) / elapsed:>9.1f}"
+            f" {percentiles[49] * 1000:>8.2f} {percentiles[89] * 1000:>8.2f}"
+            f" {percentiles[98] * 1000:>8.2f} {latencies[-1] * 1000:>8.2f} {self.errors:>7}")
+
+
+def request(port:int, method:str, path:str, body:dict=None) -> bool:
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, path, payload, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status < 300
+    except OSError:
+        return False
+    finally:
+        connection.close()
+
+
+def load(port:int, clients:int, duration:float, call) -> Results:
+    """
+    Runs ``call(port, client_index, iteration)`` in a loop from ``clients``
+    threads, for ``duration`` seconds.
+    """
+    results = Results()
+    stop = Event()
+
+    def client(index):
+        iteration = 0
+        while not stop.is_set():
+            started = monotonic()
+            ok = call(port, index, iteration)
+            results.add(monotonic() - started, ok)
+            iteration += 1
+
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def get_live(port, index, iteration):
+    return request(port, 'GET', '/live')
+
+
+def post_metadata(port, index, iteration):
+    return request(port, 'POST', '/metadata_log', {
+        'artist': f"Benchmark {index}",
+        'title': f"Track {iteration}",
+        'album': "Load test",
+    })
+
+
+def scheduled_commands(port:int, fake:FakeLiquidsoap, count:int) -> Results:
+    """
+    Schedules ``count`` commands, 100ms apart, and measures how late they're
+    received by the fake Liquidsoap.
+    """
+    results = Results()
+    expected = {}
+    start = datetime.now(timezone.utc) + timedelta(seconds=2)
+    start_monotonic = monotonic() + 2
+    for i in range(count):
+        command = f"queue.push /bench/{i}.mp3"
+        expected[command] = start_monotonic + i * 0.1
+        ok = request(port, 'PUT', '/schedule/command', {
+            'command': command,
+            'when': (start + timedelta(seconds=i * 0.1)).isoformat(),
+        })
+        if not ok:
+            results.add(0., False)
+
+    def on_command(command):
+        if command in expected:
+            results.add(monotonic() - expected.pop(command), True)
+    fake.on_command = on_command
+    sleep(2 + count * 0.1 + 2)
+    fake.on_command = None
+    for _ in expected:
+        results.add(0., False)
+    return results
+
+
+def _ms(seconds) -> float:
+    return (seconds or 0.) * 1000
+
+
+def print_link_stats():
+    stats = Connection.link_stats()
+    print(f"\nLiquidsoap link, {stats['reconnects']} reconnection(s):")
+    print(f"{'':<22} {'count':>8} {'p50 (ms)':>9} {'p90 (ms)':>9} {'max (ms)':>9} {'errors':>7}")
+    for name, command in stats['commands'].items():
+        rtt = command['rtt']
+        print(f"{name:<22} {rtt['count']:>8} {_ms(rtt['p50']):>9.3f} {_ms(rtt['p90']):>9.3f}"
+            f" {_ms(rtt['max']):>9.3f} {command['errors']:>7}")
+    for name, wait in stats['waits'].items():
+        print(f"{'wait: ' + name:<22} {wait['count']:>8} {_ms(wait['p50']):>9.3f} {_ms(wait['p90']):>9.3f}"
+            f" {_ms(wait['max']):>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10., help="seconds, per phase")
+    parser.add_argument('--latency', type=float, default=0.002, help="fake Liquidsoap's latency, in seconds")
+    parser.add_argument('--picture-size', type=int, default=64 * 1024, help="bytes of cover art in metadata")
+    parser.add_argument('--poll-interval', type=float, default=1.)
+    parser.add_argument('--scheduled', type=int, default=20, help="how many commands to schedule")
+    parser.add_argument('--threads', type=int, default=30, help="Paste's thread pool size")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    fake = FakeLiquidsoap(latency=args.latency, picture_size=args.picture_size)
+    tmp_dir = tempfile.TemporaryDirectory()
+    config = {
+        'db.sqlalchemy.url': "sqlite:///" + os.path.join(tmp_dir.name, "bench.db"),
+        'interface.name': "Benchmark",
+        'metadata_log.extra_fields': [],
+    }
+    config.update(fake.config(poll_interval=args.poll_interval))
+    app.config.update(config)
+    app.init(conf={})
+    Base.metadata.create_all(app.get_engine())
+    Connection.get().wait_available(5)
+
+    server = httpserver.serve(app, host='127.0.0.1', port=0, start_loop=False,
+        use_threadpool=True, threadpool_workers=args.threads)
+    port = server.server_address[1]
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"{args.clients} clients, {args.duration}s per phase, "
+        f"fake Liquidsoap latency {args.latency * 1000}ms, {args.picture_size // 1024} KiB pictures\n")
+    print(f"{'':<22} {'requests':>8} {'req/s':>9} {'p50 (ms)':>8} {'p90 (ms)':>8} {'p99 (ms)':>8} {'max (ms)':>8} {'errors':>7}")
+    load(port, args.clients, args.duration, get_live).report("GET /live", args.duration)
+    load(port, args.clients, args.duration, post_metadata).report("POST /metadata_log", args.duration)
+    MetadataWriter.get().join()
+    scheduled_commands(port, fake, args.scheduled).report("scheduled cmd. delay", args.scheduled * 0.1)
+    print_link_stats()
+
+    server.server_close()
+    fake.stop()
+    tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
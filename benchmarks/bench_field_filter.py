@@ -0,0 +1,64 @@
+"""
+Benchmarks ``FieldFilter.filter`` on payloads of 30 to 60 keys, while the
+number of ``extra_fields`` wildcards grows, comparing it to the previous
+implementation (matching each key against each wildcard).
+
+Run from the repository's root::
+
+    python -m benchmarks.bench_field_filter
+"""
+import re
+from timeit import timeit
+
+from showergel.metadata import FieldFilter
+
+
+def previous_implementation(data:dict, fields:set, wildcards:list, only_extra=True) -> list:
+    result = list()
+    for k, v in data.items():
+        if k and v and (
+            ((not only_extra) and k in [
+            'on_air', 'artist', 'title', 'album', 'source', 'initial_uri'])
+            or
+            (k in fields)
+            or
+            (any(rule.match(k) for rule in wildcards))
+        ):
+            result.append((k, v))
+    return result
+
+
+def payload(keys:int) -> dict:
+    data = {
+        'on_air': "2023/03/01 10:00:00",
+        'artist': "Artist",
+        'title': "Title",
+        'album': "Album",
+        'initial_uri': "/music/track.mp3",
+        'source': "playlist",
+    }
+    for i in range(keys - len(data)):
+        data[f"field_{i}"] = f"value {i}"
+    return data
+
+
+def extra_fields(wildcards:int) -> list:
+    return ["genre", "year"] + [f"prefix{i}_*" for i in range(wildcards - 1)] + ["field_1*"]
+
+
+if __name__ == '__main__':
+    print(f"{'keys':>5} {'wildcards':>10} {'previous (µs)':>14} {'filter (µs)':>12} {'speedup':>8}")
+    for keys in (30, 60):
+        data = payload(keys)
+        for wildcards in (1, 10, 50):
+            config = {'metadata_log.extra_fields': extra_fields(wildcards)}
+            FieldFilter.setup(config)
+            fields = {"genre", "year"}
+            rules = [re.compile(entry.replace('*', '.*')) for entry in extra_fields(wildcards) if '*' in entry]
+            for only_extra in (True, False):
+                assert FieldFilter.filter(data, only_extra=only_extra) == \
+                    previous_implementation(data, fields, rules, only_extra)
+            runs = 10000
+            previous = timeit(lambda: previous_implementation(data, fields, rules), number=runs) / runs
+            current = timeit(lambda: FieldFilter.filter(data), number=runs) / runs
+            print(f"{keys:>5} {wildcards:>10} {previous * 1e6:>14.2f} {current * 1e6:>12.2f} {previous / current:>7.1f}x")
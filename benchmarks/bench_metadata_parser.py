@@ -0,0 +1,41 @@
+"""
+Benchmarks parsing ``<output>.metadata`` responses on tracks embedding cover
+art, comparing ``MetadataParser`` to the previous implementation (decoding
+every line, then matching each one against a regular expression).
+
+Run from the repository's root::
+
+    python -m benchmarks.bench_metadata_parser
+"""
+import re
+from timeit import timeit
+
+from showergel.liquidsoap_connector import MetadataParser, iter_lines
+from benchmarks.bench_telnet_reader import synthetic_metadata
+
+METADATA_PATTERN = re.compile(r"^([^=]+)=\"(.*)\"$")
+
+
+def previous_implementation(raw:bytes, start:int) -> dict:
+    metadata = {}
+    for line in iter_lines(raw, start):
+        if line:
+            parsed = METADATA_PATTERN.match(line)
+            if parsed:
+                metadata[parsed.group(1)] = parsed.group(2)
+    return metadata
+
+
+if __name__ == '__main__':
+    parser = MetadataParser(max_size=4096)
+    print(f"{'response size':>14} {'previous (ms)':>14} {'parser (ms)':>12} {'speedup':>8}")
+    for picture_size in (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024):
+        raw = synthetic_metadata(picture_size)[:-len(b"\r\nEND\r\n")]
+        start = raw.index(b"--- 1 ---\r\n") + len(b"--- 1 ---\r\n")
+        expected = previous_implementation(raw, start)
+        del expected['apic']
+        assert parser.parse(raw, start) == expected
+        runs = 20
+        previous = timeit(lambda: previous_implementation(raw, start), number=runs) / runs
+        current = timeit(lambda: parser.parse(raw, start), number=runs) / runs
+        print(f"{len(raw) // 1024:>11} KiB {previous * 1000:>14.3f} {current * 1000:>12.3f} {previous / current:>7.1f}x")
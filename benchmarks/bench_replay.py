@@ -0,0 +1,85 @@
+"""
+Replays a recording of real Liquidsoap sessions (see
+``showergel.liquidsoap_recording``) as fast as possible, and measures how long
+``TelnetConnector`` takes to handle it: polling what's playing, and loading
+the commands list (parsing ``help``). Use it to catch slowdowns on real-world
+responses, that synthetic benchmarks miss.
+
+Record a session by setting ``record = "session.lsrec"`` in the ``[liquidsoap]``
+section of Showergel's configuration, then run from the repository's root::
+
+    python -m benchmarks.bench_replay session.lsrec
+
+Without a recording, this records and replays a session with the fake
+Liquidsoap, embedding cover art.
+"""
+import argparse
+import logging
+import os
+import tempfile
+from datetime import timedelta
+from timeit import timeit
+
+from showergel.fake_liquidsoap import FakeLiquidsoap
+from showergel.liquidsoap_connector import TelnetConnector
+from showergel.liquidsoap_recording import ReplayLiquidsoap, read_recording
+
+
+def record_fake_session(path:str):
+    server = FakeLiquidsoap(picture_size=256 * 1024)
+    connector = TelnetConnector(server.config(record=path))
+    connector._reconnect_thread.join(5)
+    for _ in range(10):
+        connector.current()
+        connector.skip()
+    connector.recorder.close()
+    server.stop()
+
+
+def connect(replay:ReplayLiquidsoap) -> TelnetConnector:
+    connector = TelnetConnector(replay.config())
+    connector._reconnect_thread.join(5)
+    return connector
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('recording', nargs='?')
+    parser.add_argument('--runs', type=int, default=100)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    path = args.recording
+    if not path:
+        path = os.path.join(tmp_dir.name, "fake.lsrec")
+        record_fake_session(path)
+
+    exchanges = list(read_recording(path))
+    sizes = {}
+    for exchange in exchanges:
+        sizes[exchange.command] = max(sizes.get(exchange.command, 0), len(exchange.response))
+    print(f"{len(exchanges)} exchanges recorded, largest responses:")
+    for command, size in sorted(sizes.items(), key=lambda item: -item[1])[:5]:
+        print(f"  {command:<30} {size / 1024:>10.1f} KiB")
+
+    replay = ReplayLiquidsoap(path)
+    connector = connect(replay)
+    print(f"\n{'operation':<30} {'ms/run':>10}")
+    # disable the metadata cache, so each run fetches and parses metadata
+    def poll():
+        connector._latest_on_air = None
+        connector.current()
+    duration = timeit(poll, number=args.runs) / args.runs
+    print(f"{'current() uncached':<30} {duration * 1000:>10.3f}")
+    duration = timeit(connector.current, number=args.runs) / args.runs
+    print(f"{'current()':<30} {duration * 1000:>10.3f}")
+    duration = timeit(lambda: connector._update_soaps(timedelta()), number=args.runs) / args.runs
+    print(f"{'load commands list':<30} {duration * 1000:>10.3f}")
+
+    replay.stop()
+    tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
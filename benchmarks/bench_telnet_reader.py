@@ -0,0 +1,68 @@
+"""
+Benchmarks reading large Liquidsoap responses, like ``<output>.metadata``
+on tracks embedding cover art.
+
+Compares ``ResponseReader`` and ``iter_lines`` to the previous implementation,
+based on ``telnetlib`` (which concatenated ``bytes`` for each received chunk).
+Data is fed in 4 KiB chunks, as the previous implementation received it.
+
+Run from the repository's root::
+
+    python -m benchmarks.bench_telnet_reader
+"""
+import base64
+import os
+from timeit import timeit
+
+from showergel.liquidsoap_connector import ResponseReader, iter_lines
+
+CHUNK = 4096
+
+
+def synthetic_metadata(picture_size:int) -> bytes:
+    picture = base64.b64encode(os.urandom(picture_size))
+    lines = [b"--- 2 ---", b'title="previous"', b"--- 1 ---"]
+    lines += [b'%s="value number %d"' % (key, i) for i, key in enumerate(
+        [b"artist", b"title", b"album", b"genre", b"year", b"tracknumber"] * 5)]
+    lines.append(b'apic="' + picture + b'"')
+    return b"\r\n".join(lines) + b"\r\nEND\r\n"
+
+
+def previous_implementation(stream:bytes):
+    cookedq = b''
+    found = -1
+    for offset in range(0, len(stream), CHUNK):
+        i = max(0, len(cookedq) - 5)
+        cookedq = cookedq + stream[offset:offset + CHUNK]
+        found = cookedq.find(b"END\r\n", i)
+        if found >= 0:
+            break
+    raw = cookedq[:found + 5].rstrip(b"END\r\n").strip(b"\r\n")
+    lines = []
+    for line in raw.split(b"\n"):
+        try:
+            lines.append(line.strip(b"\r").decode('utf8'))
+        except UnicodeDecodeError:
+            pass
+    return lines
+
+
+def response_reader(stream:bytes):
+    reader = ResponseReader()
+    for offset in range(0, len(stream), CHUNK):
+        reader.feed(stream[offset:offset + CHUNK])
+        raw = reader.next_response()
+        if raw is not None:
+            break
+    return list(iter_lines(raw))
+
+
+if __name__ == '__main__':
+    print(f"{'response size':>14} {'previous (ms)':>14} {'reader (ms)':>12} {'speedup':>8}")
+    for picture_size in (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024):
+        stream = synthetic_metadata(picture_size)
+        assert previous_implementation(stream) == response_reader(stream)
+        runs = 5
+        previous = timeit(lambda: previous_implementation(stream), number=runs) / runs
+        current = timeit(lambda: response_reader(stream), number=runs) / runs
+        print(f"{len(stream) // 1024:>11} KiB {previous * 1000:>14.2f} {current * 1000:>12.2f} {previous / current:>7.1f}x")
@@ -21,6 +21,8 @@ from showergel.rest import sub_apps
 from showergel.liquidsoap_connector import Connection
 from showergel.scheduler import Scheduler
 from showergel.cartfolders import CartFolders
+from showergel.metadata import MetadataWriter, LogSearch
+from showergel.log_archive import LogArchive
 
 _log = logging.getLogger(__name__)
 
@@ -83,7 +85,10 @@ class MainBottle(ShowergelBottle):
         dbsession = factory()
 
         Scheduler.setup(dbsession, store_in_memory=store_scheduler_in_memory)
-        Connection.setup(self.config)
+        Connection.setup(self.config, engine)
+        MetadataWriter.setup(engine, self.config)
+        LogSearch.setup(self.config)
+        LogArchive.setup(self.config, engine)
         CartFolders.setup(dbsession, conf)
 
         if demo:
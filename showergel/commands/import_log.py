@@ -0,0 +1,102 @@
+import gzip
+import re
+from typing import Dict, Iterable, Iterator, TextIO
+
+import arrow
+import click
+import toml
+from bottle import ConfigDict
+from sqlalchemy import engine_from_config
+from sqlalchemy.orm import sessionmaker
+
+from showergel.log_archive import LogArchive
+from showergel.metadata import Log, FieldFilter, LogSearch
+from . import showergel_cli
+
+PATTERNS = {
+    # logged at each track start by the on_track snippet in our docs
+    'now_playing': r'^(?P<on_air>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) \[now_playing:\d\] (?P<initial_uri>.+)$',
+    # request-based sources (playlists, queues...) log this when preparing a
+    # track, which may happen up to a whole track before it goes on air
+    'prepared': r'^(?P<on_air>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) \[(?P<source>[^:\]]+):\d\] Prepared "(?P<initial_uri>[^"]+)"',
+}
+DEFAULT_TIME_FORMAT = "YYYY/MM/DD HH:mm:ss"
+
+
+def open_log(path:str) -> TextIO:
+    """
+    Opens a log file as text, un-gzipping it if needed
+    """
+    with open(path, 'rb') as log_file:
+        magic = log_file.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rt', encoding='utf8', errors='replace')
+    return open(path, 'r', encoding='utf8', errors='replace')
+
+
+def read_track_changes(lines:Iterable[str], pattern:re.Pattern, time_format:str,
+    counts:Dict[str, int]) -> Iterator[Dict]:
+    """
+    Yields a metadata entry for each line matching ``pattern``: its named
+    groups become metadata fields. The ``on_air`` group is parsed with
+    ``time_format`` (in the local timezone).
+    ``counts`` is updated with how many lines were ``read`` and ``matched``.
+    """
+    for line in lines:
+        counts['read'] += 1
+        match = pattern.search(line)
+        if match is None:
+            continue
+        entry = {key: value for key, value in match.groupdict().items() if value}
+        try:
+            entry['on_air'] = arrow.get(entry['on_air'], time_format, tzinfo='local').isoformat()
+        except (KeyError, arrow.parser.ParserError):
+            continue
+        counts['matched'] += 1
+        yield entry
+
+
+@showergel_cli.command(name='import-log')
+@click.argument('config_path', type=click.Path(readable=True, allow_dash=False, exists=True))
+@click.argument('log_paths', nargs=-1, required=True,
+    type=click.Path(readable=True, dir_okay=False, exists=True))
+@click.option('--pattern', required=True,
+    help="Regular expression matching a track change, or one of: " + ", ".join(PATTERNS) + ". "
+    "Its named groups are saved as metadata, it must at least capture on_air")
+@click.option('--time-format', default=DEFAULT_TIME_FORMAT, show_default=True,
+    help="Format of on_air, in Arrow's tokens")
+def import_log(config_path, log_paths, pattern, time_format):
+    """
+    Fill the metadata log from Liquidsoap's log files (maybe gzipped)
+    """
+    try:
+        compiled = re.compile(PATTERNS.get(pattern, pattern))
+    except re.error as error:
+        raise click.BadParameter(str(error), param_hint="--pattern")
+    if 'on_air' not in compiled.groupindex:
+        raise click.BadParameter("must have an (?P<on_air>...) group", param_hint="--pattern")
+
+    with open(config_path, 'r') as f:
+        conf = toml.load(f)
+    config = ConfigDict()
+    config.load_dict(conf)
+    FieldFilter.setup(config)
+    LogSearch.setup(config)
+    engine = engine_from_config(config, prefix="db.sqlalchemy.")
+    db = sessionmaker(bind=engine)()
+    archive = LogArchive.configured(config)
+
+    total = {'inserted': 0, 'skipped': 0}
+    for path in log_paths:
+        counts = {'read': 0, 'matched': 0}
+        with open_log(path) as lines:
+            summary = Log.insert_many(config, db,
+                read_track_changes(lines, compiled, time_format, counts),
+                archive=archive)
+        click.echo(f"{path}: {counts['read']} lines, {counts['matched']} track changes, "
+            f"{summary['inserted']} inserted, {summary['skipped']} already logged")
+        for key in total:
+            total[key] += summary[key]
+    db.close()
+    click.secho(f"{total['inserted']} entries imported, {total['skipped']} were already logged",
+        fg='green', bold=True)
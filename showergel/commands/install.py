@@ -12,7 +12,9 @@ import socket
 
 import click
 import toml
+from bottle import ConfigDict
 from sqlalchemy import engine_from_config
+from sqlalchemy.orm import sessionmaker
 
 from . import showergel_cli
 
@@ -38,6 +40,17 @@ extra_fields = [
     "year",
 ]
 
+# extra fields whose values can be searched, in addition to
+# artist/title/album/initial_uri
+search_fields = [
+    "genre",
+]
+
+# uncomment to move entries older than 12 months (plus the current one) to
+# monthly archive files, in archive_dir
+# retention_months = 12
+# archive_dir = "metadata_log_archives"
+
 ############## Server configuration ##########
 [listen]
 # Showergel's interface will be available at http://[address]:[port]/
@@ -60,6 +73,12 @@ port = {port:d}
 # settings.server.telnet.port.set(1234)
 #
 # then change "method" from "none" to "telnet".
+# If Liquidsoap runs on the same machine, its Unix socket server is faster:
+#
+# settings.server.socket.set(true)
+# settings.server.socket.path.set("/path/to/liquidsoap.sock")
+#
+# then set method = "socket" and path = "/path/to/liquidsoap.sock"
 
 method = "none"
 host = "127.0.0.1"
@@ -267,6 +286,33 @@ backupCount = 10
             config = toml.load(f)
         engine = engine_from_config(config['db']['sqlalchemy'], prefix='')
         Base.metadata.create_all(engine)
+        return engine
+
+    def fill_log_rollup(self, engine):
+        """
+        Computes play counts of the existing log, when upgrading
+        """
+        from showergel.metadata import Log, LogRollup
+        db = sessionmaker(bind=engine)()
+        if db.query(LogRollup).first() is None and db.query(Log).first() is not None:
+            click.echo("Counting plays in the metadata log")
+            LogRollup.rebuild(db)
+        db.close()
+
+    def fill_log_search(self, engine, path_toml):
+        """
+        Indexes the existing log for full-text search, when upgrading
+        """
+        from showergel.metadata import LogSearch
+        with open(path_toml, 'r') as f:
+            config = ConfigDict()
+            config.load_dict(toml.load(f))
+        LogSearch.setup(config)
+        db = sessionmaker(bind=engine)()
+        indexed = LogSearch.fill(db)
+        if indexed:
+            click.echo(f"Indexed {indexed} metadata log entries for search")
+        db.close()
 
     def choose_liquid_script(self, cliprovided=None):
         if cliprovided:
@@ -439,7 +485,9 @@ def update(config_path):
     Update/restore a Showergel installation
     """
     installer = Installer()
-    installer.create_db_schema(path_toml=config_path)
+    engine = installer.create_db_schema(path_toml=config_path)
+    installer.fill_log_rollup(engine)
+    installer.fill_log_search(engine, config_path)
     click.secho("DB is up-to-date", fg='green', bold=True)
     # TODO support restore: re-create/re-enable systemd units
 
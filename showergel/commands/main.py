@@ -1,5 +1,5 @@
 # load sub-commands
-from . import install, serve, version, showergel_cli
+from . import install, import_log, serve, version, showergel_cli
 
 if __name__ == '__main__':
     showergel_cli()
@@ -40,9 +40,13 @@ def serve(config_path, verbose):
     demo = read_bool_param('demo')
     debug = read_bool_param('debug')
     server = 'paste'
+    server_options = {}
     if demo:
         # stubbing to :memory: works better with the default, mono-threaded server
         server = 'wsgiref'
+    else:
+        # each client of /live/stream holds a thread
+        server_options['threadpool_workers'] = int(app.config.get('listen.threads', 30))
     app.run(
         server=server,
         host=app.config['listen.address'],
@@ -52,4 +56,5 @@ def serve(config_path, verbose):
         demo=demo,
         debug=debug,
         conf=conf,
+        **server_options,
     )
@@ -10,7 +10,7 @@ from sqlalchemy.orm import sessionmaker
 import arrow
 
 from showergel.users import User
-from showergel.metadata import Log
+from showergel.metadata import Log, LogRollup
 from showergel.scheduler import Scheduler
 
 try:
@@ -76,6 +76,8 @@ def stub_all(engine, config):
     session = Session()
     stub_users(session)
     stub_log_data(session, config)
+    # entries were saved from the most recent, so airtimes are unknown
+    LogRollup.rebuild(session)
     stub_scheduler()
     session.commit()
     session.close()
@@ -89,6 +91,8 @@ class FakeLiquidsoapConnector:
 
     FAKE_TIME_SHIFT = timedelta(minutes=3)
 
+    available = True
+
     def __init__(self):
         self._uptime = timedelta(hours=10)
         self._on_air = datetime.now().replace(microsecond=0)
@@ -97,7 +101,7 @@ class FakeLiquidsoapConnector:
         self.connected_liquidsoap_version = "Stub"
         self._metadata = self.generate_metadata()
 
-    def command(self, command:str) -> str:
+    def command(self, command:str, priority=False) -> str:
         return "OK"
 
     def uptime(self) -> Type[timedelta]:
@@ -112,6 +116,9 @@ class FakeLiquidsoapConnector:
     def remaining(self):
         return self.FAKE_TIME_SHIFT.total_seconds()
 
+    def close(self):
+        pass
+
     def current(self) -> dict:
         return self._metadata
 
@@ -0,0 +1,315 @@
+"""
+Fake Liquidsoap server
+======================
+
+A small server speaking Liquidsoap's command protocol (over TCP, like
+``server.telnet``, or over a Unix socket, like ``server.socket``), so the real
+connectors can be exercised without Liquidsoap: in unit tests, benchmarks or
+load tests.
+
+It simulates a script with a ``out`` output and a ``queue`` request queue,
+playing tracks of ``track_duration`` seconds. Its behaviour can be tuned:
+
+ * ``latency``: seconds to wait before each response, plus up to ``jitter``
+ * ``picture_size``: bytes of (base64-encoded) cover art in each track's
+   metadata, to simulate large responses
+ * ``responses``: fixed responses, by command - they take precedence
+ * ``delays``: additional latency, by command
+ * ``restart()`` and ``disconnect()`` simulate a Liquidsoap restart, or
+   dropped connections. ``restart_every`` and ``disconnect_every`` (in
+   seconds) will call them periodically.
+
+Run it from the command line::
+
+    python -m showergel.fake_liquidsoap --port 1234 --latency 0.005 --picture-size 65536
+"""
+
+import base64
+import logging
+import os
+import random
+import socket
+import socketserver
+from datetime import datetime
+from threading import Thread, Event, Lock
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+import click
+
+log = logging.getLogger(__name__)
+
+HELP = """Available commands:
+| exit
+| help [<command>]
+| list
+| out.metadata
+| out.remaining
+| out.skip
+| out.start
+| out.status
+| out.stop
+| queue.push <uri>
+| queue.queue
+| quit
+| request.metadata <rid>
+| request.on_air
+| uptime
+| version
+Type "help <command>" for more information."""
+
+UNKNOWN_COMMAND = 'ERROR: unknown command, type "help" to get a list of commands.'
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        if server.address_family != socket.AF_UNIX:
+            # otherwise, each response to a batch waits for the previous one to be acknowledged
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        with server.clients_lock:
+            server.clients.append(self.request)
+        try:
+            for line in self.rfile:
+                command = line.decode('utf8', 'replace').strip()
+                if not command:
+                    continue
+                server.received.append(command)
+                if server.on_command:
+                    server.on_command(command)
+                if command in ('quit', 'exit'):
+                    self.wfile.write(b"Bye!\r\n")
+                    break
+                server.wait(command)
+                self.wfile.write(server.respond_raw(command))
+        except OSError:
+            pass # disconnected by disconnect()
+        finally:
+            with server.clients_lock:
+                if self.request in server.clients:
+                    server.clients.remove(self.request)
+
+
+class FakeLiquidsoap(socketserver.ThreadingTCPServer):
+    """
+    Fake Liquidsoap telnet server, running in background threads from
+    its creation until ``stop()``. Listens on ``address``, by default
+    a random port on localhost.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    VERSION = "Liquidsoap 2.1.4"
+
+    def __init__(self, address=('127.0.0.1', 0), latency:float=0., jitter:float=0.,
+        picture_size:int=0, track_duration:float=180., responses:dict=None,
+        delays:dict=None, restart_every:float=None, disconnect_every:float=None):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.picture_size = picture_size
+        self.track_duration = track_duration
+        self.responses = dict(responses) if responses else {}
+        self.delays = dict(delays) if delays else {}
+        self.received = []
+        self.on_command:Optional[Callable[[str], None]] = None
+        self.clients = []
+        self.clients_lock = Lock()
+        self._state_lock = Lock()
+        self._stopped = Event()
+        self.restart()
+        Thread(target=self.serve_forever, daemon=True).start()
+        if restart_every:
+            self._every(restart_every, self.restart)
+        if disconnect_every:
+            self._every(disconnect_every, self.disconnect)
+
+    def address_config(self) -> dict:
+        return {
+            'liquidsoap.method': "telnet",
+            'liquidsoap.host': self.server_address[0],
+            'liquidsoap.port': self.server_address[1],
+        }
+
+    def config(self, **kwargs) -> dict:
+        """
+        :return: Showergel's configuration connecting to this server,
+            completed with ``[liquidsoap]`` settings given as keyword arguments
+        """
+        config = self.address_config()
+        config['liquidsoap.timeout'] = 2
+        for key, value in kwargs.items():
+            config['liquidsoap.' + key] = value
+        return config
+
+    def _every(self, period:float, action:Callable):
+        def run():
+            while not self._stopped.wait(period):
+                action()
+        Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.shutdown()
+        self.server_close()
+        self.disconnect()
+
+    def restart(self):
+        """
+        Drop all connections, and start over as a new Liquidsoap process
+        """
+        self.disconnect()
+        with self._state_lock:
+            self._started_at = monotonic()
+            self._next_rid = 0
+            self._tracks = []
+            self._next_track()
+
+    def disconnect(self):
+        """
+        Close all clients' connections
+        """
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait(self, command:str):
+        delay = self.latency + self.delays.get(command, 0.)
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            sleep(delay)
+
+    def _next_track(self, uri:str=None):
+        rid = self._next_rid
+        self._next_rid += 1
+        if uri is None:
+            uri = f"/music/track{rid}.mp3"
+        metadata = [
+            ('artist', f"Artist {rid}"),
+            ('title', f"Track {rid}"),
+            ('album', "Fake Liquidsoap"),
+            ('initial_uri', uri),
+            ('source', "queue"),
+            ('on_air', datetime.now().strftime("%Y/%m/%d %H:%M:%S")),
+        ]
+        if self.picture_size:
+            picture = base64.b64encode(os.urandom(self.picture_size * 3 // 4)).decode('ascii')
+            metadata.append(('apic', picture))
+        self._tracks.append((rid, monotonic(), metadata))
+        del self._tracks[:-2]
+
+    def _current_track(self):
+        """
+        Switches to the next track if the current one is over
+        """
+        rid, started, _ = self._tracks[-1]
+        if monotonic() - started >= self.track_duration:
+            self._next_track()
+        return self._tracks[-1]
+
+    def respond_raw(self, command:str) -> bytes:
+        """
+        :return: the response to ``command``, as sent over the wire
+        """
+        return self.respond(command).replace("\n", "\r\n").encode('utf8') + b"\r\nEND\r\n"
+
+    def respond(self, command:str) -> str:
+        if command in self.responses:
+            return self.responses[command]
+        name, _, argument = command.partition(' ')
+        with self._state_lock:
+            rid, started, metadata = self._current_track()
+            if name == 'help':
+                return HELP
+            if name == 'version':
+                return self.VERSION
+            if name == 'uptime':
+                uptime = int(monotonic() - self._started_at)
+                days, uptime = divmod(uptime, 86400)
+                hours, uptime = divmod(uptime, 3600)
+                minutes, seconds = divmod(uptime, 60)
+                return f"{days}d {hours:02d}h {minutes:02d}m {seconds:02d}s"
+            if name == 'request.on_air':
+                return str(rid)
+            if name == 'out.metadata':
+                # oldest first, the current track being "--- 1 ---"
+                dump = []
+                for index, (_, _, track_metadata) in enumerate(self._tracks):
+                    dump.append(f"--- {len(self._tracks) - index} ---")
+                    dump += [f'{key}="{value}"' for key, value in track_metadata]
+                return "\n".join(dump)
+            if name == 'out.remaining':
+                return "%.2f" % max(0., self.track_duration - (monotonic() - started))
+            if name == 'out.skip':
+                self._next_track()
+                return "Done"
+            if name == 'out.status':
+                return "on"
+            if name in ('out.start', 'out.stop'):
+                return "OK"
+            if name == 'queue.push':
+                self._next_rid += 1
+                return str(self._next_rid - 1)
+            if name == 'queue.queue':
+                return ""
+            if name == 'request.metadata':
+                for track_rid, _, track_metadata in self._tracks:
+                    if argument == str(track_rid):
+                        return "\n".join(f'{key}="{value}"' for key, value in track_metadata)
+                return "No such request."
+        return UNKNOWN_COMMAND
+
+
+class FakeLiquidsoapSocket(FakeLiquidsoap, socketserver.ThreadingUnixStreamServer):
+    """
+    Same as ``FakeLiquidsoap``, listening on a Unix socket at ``address``
+    """
+    address_family = socket.AF_UNIX
+
+    def address_config(self) -> dict:
+        return {
+            'liquidsoap.method': "socket",
+            'liquidsoap.path': self.server_address,
+        }
+
+    def stop(self):
+        super().stop()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=1234, show_default=True)
+@click.option('--socket', 'socket_path', help="Listen on a Unix socket at this path, instead of TCP")
+@click.option('--latency', default=0., show_default=True, help="Seconds to wait before each response")
+@click.option('--jitter', default=0., show_default=True, help="Random additional latency, in seconds")
+@click.option('--picture-size', default=0, show_default=True, help="Bytes of cover art in each track's metadata")
+@click.option('--track-duration', default=180., show_default=True, help="In seconds")
+@click.option('--restart-every', type=float, help="Simulate a restart every N seconds")
+@click.option('--disconnect-every', type=float, help="Drop all connections every N seconds")
+def main(host, port, socket_path, **kwargs):
+    """
+    Run a fake Liquidsoap server, until interrupted
+    """
+    logging.basicConfig(level=logging.INFO)
+    if socket_path:
+        server = FakeLiquidsoapSocket(socket_path, **kwargs)
+    else:
+        server = FakeLiquidsoap((host, port), **kwargs)
+    log.info("Fake Liquidsoap listening, configure Showergel with %s", server.address_config())
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main() # pylint: disable=no-value-for-parameter
@@ -0,0 +1,171 @@
+"""
+Liquidsoap link instrumentation
+===============================
+
+In-process statistics about commands sent to Liquidsoap: round-trip time,
+response size and errors per command name, plus the time spent
+waiting for a session or a lock before talking to Liquidsoap.
+
+Values are counted in fixed buckets, so recording is cheap (a bisection and
+a few additions) and memory does not grow with traffic.
+"""
+
+from bisect import bisect_left
+from datetime import datetime
+from threading import Lock
+from typing import Optional, Tuple
+
+# seconds
+TIME_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10.)
+# bytes
+SIZE_BOUNDS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# namespaces defined by Liquidsoap itself - other prefixes are operators' IDs
+_BUILTIN_NAMESPACES = ('request', 'var', 'server', 'runtime')
+
+
+def command_name(command:str) -> str:
+    """
+    Groups commands by what they do: arguments are dropped, and operators' IDs
+    are replaced by ``*``, so ``out.metadata`` becomes ``*.metadata`` and
+    ``queue.push /some/file.mp3`` becomes ``*.push``.
+    """
+    name = command.split(' ', 1)[0]
+    prefix, dot, verb = name.rpartition('.')
+    if dot and prefix not in _BUILTIN_NAMESPACES:
+        return '*.' + verb
+    return name
+
+
+class Histogram:
+    """
+    Counts values in buckets delimited by ``bounds``, the last bucket holding
+    values above the last bound.
+    """
+
+    __slots__ = ('bounds', 'buckets', 'count', 'total', 'max')
+
+    def __init__(self, bounds:Tuple[float, ...]):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value:float):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, ratio:float) -> Optional[float]:
+        """
+        :return: the upper bound of the bucket containing the given percentile
+            (``max`` for the last bucket), or None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        threshold = ratio * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= threshold and bucket:
+                if index < len(self.bounds):
+                    return min(self.bounds[index], self.max)
+                break
+        return self.max
+
+    def to_dict(self) -> dict:
+        buckets = {}
+        for bound, bucket in zip(self.bounds, self.buckets):
+            buckets[f"<={bound}"] = bucket
+        buckets[f">{self.bounds[-1]}"] = self.buckets[-1]
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max if self.count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': buckets,
+        }
+
+
+class CommandStats:
+
+    __slots__ = ('rtt', 'size', 'errors')
+
+    def __init__(self):
+        self.rtt = Histogram(TIME_BOUNDS)
+        self.size = Histogram(SIZE_BOUNDS)
+        self.errors = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'rtt': self.rtt.to_dict(),
+            'size': self.size.to_dict(),
+            'errors': self.errors,
+        }
+
+
+class LinkStats:
+    """
+    Statistics of one Liquidsoap connector. All methods are thread-safe.
+
+    Round-trip times are measured from the moment a batch is written: a
+    command sent in a batch includes the time spent answering previous ones.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+            self._waits = {}
+            self.reconnects = 0
+            self.since = datetime.now()
+
+    def _command(self, command:str) -> CommandStats:
+        name = command_name(command)
+        stats = self._commands.get(name)
+        if stats is None:
+            stats = self._commands[name] = CommandStats()
+        return stats
+
+    def record(self, command:str, rtt:float, size:int):
+        with self._lock:
+            stats = self._command(command)
+            stats.rtt.record(rtt)
+            stats.size.record(size)
+
+    def record_error(self, command:str):
+        with self._lock:
+            self._command(command).errors += 1
+
+    def record_reconnect(self):
+        with self._lock:
+            self.reconnects += 1
+
+    def record_wait(self, what:str, duration:float):
+        """
+        Records time spent waiting for ``what`` (a session, a lock...)
+        """
+        with self._lock:
+            histogram = self._waits.get(what)
+            if histogram is None:
+                histogram = self._waits[what] = Histogram(TIME_BOUNDS)
+            histogram.record(duration)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'since': self.since.isoformat(),
+                'reconnects': self.reconnects,
+                'commands': {name: stats.to_dict()
+                    for name, stats in sorted(self._commands.items())},
+                'waits': {what: histogram.to_dict()
+                    for what, histogram in sorted(self._waits.items())},
+            }
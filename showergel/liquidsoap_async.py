@@ -0,0 +1,272 @@
+"""
+asyncio-based Liquidsoap connector
+==================================
+
+``AsyncTelnetConnector`` offers the same methods as ``TelnetConnector``, but
+all sockets are handled by a single asyncio event loop, running in its own
+thread: waiting for Liquidsoap does not hold a thread per session.
+
+Code running in that loop can await ``async_current``, ``async_uptime``,
+``async_remaining``, ``async_skip``, ``async_command`` and ``async_batch``.
+Other threads simply call the usual, blocking methods - which must not be
+called from the loop, as they wait for it.
+"""
+
+import asyncio
+import logging
+from threading import Thread
+from time import monotonic
+from datetime import timedelta
+from typing import List, Optional, Generator
+
+from sqlalchemy.engine import Engine
+
+from showergel.liquidsoap_connector import TelnetSession, TelnetConnector, iter_lines
+from showergel.link_stats import LinkStats
+
+log = logging.getLogger(__name__)
+
+
+class AsyncTelnetSession(TelnetSession):
+    """
+    One telnet connection to Liquidsoap, over asyncio streams.
+    Like ``TelnetSession``, it should only be used by one task at a time.
+    """
+
+    def __init__(self, host:str, port:int, timeout:int, stats:LinkStats=None, recorder=None):
+        super().__init__(host, port, timeout, stats, recorder)
+        self._stream = None
+        self._writer = None
+
+    async def connect(self):
+        log.info("Attempting to contact Liquidsoap over telnet (asyncio) @%s:%s",
+            self.host, self.port)
+        try:
+            self._stream, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            log.info("Connected.")
+        except (OSError, asyncio.TimeoutError):
+            log.warning("Cannot connect to Liquidsoap. Please check it is running, or check Showergel's configuration.")
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+            self._stream = None
+        self._reader.clear()
+        self._iac_pending = b''
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    def _reply(self, data:bytes):
+        self._writer.write(data)
+
+    async def _read_response(self) -> bytes:
+        while True:
+            response = self._reader.next_response()
+            if response is not None:
+                return response
+            data = await asyncio.wait_for(self._stream.read(self.RECV_SIZE), self.timeout)
+            if not data:
+                # this happens when Liquidsoap says "Connection timed out.. Bye!"
+                raise EOFError()
+            self._reader.feed(self._process_telnet(data))
+
+    async def command(self, command:str) -> Optional[bytes]:
+        responses = await self.batch([command])
+        if responses is None:
+            return None
+        return responses[0]
+
+    async def batch(self, commands:List[str]) -> Optional[List[bytes]]:
+        """
+        see ``TelnetSession.batch``
+        """
+        if not self._writer:
+            self._record_failure(commands)
+            return None
+        payload = b''.join(command.encode('utf8') + b'\n' for command in commands)
+        try:
+            self._writer.write(payload)
+            await self._writer.drain()
+            sent_at = previous = monotonic()
+            responses = []
+            for command in commands:
+                responses.append(await self._read_response())
+                previous = self._record(command, sent_at, previous, responses[-1])
+            return responses
+        except (EOFError, OSError, asyncio.TimeoutError):
+            self._record_failure(commands)
+            self.close()
+            log.warning("Lost connection to %s", self.address)
+        return None
+
+
+class AsyncTelnetConnector(TelnetConnector):
+    """
+    Connects Showergel to Liquidsoap over Telnet, using asyncio.
+
+    Enable it with ``method = "asyncio"`` in the ``[liquidsoap]`` section;
+    other parameters are the same as ``TelnetConnector``.
+
+    Blocking methods must not be called from the event loop's thread: use
+    their ``async_`` versions there. ``current`` and ``uptime`` run their
+    async versions in the loop, so all callers share the same state.
+    """
+
+    def __init__(self, config:dict, engine:Engine=None):
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = Thread(target=self._loop.run_forever,
+            name="liquidsoap-asyncio", daemon=True)
+        self._loop_thread.start()
+        super().__init__(config, engine)
+
+    def _new_session(self) -> AsyncTelnetSession:
+        return AsyncTelnetSession(self.host, self.port, self.timeout,
+            stats=self.stats, recorder=self.recorder)
+
+    def _open_sessions(self, pool_size:int):
+        self._run(self._async_open_sessions(pool_size))
+
+    async def _async_open_sessions(self, pool_size:int):
+        # asyncio primitives should be created from the loop they belong to
+        self._pool_size = pool_size
+        self._pool = asyncio.Queue()
+        for _ in range(pool_size):
+            self._pool.put_nowait(self._new_session())
+        self._priority_lock = asyncio.Lock()
+        self._priority_session = self._new_session()
+        self._state_lock = asyncio.Lock()
+
+    def _try_connect(self) -> bool:
+        return self._run(self._async_try_connect())
+
+    async def _async_try_connect(self) -> bool:
+        sessions = [self._new_session() for _ in range(self._pool_size + 1)]
+        for session in sessions:
+            await session.connect()
+            if not session.connected:
+                for opened in sessions:
+                    opened.close()
+                return False
+        async with self._priority_lock:
+            self._priority_session.close()
+            self._priority_session = sessions.pop()
+        for _ in range(self._pool_size):
+            (await self._pool.get()).close()
+        for session in sessions:
+            self._pool.put_nowait(session)
+        return True
+
+    def _close_sessions(self):
+        self._run(self._async_close_sessions())
+
+    async def _async_close_sessions(self):
+        async with self._priority_lock:
+            self._priority_session.close()
+        pooled = [await self._pool.get() for _ in range(self._pool_size)]
+        for session in pooled:
+            session.close()
+            self._pool.put_nowait(session)
+
+    def close(self):
+        super().close()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def _batch_raw(self, commands:List[str], priority=False) -> List[Optional[bytes]]:
+        if not self.available:
+            self._fail_fast(commands)
+            return [None] * len(commands)
+        return self._run(self._async_batch_raw(commands, priority))
+
+    async def _async_batch_raw(self, commands:List[str], priority=False) -> List[Optional[bytes]]:
+        if not self.available:
+            self._fail_fast(commands)
+            return [None] * len(commands)
+        waiting_since = monotonic()
+        if priority:
+            async with self._priority_lock:
+                self.stats.record_wait("priority session", monotonic() - waiting_since)
+                raws = await self._priority_session.batch(commands)
+        else:
+            session = await self._pool.get()
+            self.stats.record_wait("pooled session", monotonic() - waiting_since)
+            try:
+                raws = await session.batch(commands)
+            finally:
+                self._pool.put_nowait(session)
+        if raws is None:
+            self._connection_lost()
+            return [None] * len(commands)
+        return raws
+
+    async def async_batch(self, commands:List[str], priority=False) -> List[Optional[List[str]]]:
+        """
+        Coroutine version of ``batch``
+        """
+        return [None if raw is None else list(iter_lines(raw))
+            for raw in await self._async_batch_raw(commands, priority)]
+
+    async def async_command(self, command:str, priority=False) -> Optional[List[str]]:
+        """
+        Coroutine version of ``command``
+        """
+        return (await self.async_batch([command], priority=priority))[0]
+
+    async def _async_drive(self, steps:Generator):
+        """
+        Coroutine version of ``_drive``
+        """
+        try:
+            commands = next(steps)
+            while True:
+                commands = steps.send(await self._async_batch_raw(commands))
+        except StopIteration as stop:
+            return stop.value
+
+    async def _async_locked_drive(self, steps:Generator):
+        waiting_since = monotonic()
+        async with self._state_lock:
+            self.stats.record_wait("connector lock", monotonic() - waiting_since)
+            return await self._async_drive(steps)
+
+    def current(self) -> dict:
+        return self._run(self.async_current())
+
+    def uptime(self) -> timedelta:
+        return self._run(self.async_uptime())
+
+    async def async_current(self) -> dict:
+        """
+        Coroutine version of ``current``
+        """
+        if not self.available:
+            return self._unreachable()
+        return await self._async_locked_drive(self._current_steps())
+
+    async def async_uptime(self) -> timedelta:
+        """
+        Coroutine version of ``uptime``
+        """
+        return await self._async_locked_drive(self._uptime_steps())
+
+    async def async_remaining(self) -> Optional[float]:
+        """
+        Coroutine version of ``remaining``
+        """
+        if self._first_output_name:
+            raw = (await self._async_batch_raw([self._first_output_name + '.remaining']))[0]
+            return self._parse_remaining(self._first_line(raw))
+        return None
+
+    async def async_skip(self):
+        """
+        Coroutine version of ``skip``
+        """
+        if self._first_output_name:
+            await self._async_batch_raw([self._first_output_name + '.skip'], priority=True)
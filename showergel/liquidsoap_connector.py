@@ -1,131 +1,379 @@
 import logging
+import os
 import re
-from typing import Type, Optional, List
+from fnmatch import translate
+from typing import Type, Optional, List, Mapping, Tuple, NamedTuple, Iterator, Iterable, Generator
 from datetime import timedelta, datetime
-from threading import RLock
-from telnetlib import Telnet
-from time import sleep
+from threading import RLock, Lock, Event, Thread, Condition
+from types import MappingProxyType
+import socket
+from contextlib import contextmanager
+from queue import Queue
+from collections import OrderedDict
 from itertools import groupby
+from time import monotonic
 
 import arrow
+from sqlalchemy import Column, String, Text
+from sqlalchemy.dialects.sqlite import DATETIME
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from showergel.db import Base
+from showergel.link_stats import LinkStats
 
 log = logging.getLogger(__name__)
 
-from telnetlib import Telnet, theNULL, IAC, DO, DONT, WILL, WONT, SE, SB, NOOPT, _TelnetSelector, selectors
-class FasterTelnet(Telnet):
-    """This is needed for Python versions affected by https://bugs.python.org/issue46740
+IAC  = 255 # "Interpret As Command"
+DONT = 254
+DO   = 253
+WONT = 252
+WILL = 251
+SB   = 250 # subnegotiation begin
+SE   = 240 # subnegotiation end
+
+
+class ResponseReader:
+    """
+    Splits the byte stream sent by Liquidsoap into responses, each one ending
+    with an ``END`` line.
+
+    Received data is appended to a single ``bytearray``, and each byte is
+    scanned only once when looking for the terminator - so reading a response
+    is linear in its size, even if it arrives in many small chunks.
     """
 
-    def fill_rawq(self):
-        """Fill raw queue from exactly one recv() system call.
+    TERMINATOR = b"\nEND\r\n"
 
-        Block if no data is immediately available.  Set self.eof when
-        connection is closed.
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def feed(self, data:bytes):
+        self._buffer += data
 
+    def next_response(self) -> Optional[bytes]:
+        """
+        :return: the next complete response (without its ``END`` line nor
+            trailing line break), or None if it hasn't been fully received yet.
         """
-        if self.irawq >= len(self.rawq):
-            self.rawq = b''
-            self.irawq = 0
-        buf = self.sock.recv(4096)
-        self.msg("recv %r", buf)
-        self.eof = (not buf)
-        self.rawq = buf
+        buffer = self._buffer
+        if buffer.startswith(self.TERMINATOR[1:]): # empty response
+            del buffer[:len(self.TERMINATOR) - 1]
+            self._scanned = 0
+            return b''
+        index = buffer.find(self.TERMINATOR, self._scanned)
+        if index < 0:
+            # the terminator might start in the last few bytes
+            self._scanned = max(0, len(buffer) - len(self.TERMINATOR) + 1)
+            return None
+        end = index
+        if end > 0 and buffer[end - 1] == 13: # \r
+            end -= 1
+        with memoryview(buffer) as view:
+            response = bytes(view[:end])
+        del buffer[:index + len(self.TERMINATOR)]
+        self._scanned = 0
+        return response
 
-    def process_rawq(self):
-        """Transfer from raw queue to cooked queue.
+    def clear(self):
+        self._buffer = bytearray()
+        self._scanned = 0
 
-        Set self.eof when connection is closed.  Don't block unless in
-        the midst of an IAC sequence.
 
+def iter_lines(raw:bytes, start:int=0) -> Iterator[str]:
+    """
+    Lazily decodes the lines of a raw response, from offset ``start``.
+
+    We split Liquidsoap's raw response before unidecoding it because
+    sometimes a line might contain incorrect Unicode - this is typically
+    caused byweird metadata (embedded images, etc.). In that case, the
+    line is just ignored.
+    """
+    with memoryview(raw) as view:
+        length = len(raw)
+        while start <= length:
+            end = raw.find(b"\n", start)
+            if end < 0:
+                end = length
+            stop = end
+            if stop > start and raw[stop - 1] == 13: # \r
+                stop -= 1
+            try:
+                line = str(view[start:stop], 'utf8')
+            except UnicodeDecodeError:
+                # leave logging for experiments, otherwise it can quickly fill the log
+                #log.debug("Error while decoding %r", raw[start:stop])
+                line = None
+            if line is not None:
+                yield line
+            start = end + 1
+
+
+class MetadataParser:
+    """
+    Parses ``key="value"`` lines of a raw metadata response, in a single pass
+    over bytes: each value is decoded only if its key matches one of the
+    ``fields`` patterns (where ``*`` matches any characters - all keys match
+    if ``fields`` is None) and if it's not longer than ``max_size`` bytes.
+    So embedded pictures or lyrics are dropped without being decoded.
+
+    Fields Showergel relies on are always kept, if not oversized.
+    """
+
+    REQUIRED_FIELDS = ('on_air', 'artist', 'title', 'album', 'source', 'status',
+        'initial_uri', 'source_url')
+    _KEYS_CACHE_SIZE = 1024
+
+    def __init__(self, fields:Iterable[str]=None, max_size:int=None):
+        if fields is None:
+            self._pattern = None
+        else:
+            patterns = list(self.REQUIRED_FIELDS) + list(fields)
+            self._pattern = re.compile("|".join(translate(p) for p in patterns))
+        self.max_size = max_size
+        self._keys = {}
+
+    def _key(self, raw_key:bytes) -> Optional[str]:
+        """
+        :return: the decoded key if it's allowed, None otherwise
         """
-        buf = [b'', b'']
         try:
-            while self.rawq:
-                if not self.iacseq:
-                    slice = self._next_nonIAC_slice()
-                    if slice:
-                        buf[self.sb] = buf[self.sb] + slice
-                    else:
-                        c = self.rawq_getchar()
-                        if c == theNULL:
-                            continue
-                        elif c == b"\021":
-                            continue
-                        else:
-                            self.iacseq += c
-                elif len(self.iacseq) == 1:
-                    c = self.rawq_getchar()
-                    # 'IAC: IAC CMD [OPTION only for WILL/WONT/DO/DONT]'
-                    if c in (DO, DONT, WILL, WONT):
-                        self.iacseq += c
-                        continue
-
-                    self.iacseq = b''
-                    if c == IAC:
-                        buf[self.sb] = buf[self.sb] + c
-                    else:
-                        if c == SB: # SB ... SE start.
-                            self.sb = 1
-                            self.sbdataq = b''
-                        elif c == SE:
-                            self.sb = 0
-                            self.sbdataq = self.sbdataq + buf[1]
-                            buf[1] = b''
-                        if self.option_callback:
-                            # Callback is supposed to look into
-                            # the sbdataq
-                            self.option_callback(self.sock, c, NOOPT)
-                        else:
-                            # We can't offer automatic processing of
-                            # suboptions. Alas, we should not get any
-                            # unless we did a WILL/DO before.
-                            self.msg('IAC %d not recognized' % ord(c))
-                elif len(self.iacseq) == 2:
-                    c = self.rawq_getchar()
-                    cmd = self.iacseq[1:2]
-                    self.iacseq = b''
-                    opt = c
-                    if cmd in (DO, DONT):
-                        self.msg('IAC %s %d',
-                            cmd == DO and 'DO' or 'DONT', ord(opt))
-                        if self.option_callback:
-                            self.option_callback(self.sock, cmd, opt)
-                        else:
-                            self.sock.sendall(IAC + WONT + opt)
-                    elif cmd in (WILL, WONT):
-                        self.msg('IAC %s %d',
-                            cmd == WILL and 'WILL' or 'WONT', ord(opt))
-                        if self.option_callback:
-                            self.option_callback(self.sock, cmd, opt)
-                        else:
-                            self.sock.sendall(IAC + DONT + opt)
-        except EOFError: # raised by self.rawq_getchar()
-            self.iacseq = b'' # Reset on EOF
-            self.sb = 0
-        self.cookedq = self.cookedq + buf[0]
-        self.sbdataq = self.sbdataq + buf[1]
-
-    def _next_nonIAC_slice(self):
-        """Return next non-IAC characters from raw queue.
-        Assumes the caller checked the raw queue is not empty.
-        """
-        next_i = self.irawq
-        max_i = len(self.rawq)
-        while next_i < max_i:
-            c = self.rawq[next_i]
-            if c == theNULL[0] or c == 0x11 or c == IAC[0]:
+            return self._keys[raw_key]
+        except KeyError:
+            pass
+        try:
+            key = raw_key.decode('utf8')
+            if self._pattern is not None and not self._pattern.match(key):
+                key = None
+        except UnicodeDecodeError:
+            key = None
+        if len(self._keys) >= self._KEYS_CACHE_SIZE:
+            self._keys.clear()
+        self._keys[raw_key] = key
+        return key
+
+    def parse(self, raw:bytes, start:int=0) -> dict:
+        """
+        Parses lines of ``raw``, from offset ``start``.
+        """
+        metadata = {}
+        max_size = self.max_size
+        length = len(raw)
+        with memoryview(raw) as view:
+            while start < length:
+                end = raw.find(b"\n", start)
+                if end < 0:
+                    end = length
+                stop = end
+                if stop > start and raw[stop - 1] == 13: # \r
+                    stop -= 1
+                equal = raw.find(b"=", start, stop)
+                if equal > start and stop - equal >= 3 \
+                    and raw[equal + 1] == 34 and raw[stop - 1] == 34: # "
+                    if max_size is None or stop - equal - 3 <= max_size:
+                        key = self._key(bytes(view[start:equal]))
+                        if key is not None:
+                            try:
+                                metadata[key] = str(view[equal + 2:stop - 1], 'utf8')
+                            except UnicodeDecodeError:
+                                pass
+                elif stop > start:
+                    log.warning("Can't parse metadata item: %r", bytes(view[start:min(stop, start + 100)]))
+                start = end + 1
+        return metadata
+
+
+class TelnetSession:
+    """
+    One telnet connection to Liquidsoap. This is not thread-safe:
+    ``TelnetConnector`` lends each session to one thread at a time.
+    Commands' timings are recorded in ``stats``, if given, and exchanges are
+    saved to ``recorder`` (see ``showergel.liquidsoap_recording``).
+    """
+
+    RECV_SIZE = 65536
+    PROTOCOL = "telnet"
+
+    def __init__(self, host:str, port:int, timeout:int, stats:LinkStats=None, recorder=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.stats = stats
+        self.recorder = recorder
+        self._sock = None
+        self._reader = ResponseReader()
+        self._iac_pending = b''
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def _open_socket(self) -> socket.socket:
+        return socket.create_connection((self.host, self.port), self.timeout)
+
+    def connect(self):
+        log.info("Attempting to contact Liquidsoap over %s @%s",
+            self.PROTOCOL, self.address)
+        try:
+            self._sock = self._open_socket()
+            log.info("Connected.")
+        except OSError:
+            log.warning("Cannot connect to Liquidsoap. Please check it is running, or check Showergel's configuration.")
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+        self._reader.clear()
+        self._iac_pending = b''
+
+    def _process_telnet(self, data:bytes) -> bytes:
+        """
+        Removes telnet negotiation sequences from ``data``, and refuses any
+        option. Liquidsoap does not send any, so this is rarely used.
+        """
+        data = self._iac_pending + data
+        self._iac_pending = b''
+        if IAC not in data:
+            return data
+        cooked = bytearray()
+        i = 0
+        length = len(data)
+        while i < length:
+            j = data.find(IAC, i)
+            if j < 0:
+                cooked += data[i:]
+                break
+            cooked += data[i:j]
+            if j + 1 >= length:
+                self._iac_pending = data[j:]
                 break
-            next_i += 1
+            cmd = data[j + 1]
+            if cmd == IAC:
+                cooked.append(IAC)
+                i = j + 2
+            elif cmd in (DO, DONT, WILL, WONT):
+                if j + 2 >= length:
+                    self._iac_pending = data[j:]
+                    break
+                answer = WONT if cmd in (DO, DONT) else DONT
+                self._reply(bytes((IAC, answer, data[j + 2])))
+                i = j + 3
+            elif cmd == SB:
+                end = data.find(bytes((IAC, SE)), j + 2)
+                if end < 0:
+                    self._iac_pending = data[j:]
+                    break
+                i = end + 2
+            else:
+                i = j + 2
+        return bytes(cooked)
+
+    def _reply(self, data:bytes):
+        self._sock.sendall(data)
+
+    def _read_response(self) -> bytes:
+        while True:
+            response = self._reader.next_response()
+            if response is not None:
+                return response
+            data = self._sock.recv(self.RECV_SIZE)
+            if not data:
+                # this happens when Liquidsoap says "Connection timed out.. Bye!"
+                raise EOFError()
+            self._reader.feed(self._process_telnet(data))
 
-        if next_i == self.irawq:
+    def command(self, command:str) -> Optional[bytes]:
+        """
+        Run a Liquidsoap command.
+
+        :return: the raw response, or None if Liquidsoap can't be reached
+        """
+        responses = self.batch([command])
+        if responses is None:
             return None
-        else:
-            slice = self.rawq[self.irawq:next_i]
-            self.irawq = next_i
-            if next_i == max_i:
-                self.rawq = b''
-                self.irawq = 0
-            return slice
+        return responses[0]
+
+    def batch(self, commands:List[str]) -> Optional[List[bytes]]:
+        """
+        Write all commands at once, then read their responses in order.
+        If that fails the session is closed: it's up to the caller to re-open it.
+
+        :return: raw responses, or None if Liquidsoap can't be reached
+        """
+        if not self._sock:
+            self._record_failure(commands)
+            return None
+        payload = b''.join(command.encode('utf8') + b'\n' for command in commands)
+        # log.debug("Telnet commands: %r", commands)
+        try:
+            self._sock.sendall(payload)
+            sent_at = previous = monotonic()
+            responses = []
+            for command in commands:
+                responses.append(self._read_response())
+                previous = self._record(command, sent_at, previous, responses[-1])
+            return responses
+        except (EOFError, OSError):
+            self._record_failure(commands)
+            self.close()
+            log.warning("Lost connection to %s", self.address)
+        return None
+
+    def _record(self, command:str, sent_at:float, previous:float, response:bytes) -> float:
+        """
+        ``previous`` is when the previous response of the batch was read
+
+        :return: now
+        """
+        now = monotonic()
+        if self.stats:
+            self.stats.record(command, now - sent_at, len(response))
+        if self.recorder:
+            self.recorder.record(command, now - previous, response)
+        return now
+
+    def _record_failure(self, commands:List[str]):
+        if self.stats:
+            for command in commands:
+                self.stats.record_error(command)
+
+
+class SocketSession(TelnetSession):
+    """
+    One connection to Liquidsoap's Unix socket server: it speaks the same
+    protocol as the telnet server, without telnet negotiation.
+    """
+
+    PROTOCOL = "Unix socket"
+
+    def __init__(self, path:str, timeout:int, stats:LinkStats=None, recorder=None):
+        super().__init__(None, None, timeout, stats, recorder)
+        self.path = path
+
+    @property
+    def address(self) -> str:
+        return self.path
+
+    def _open_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _process_telnet(self, data:bytes) -> bytes:
+        return data
+
 
 class TelnetConnector:
     """
@@ -153,96 +401,267 @@ class TelnetConnector:
     to identify the main output - the one polled from Showergel's "now playing"
     page. In that case, you can also set ``output`` in this section, giving the
     ID of the main output.
+
+    Commands are sent over a pool of ``pool_size`` telnet sessions (defaults
+    to 2), so a slow response does not delay other callers. Another session is
+    reserved to time-critical commands, sent with ``priority=True``:
+    skipping, and scheduled commands.
+
+    Liquidsoap's uptime is queried only every ``uptime_interval`` seconds
+    (defaults to 60) or after a reconnection, and estimated in between. If it
+    shows Liquidsoap restarted, we update the list of available commands.
+    When given an ``engine``, that list is also cached in the DB
+    (see ``LiquidsoapCatalogue``).
+
+    Connections are opened by a background thread. When a session fails, or
+    while Liquidsoap can't be reached, commands fail immediately (returning
+    None) while that thread re-opens sessions, waiting up to ``reconnect_max_delay`` seconds (defaults to 30)
+    between attempts.
+
+    If ``metadata_max_size`` is set, metadata values longer than that many
+    bytes are dropped, and if ``metadata_fields`` is set only those fields are
+    kept (see ``MetadataParser``). This avoids decoding embedded pictures.
+
+    The main output's metadata is only fetched when the request on air changes,
+    as told by ``request.on_air``: parsed metadata of the latest requests are
+    cached by request ID.
+
+    Each command's round-trip time, response size and errors are
+    recorded in ``stats``, along with the time spent waiting for a session
+    or a lock (see ``showergel.link_stats``).
+
+    Set ``record`` to a file path to record all exchanges with Liquidsoap
+    (see ``showergel.liquidsoap_recording``).
     """
 
     UPTIME_PATTERN = re.compile(r"([0-9]+)d ([0-9]+)h ([0-9]+)m ([0-9]+)s")
-    METADATA_PATTERN = re.compile(r"^([^=]+)=\"(.*)\"$")
     _REQUIRED_OUTPUT_COMMANDS = set(['remaining', 'skip', 'metadata'])
+    # uptime is only precise to the second, and read after some network delay
+    _RESTART_TOLERANCE = 5.
+    _RECONNECT_MIN_DELAY = 1.
+    _METADATA_CACHE_SIZE = 16
 
-    def __init__(self, config:dict):
+    def __init__(self, config:dict, engine:Engine=None):
         self._lock = RLock()
-        self.host = config['liquidsoap.host']
-        self.port = config['liquidsoap.port']
+        self._engine = engine
+        self._configure_address(config)
         if 'liquidsoap.timeout' in config:
             self.timeout = int(config['liquidsoap.timeout'])
         else:
             self.timeout = 10
         self._favorite_output = config.get('liquidsoap.output')
-
-        self._connection = FasterTelnet()
-        self._connect()
+        metadata_max_size = config.get('liquidsoap.metadata_max_size')
+        self._metadata_parser = MetadataParser(
+            config.get('liquidsoap.metadata_fields'),
+            int(metadata_max_size) if metadata_max_size else None,
+        )
+        self._uptime_interval = float(config.get('liquidsoap.uptime_interval', 60))
+        self._reconnected = False
+        self._connected_once = False
+        self._started_at = None
+        self._uptime_checked_at = None
+        self._reconnect_max_delay = float(config.get('liquidsoap.reconnect_max_delay', 30))
+        self._available = Event()
+        self._closing = Event()
+        self._breaker_lock = Lock()
+        self._reconnect_thread = None
+        self.stats = LinkStats()
+        self.recorder = None
+        if config.get('liquidsoap.record'):
+            from showergel.liquidsoap_recording import Recorder
+            self.recorder = Recorder(config['liquidsoap.record'])
 
         self.commands = []
         self._status_commands = []
         self._first_output_name = None
-        self._soaps_updated_at = None
         self.connected_liquidsoap_version = None
-        self.uptime()
         self._latest_active_source = None
+        self._metadata_cache = OrderedDict()
+        self._latest_on_air = None
+        self._latest_remaining = None
+
+        self._open_sessions(max(1, int(config.get('liquidsoap.pool_size', 2))))
+        self._connection_lost()
 
-    def _connect(self, reconnect=False):
-        self._lock.acquire()
-        if reconnect:
-            self._connection.close()
-            self._connection = FasterTelnet()
-        log.info("Attempting to contact Liquidsoap over telnet @%s:%s",
-            self.host, self.port)
+    def _configure_address(self, config:dict):
+        self.host = config['liquidsoap.host']
+        self.port = config['liquidsoap.port']
+
+    @property
+    def available(self) -> bool:
+        """
+        False while Liquidsoap can't be reached
+        """
+        return self._available.is_set()
+
+    def wait_available(self, timeout:float=None) -> bool:
+        """
+        Blocks until Liquidsoap is reachable, or ``timeout`` (in seconds) expires.
+        """
+        return self._available.wait(timeout)
+
+    def _connection_lost(self):
+        """
+        Makes commands fail immediately, and starts the background reconnection.
+        """
+        with self._breaker_lock:
+            if self._available.is_set():
+                log.warning("Lost connection to Liquidsoap, will retry in background")
+            self._available.clear()
+            if self._reconnect_thread is None and not self._closing.is_set():
+                self._reconnect_thread = Thread(target=self._reconnect,
+                    name="liquidsoap-reconnect", daemon=True)
+                self._reconnect_thread.start()
+
+    def _reconnect(self):
+        delay = self._RECONNECT_MIN_DELAY
+        while not self._try_connect():
+            if self._closing.wait(delay):
+                break
+            delay = min(delay * 2, self._reconnect_max_delay)
+        with self._breaker_lock:
+            if self._closing.is_set():
+                self._reconnect_thread = None
+                return
+            if self._connected_once:
+                self.stats.record_reconnect()
+            self._connected_once = True
+            # Liquidsoap may have restarted while we were disconnected
+            self._reconnected = True
+            self._available.set()
         try:
-            self._connection.open(
-                host=self.host,
-                port=self.port,
-                timeout=self.timeout
-            )
-            log.info("Connected.")
-        except ConnectionRefusedError:
-            log.warning("Cannot connect to Liquidsoap. Please check it is running, or check Showergel's configuration.")
-        self._lock.release()
+            # reload the commands list if needed
+            self.uptime()
+        except Exception: # pylint: disable=broad-except
+            log.exception("Error while querying Liquidsoap's uptime")
+        with self._breaker_lock:
+            self._reconnect_thread = None
+            lost_again = not self._available.is_set()
+        if lost_again:
+            self._connection_lost()
 
-    def _decode(self, raw:str) -> List[str]:
+    def close(self):
         """
-        We split Liquidsoap's raw response before unidecoding it because
-        sometimes a line might contain incorrect Unicode - this is typically
-        caused byweird metadata (embedded images, etc.). In that case, the
-        line is just ignored.
+        Stops reconnecting, then closes all sessions and the recording:
+        the connector can't be used afterwards.
         """
-        response = []
-        for line in raw.split(b"\n"):
-            try:
-                response.append(line.strip(b"\r").decode('utf8'))
-            except UnicodeDecodeError as error:
-                # leave logging for experiments, otherwise it can quickly fill the log
-                #log.debug("Error while decoding %r", line)
-                #log.debug("%s", error)
-                pass
-        return response
+        with self._breaker_lock:
+            self._closing.set()
+            self._available.clear()
+            reconnect_thread = self._reconnect_thread
+        if reconnect_thread:
+            reconnect_thread.join()
+        self._close_sessions()
+        if self.recorder:
+            self.recorder.close()
 
-    def command(self, command:str) -> Optional[List[str]]:
+    def _close_sessions(self):
+        with self._priority_lock:
+            self._priority_session.close()
+        # waits for sessions still in use
+        pooled = [self._pool.get() for _ in range(self._pool_size)]
+        for session in pooled:
+            session.close()
+            self._pool.put(session)
+
+    def _try_connect(self) -> bool:
+        """
+        Opens new sessions, replacing all previous ones: when one fails,
+        others are likely to be broken too.
+        """
+        sessions = [self._new_session() for _ in range(self._pool_size + 1)]
+        for session in sessions:
+            session.connect()
+            if not session.connected:
+                for opened in sessions:
+                    opened.close()
+                return False
+        with self._priority_lock:
+            self._priority_session.close()
+            self._priority_session = sessions.pop()
+        # waits for sessions still in use, so each one is replaced
+        for _ in range(self._pool_size):
+            self._pool.get().close()
+        for session in sessions:
+            self._pool.put(session)
+        return True
+
+    def _new_session(self) -> TelnetSession:
+        return TelnetSession(self.host, self.port, self.timeout,
+            stats=self.stats, recorder=self.recorder)
+
+    def _open_sessions(self, pool_size:int):
+        # sessions are connected by the reconnection thread
+        self._pool_size = pool_size
+        self._pool = Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._new_session())
+        self._priority_lock = Lock()
+        self._priority_session = self._new_session()
+
+    def command(self, command:str, priority=False) -> Optional[List[str]]:
         """
         Run a Liquidsoap command, and return its result.
+
+        Set ``priority`` for time-critical commands: they will use the reserved
+        session instead of waiting for one from the pool.
+        """
+        return self.batch([command], priority=priority)[0]
+
+    def batch(self, commands:List[str], priority=False) -> List[Optional[List[str]]]:
+        """
+        Run a few Liquidsoap commands in a single network round trip: they are
+        all written at once, then responses are read in order.
+
+        :return: the list of responses, one per command - responses are None
+            if Liquidsoap can't be reached
+        """
+        return [None if raw is None else list(iter_lines(raw))
+            for raw in self._batch_raw(commands, priority)]
+
+    def _batch_raw(self, commands:List[str], priority=False) -> List[Optional[bytes]]:
+        """
+        Same as ``batch``, but responses are not decoded.
         """
-        self._lock.acquire()
-        response = None
-        remaining_attempts = 2
-        while remaining_attempts > 0:
-            # log.debug("Telnet command: %s", command)
-            remaining_attempts -= 1
+        if not self._available.is_set():
+            self._fail_fast(commands)
+            return [None] * len(commands)
+        waiting_since = monotonic()
+        if priority:
+            with self._priority_lock:
+                self.stats.record_wait("priority session", monotonic() - waiting_since)
+                raws = self._priority_session.batch(commands)
+        else:
+            session = self._pool.get()
+            self.stats.record_wait("pooled session", monotonic() - waiting_since)
             try:
-                if not self._connection.sock:
-                    raise BrokenPipeError()
-                self._connection.write(command.encode('utf8') + b'\n')
-                raw = self._connection.read_until(b'END\r\n').rstrip(b"END\r\n").strip(b"\r\n")
-                if raw == b"Connection timed out.. Bye!":
-                    raise EOFError()
-                response = self._decode(raw)
-                # log.debug("Telnet response: %r", response)
-                break
-            except (EOFError, BrokenPipeError, ConnectionResetError):
-                if remaining_attempts:
-                    self._connect(reconnect=True)
-                else:
-                    log.critical("Failed to open connection to %s:%s", self.host, self.port)
-        self._lock.release()
-        return response
+                raws = session.batch(commands)
+            finally:
+                self._pool.put(session)
+        if raws is None:
+            self._connection_lost()
+            return [None] * len(commands)
+        return raws
+
+    def _fail_fast(self, commands:List[str]):
+        for command in commands:
+            self.stats.record_error(command)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds ``_lock``, recording how long it took to get it.
+        """
+        waiting_since = monotonic()
+        with self._lock:
+            self.stats.record_wait("connector lock", monotonic() - waiting_since)
+            yield
+
+    @staticmethod
+    def _first_line(raw:Optional[bytes]) -> Optional[str]:
+        if raw is None:
+            return None
+        return next(iter_lines(raw), None)
 
     def uptime(self) -> Type[timedelta]:
         """
@@ -251,10 +670,42 @@ class TelnetConnector:
 
         :return timedelta: the connected Liquidsoap instance's uptime
         """
-        self._lock.acquire()
-        raw_uptime = self.command("uptime")
+        with self._locked():
+            return self._drive(self._uptime_steps())
+
+    def _drive(self, steps:Generator):
+        """
+        Runs ``steps``: a generator that yields lists of commands, receives
+        their raw responses and finally returns its result. So the same
+        steps can be driven by blocking or asyncio batches.
+        """
+        try:
+            commands = next(steps)
+            while True:
+                commands = steps.send(self._batch_raw(commands))
+        except StopIteration as stop:
+            return stop.value
+
+    def _uptime_steps(self) -> Generator:
+        responses = yield ["uptime"]
+        return (yield from self._check_uptime(self._first_line(responses[0])))
+
+    def _uptime_is_due(self) -> bool:
+        return self._started_at is None or self._reconnected or \
+            monotonic() - self._uptime_checked_at >= self._uptime_interval
+
+    def _estimated_uptime(self) -> Type[timedelta]:
+        return timedelta(seconds=int(monotonic() - self._started_at))
+
+    def _check_uptime(self, raw_uptime:Optional[str]) -> Generator:
+        """
+        Parses the response to ``uptime``, and updates the list of soap objects
+        if Liquidsoap rebooted - that is, if it started later than we thought.
+        Steps (see ``_drive``) returning the uptime.
+        """
+        self._reconnected = False
         if raw_uptime:
-            parsed = self.UPTIME_PATTERN.match(raw_uptime[0])
+            parsed = self.UPTIME_PATTERN.match(raw_uptime)
         else:
             parsed = None
         if parsed:
@@ -264,28 +715,35 @@ class TelnetConnector:
                 minutes = int(parsed.group(3)),
                 seconds = int(parsed.group(4)),
             )
-            if not self._soaps_updated_at or uptime < self._soaps_updated_at:
-                self._update_soaps()
-                self._soaps_updated_at = uptime
+            now = monotonic()
+            started_at = now - uptime.total_seconds()
+            if self._started_at is None or started_at - self._started_at > self._RESTART_TOLERANCE:
+                yield from self._update_soaps(uptime)
+            self._started_at = started_at
+            self._uptime_checked_at = now
         else:
             uptime = timedelta()
             log.error("Cannot parse uptime: %r", raw_uptime)
-
-        self._lock.release()
         return uptime
 
-    def _update_soaps(self):
-        self.commands = []
-        raw = self.command("help")
-        if raw:
-            for line in raw:
-                if line.startswith("|"):
-                    command = line[2:]
-                    if not command.startswith('help ') and \
-                        not command.startswith('request.') and \
-                        command not in ('exit', 'list', 'quit', 'uptime', 'version'):
-                        self.commands.append(command)
+    def _update_soaps(self, uptime:timedelta) -> Generator:
+        started_at = datetime.utcnow() - uptime
+        if self._engine is None:
+            raw_help, raw_version = yield ["help", "version"]
+            version = self._first_line(raw_version)
+            commands = self._parse_help(raw_help)
+        else:
+            version = self._first_line((yield ["version"])[0])
+            commands = LiquidsoapCatalogue.load(self._engine, self._instance_name(),
+                version, started_at)
+            if commands is None:
+                commands = self._parse_help((yield ["help"])[0])
+                LiquidsoapCatalogue.save(self._engine, self._instance_name(),
+                    version, started_at, commands)
+            else:
+                log.info("Using commands list cached for %s", version)
 
+        self.commands = commands
         if self._favorite_output:
             self._first_output_name = self._favorite_output
             expected = self._first_output_name + '.metadata'
@@ -308,7 +766,26 @@ class TelnetConnector:
             if command.endswith('.status'):
                 self._status_commands.append(command)
 
-        self.connected_liquidsoap_version = self.command("version")[0]
+        if version:
+            self.connected_liquidsoap_version = version
+        # request IDs start over when Liquidsoap restarts
+        self._metadata_cache.clear()
+
+    def _instance_name(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    @staticmethod
+    def _parse_help(raw:Optional[bytes]) -> List[str]:
+        commands = []
+        if raw:
+            for line in iter_lines(raw):
+                if line.startswith("|"):
+                    command = line[2:]
+                    if not command.startswith('help ') and \
+                        not command.startswith('request.') and \
+                        command not in ('exit', 'list', 'quit', 'uptime', 'version'):
+                        commands.append(command)
+        return commands
 
     def current(self) -> dict:
         """
@@ -319,17 +796,73 @@ class TelnetConnector:
         This may not work well either with harbor or input.http so we might also
         poll their `.status` command.
 
+        All commands are sent in a single batch (plus another one for ``.status``
+        commands, if needed). Uptime is estimated, unless it's time to check
+        it. This also queries the main output's remaining time, which is
+        included as ``remaining`` (possibly None).
+
+        The main output's metadata is taken from the cache if ``request.on_air``
+        did not change, otherwise it's fetched in another batch. When there's
+        no request on air (eg. with ``input.harbor``) it's fetched along with
+        the first batch, every time. See ``_handed_over`` for cases where
+        ``request.on_air`` does not change but the track does.
+
         :return dict: metadata of what's currently playing
         """
-        uptime = self.uptime()
+        if not self._available.is_set():
+            return self._unreachable()
+        with self._locked():
+            return self._drive(self._current_steps())
+
+    @staticmethod
+    def _unreachable() -> dict:
+        return {
+            'uptime': str(timedelta()),
+            'status': "can't reach Liquidsoap",
+            'remaining': None,
+        }
 
-        metadata = self._read_output_metadata()
-        request_on_air = self.command("request.on_air")
-        if request_on_air: #FIXME may not happen
-            request_on_air = request_on_air[0]
+    def _current_steps(self) -> Generator:
+        """
+        Steps (see ``_drive``) of ``current``
+        """
+        output = self._first_output_name
+        check_uptime = self._uptime_is_due()
+        # without request ID, the cache can't help
+        speculative = output and not self._latest_on_air
+        commands = ["request.on_air"]
+        if output:
+            commands.append(output + '.remaining')
+        if speculative:
+            commands.append(output + '.metadata')
+        if check_uptime:
+            commands.append("uptime")
+        responses = yield commands
+        if responses[0] is None:
+            # the session failed, reconnection is starting
+            return self._unreachable()
+        if check_uptime:
+            uptime = yield from self._check_uptime(self._first_line(responses.pop()))
+        else:
+            uptime = self._estimated_uptime()
+        request_on_air = self._first_line(responses[0])
+        self._latest_on_air = request_on_air
+
+        if output:
+            remaining = self._parse_remaining(self._first_line(responses[1]))
+            if speculative:
+                metadata = self._parse_output_metadata(responses[2])
+                self._cache_metadata(request_on_air, metadata)
+            else:
+                if self._handed_over(request_on_air, remaining):
+                    self._metadata_cache.pop(request_on_air, None)
+                metadata = yield from self._cached_metadata(request_on_air, output)
+            self._latest_remaining = remaining
+        else:
+            metadata = {}
 
         if 'source' not in metadata or not request_on_air:
-            polled = self._poll_status()
+            polled = yield from self._poll_status()
             if polled:
                 if polled['source'] != metadata.get('source'):
                     metadata = polled
@@ -340,63 +873,197 @@ class TelnetConnector:
             metadata['on_air'] = arrow.get(metadata['on_air'], tzinfo='local').isoformat()
 
         metadata['uptime'] = str(uptime)
+        if output:
+            metadata['remaining'] = remaining
         return metadata
 
-    def _poll_status(self) -> dict:
-        for command in self._status_commands:
-            response = self.command(command)
-            if response and "connected" in response[0]:
+    def _cached_metadata(self, request_on_air:Optional[str], output:str) -> Generator:
+        """
+        Steps (see ``_drive``) returning a copy of the cached metadata of
+        ``request_on_air``, fetched from ``output`` if needed
+        """
+        metadata = self._metadata_cache.get(request_on_air) if request_on_air else None
+        if metadata is None:
+            metadata = self._parse_output_metadata((yield [output + '.metadata'])[0])
+            self._cache_metadata(request_on_air, metadata)
+        else:
+            self._metadata_cache.move_to_end(request_on_air)
+        return dict(metadata)
+
+    def _handed_over(self, request_on_air:Optional[str], remaining:Optional[float]) -> bool:
+        """
+        When a switch or fallback hands over to a source without requests (like
+        ``input.harbor`` or ``input.http``), ``request.on_air`` may still list
+        the previous request. The main output's remaining time tells it: it
+        goes up when another track starts, and is unknown (or negative) for
+        live sources. Multiple RIDs are ambiguous, so they're not cached either.
+
+        :return: True if the cached metadata of ``request_on_air`` can't be trusted
+        """
+        if request_on_air and len(request_on_air.split()) > 1:
+            return True
+        previous = self._latest_remaining
+        known = remaining is not None and remaining >= 0
+        previously_known = previous is not None and previous >= 0
+        if known != previously_known:
+            return True
+        return known and remaining > previous + 1
+
+    def _cache_metadata(self, request_on_air:Optional[str], metadata:dict):
+        if request_on_air and metadata:
+            self._metadata_cache[request_on_air] = dict(metadata)
+            while len(self._metadata_cache) > self._METADATA_CACHE_SIZE:
+                self._metadata_cache.popitem(last=False)
+
+    def _poll_status(self) -> Generator:
+        if not self._status_commands:
+            return {}
+        responses = yield self._status_commands
+        for command, response in zip(self._status_commands, responses):
+            status = self._first_line(response)
+            if status and "connected" in status:
                 return {
                     'source': command[0:-len('.status')],
-                    'status': response[0],
+                    'status': status,
                 }
         return {}
 
-    @classmethod
-    def _metadata_to_dict(cls, raw) -> dict:
-        metadata = {}
-        for line in raw:
-            if line:
-                parsed = cls.METADATA_PATTERN.match(line)
-                if parsed:
-                    metadata[parsed.group(1)] = parsed.group(2)
-                else:
-                    log.warning("Can't parse metadata item: %r", line)
-        return metadata
+    _LATEST_METADATA_HEADER = b"--- 1 ---"
 
-    def _read_output_metadata(self) -> dict:
-        if self._first_output_name:
-            all_metadata = self.command(self._first_output_name + '.metadata')
-            if all_metadata:
-                try:
-                    index = all_metadata.index("--- 1 ---")
-                    return self._metadata_to_dict(all_metadata[index+1:])
-                except ValueError:
-                    pass
+    def _parse_output_metadata(self, all_metadata:Optional[bytes]) -> dict:
+        """
+        Only lines following ``--- 1 ---`` are parsed.
+        """
+        if all_metadata:
+            if all_metadata.startswith(self._LATEST_METADATA_HEADER):
+                index = 0
+            else:
+                index = all_metadata.find(b"\n" + self._LATEST_METADATA_HEADER)
+            if index >= 0:
+                start = all_metadata.find(b"\n", index + 1)
+                if start < 0:
+                    return {}
+                return self._metadata_parser.parse(all_metadata, start + 1)
         return {}
 
     def skip(self):
         if self._first_output_name:
-            self.command(self._first_output_name + '.skip')
+            self.command(self._first_output_name + '.skip', priority=True)
+
+    @staticmethod
+    def _parse_remaining(raw:Optional[str]) -> Optional[float]:
+        if raw:
+            try:
+                return float(raw)
+            except ValueError:
+                pass
+        return None
 
     def remaining(self) -> Optional[float]:
         if self._first_output_name:
-            raw = self.command(self._first_output_name + '.remaining')
-            if raw:
-                try:
-                    return float(raw[0])
-                except (ValueError, IndexError):
-                    pass
+            return self._parse_remaining(self._first_line(
+                self._batch_raw([self._first_output_name + '.remaining'])[0]))
+        return None
+
+
+class SocketConnector(TelnetConnector):
+    """
+    Connects Showergel to Liquidsoap over a Unix socket. This is faster than
+    telnet, but only works when both run on the same machine.
+
+    This requires the Liquidsoap script to enable ``server.socket``:
+
+    .. code-block:: ocaml
+        settings.server.socket.set(true)
+        settings.server.socket.path.set("/home/radio/liquidsoap.sock")
+
+    Then Showergel configuration should contain:
+
+    .. code-block:: toml
+        [liquidsoap]
+        method = "socket"
+        path = "/home/radio/liquidsoap.sock"
+
+    Other parameters are the same as ``TelnetConnector``.
+    """
+
+    def _configure_address(self, config:dict):
+        self.path = config['liquidsoap.path']
+
+    def _new_session(self) -> SocketSession:
+        return SocketSession(self.path, self.timeout,
+            stats=self.stats, recorder=self.recorder)
+
+    def _instance_name(self) -> str:
+        return self.path
+
+
+class LiquidsoapCatalogue(Base):
+    """
+    Caches the list of commands offered by a Liquidsoap instance (parsed from
+    ``help``, that can be long on big scripts). A Liquidsoap version is not
+    enough to identify a script, so cached commands are only used while the
+    same Liquidsoap process is running, ie. it started at the same time.
+    """
+    __tablename__ = 'liquidsoap_catalogue'
+
+    instance = Column(String, primary_key=True)
+    version = Column(String, primary_key=True)
+    started_at = Column(DATETIME, nullable=False)
+    commands = Column(Text, nullable=False)
+
+    _CLOCK_TOLERANCE = timedelta(seconds=10)
+
+    @classmethod
+    def load(cls, engine:Engine, instance:str, version:Optional[str],
+        started_at:datetime) -> Optional[List[str]]:
+        """
+        :return: cached commands, or None if they may not be up-to-date
+        """
+        if not version:
+            return None
+        try:
+            with Session(engine) as db:
+                cached = db.get(cls, (instance, version))
+                if cached and abs(cached.started_at - started_at) <= cls._CLOCK_TOLERANCE:
+                    return cached.commands.split("\n") if cached.commands else []
+        except SQLAlchemyError as error:
+            log.warning("Can't read Liquidsoap commands cache, maybe you should run `showergel update`: %s", error)
         return None
 
+    @classmethod
+    def save(cls, engine:Engine, instance:str, version:Optional[str],
+        started_at:datetime, commands:List[str]):
+        if not version:
+            return
+        try:
+            with Session(engine) as db:
+                db.merge(cls(
+                    instance=instance,
+                    version=version,
+                    started_at=started_at,
+                    commands="\n".join(commands),
+                ))
+                db.commit()
+        except SQLAlchemyError as error:
+            log.warning("Can't write Liquidsoap commands cache, maybe you should run `showergel update`: %s", error)
+
 
 class EmptyConnector(TelnetConnector):
+
+    available = False
+    stats = None
+    recorder = None
+
     def __init__(self):
         self.connected_liquidsoap_version = "[can't connect - missing configuration]"
         self.started_at = datetime.utcnow()
         self.commands = []
 
-    def command(self, command:str) -> str:
+    def close(self):
+        pass
+
+    def command(self, command:str, priority=False) -> str:
         return ""
 
     def uptime(self):
@@ -417,40 +1084,314 @@ class EmptyConnector(TelnetConnector):
         }
 
 
+class NowPlaying(NamedTuple):
+    """
+    Immutable snapshot of what's on air, as last polled by ``Poller``.
+    """
+    metadata: Mapping[str, str]
+    remaining: Optional[float]
+    commands: Tuple[str, ...]
+    liquidsoap_version: str
+    connected: bool
+    polled_at: datetime
+    generation: int
+
+    CHANGE_FIELDS = ('on_air', 'artist', 'title', 'source', 'status')
+
+    def differs_from(self, previous:Optional['NowPlaying']) -> bool:
+        """
+        Tells if this snapshot shows a change worth notifying to clients,
+        compared to ``previous``: another track, source or status, a
+        Liquidsoap restart (uptime going backwards) or disconnection.
+        """
+        if previous is None or self.connected != previous.connected:
+            return True
+        for field in self.CHANGE_FIELDS:
+            if self.metadata.get(field) != previous.metadata.get(field):
+                return True
+        uptime = _parse_timedelta(self.metadata.get('uptime'))
+        previous_uptime = _parse_timedelta(previous.metadata.get('uptime'))
+        return uptime is not None and previous_uptime is not None and uptime < previous_uptime
+
+
+_TIMEDELTA_STR_PATTERN = re.compile(r"^(?:(-?[0-9]+) days?, )?([0-9]+):([0-9]{2}):([0-9]{2})")
+
+def _parse_timedelta(value:Optional[str]) -> Optional[timedelta]:
+    """
+    Parses back ``str(some_timedelta)``
+    """
+    if not value:
+        return None
+    parsed = _TIMEDELTA_STR_PATTERN.match(value)
+    if not parsed:
+        return None
+    return timedelta(
+        days    = int(parsed.group(1) or 0),
+        hours   = int(parsed.group(2)),
+        minutes = int(parsed.group(3)),
+        seconds = int(parsed.group(4)),
+    )
+
+
+class Poller:
+    """
+    Polls a connector from a single background thread, every ``interval``
+    seconds, and keeps the latest result as a ``NowPlaying`` snapshot.
+    Readers never talk to Liquidsoap: however many clients are polling
+    ``/live``, Liquidsoap sees the same request rate.
+    """
+
+    def __init__(self, connector, interval:float):
+        self.connector = connector
+        self.interval = interval
+        self._snapshot = None
+        self._refresh_lock = Lock()
+        self._changed = Condition()
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="liquidsoap-poller", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception: # pylint: disable=broad-except
+                log.exception("Error while polling Liquidsoap")
+            self._stopped.wait(self.interval)
+
+    def refresh(self) -> NowPlaying:
+        """
+        Poll the connector now, and return the new snapshot.
+        """
+        with self._refresh_lock:
+            previous = self._snapshot
+            metadata = dict(self.connector.current())
+            if 'remaining' in metadata:
+                # some connectors fetch it along with metadata
+                remaining = metadata.pop('remaining')
+            else:
+                remaining = self.connector.remaining()
+            snapshot = NowPlaying(
+                metadata=MappingProxyType(metadata),
+                remaining=remaining,
+                commands=tuple(self.connector.commands),
+                liquidsoap_version=self.connector.connected_liquidsoap_version,
+                connected=self.connector.available,
+                polled_at=datetime.now(),
+                generation=previous.generation if previous else 0,
+            )
+            if snapshot.differs_from(previous):
+                snapshot = snapshot._replace(generation=snapshot.generation + 1)
+                with self._changed:
+                    self._snapshot = snapshot
+                    self._changed.notify_all()
+            else:
+                self._snapshot = snapshot
+        return snapshot
+
+    def wait_for_change(self, generation:int, timeout:float) -> Optional[NowPlaying]:
+        """
+        Blocks until the snapshot's generation differs from ``generation``,
+        or until ``timeout`` (in seconds) expires.
+
+        :return: the new snapshot, or None on timeout
+        """
+        with self._changed:
+            changed = self._changed.wait_for(
+                lambda: self._snapshot is not None and self._snapshot.generation != generation,
+                timeout,
+            )
+            if changed:
+                return self._snapshot
+        return None
+
+    def get(self) -> NowPlaying:
+        """
+        Return the latest snapshot - only the very first call might wait for
+        Liquidsoap.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.refresh()
+        return snapshot
+
+
 class Connection:
     """
     This is both a Liquidsoap connector factory and a singleton holder.
     **Call ``Connection.setup(config=...)`` when starting showergel**.
+    Also provide the DB ``engine`` if you'd like to cache Liquidsoap's
+    commands list. Calling it again closes previous connectors.
+
+    Showergel can connect to a few Liquidsoap instances, each one configured
+    in a ``[liquidsoap.<name>]`` section - its settings override those of the
+    ``[liquidsoap]`` section. If ``[liquidsoap]`` itself sets a ``method``, it
+    also defines the instance called ``default``. Methods accepting an
+    ``instance`` name use the default instance when it's None: ``default`` if
+    it exists, otherwise the first configured instance.
+    They raise ``KeyError`` when given an unknown instance name.
+
+    Each instance has its own ``Poller``, refreshing the ``NowPlaying``
+    snapshot every ``poll_interval`` seconds (defaults to 1), so instances
+    are polled in parallel.
 
-    see TelnetConnector, showergel.demo.FakeLiquidsoapConnector,
-    showergel.demo.DemoLiquidsoapConnector
+    see TelnetConnector, SocketConnector, showergel.liquidsoap_async.AsyncTelnetConnector,
+    showergel.demo.FakeLiquidsoapConnector, showergel.demo.DemoLiquidsoapConnector
     """
-    _instance = None
+    DEFAULT_INSTANCE = 'default'
+
+    _instances = {}
+    _pollers = {}
+    _default = None
+
+    @classmethod
+    def setup(cls, config:dict=None, engine:Engine=None):
+        for poller in cls._pollers.values():
+            poller.stop()
+        for connector in cls._instances.values():
+            connector.close()
+        cls._instances = {}
+        cls._pollers = {}
+        configs = cls._instances_config(config or {})
+        for name, instance_config in configs.items():
+            connector = cls._create_connector(instance_config, engine)
+            interval = float(instance_config.get('liquidsoap.poll_interval', 1))
+            poller = Poller(connector, interval)
+            cls._instances[name] = connector
+            cls._pollers[name] = poller
+            poller.start()
+        cls._default = next(iter(configs))
 
     @classmethod
-    def setup(cls, config:dict=None):
-        if config:
-            method = config.get('liquidsoap.method')
-            if method == 'none':
-                cls._instance = EmptyConnector()
-            elif method == 'demo':
-                from showergel.demo import DemoLiquidsoapConnector
-                cls._instance = DemoLiquidsoapConnector()
-            elif method == 'telnet':
-                cls._instance = TelnetConnector(config)
+    def _instances_config(cls, config:dict) -> Mapping[str, dict]:
+        """
+        Split ``config`` in one configuration per Liquidsoap instance,
+        where instance-specific keys are moved to ``[liquidsoap]``.
+        """
+        shared = {}
+        named = {}
+        for key, value in config.items():
+            parts = key.split('.')
+            if parts[0] == 'liquidsoap' and len(parts) == 3:
+                named.setdefault(parts[1], {})['liquidsoap.' + parts[2]] = value
             else:
-                log.warning("Unknown method %s. Only 'demo' or 'telnet' are supported.", method)
-                log.warning("Falling back to FakeLiquidsoapConnector: current playout info will be incorrect.")
+                shared[key] = value
+        configs = {}
+        if 'liquidsoap.method' in shared or not named:
+            configs[cls.DEFAULT_INSTANCE] = dict(shared)
+        for name, specific in named.items():
+            instance_config = dict(shared)
+            instance_config.update(specific)
+            configs[name] = instance_config
+        shared_record = shared.get('liquidsoap.record')
+        if shared_record and len(configs) > 1:
+            # each instance records to its own file
+            root, extension = os.path.splitext(shared_record)
+            for name, instance_config in configs.items():
+                if instance_config['liquidsoap.record'] == shared_record:
+                    instance_config['liquidsoap.record'] = f"{root}.{name}{extension}"
+        return configs
 
-        if cls._instance is None:
+    @staticmethod
+    def _create_connector(config:dict, engine:Engine=None):
+        connector = None
+        method = config.get('liquidsoap.method')
+        if method == 'none':
+            connector = EmptyConnector()
+        elif method == 'demo':
+            from showergel.demo import DemoLiquidsoapConnector
+            connector = DemoLiquidsoapConnector()
+        elif method == 'telnet':
+            connector = TelnetConnector(config, engine)
+        elif method == 'socket':
+            connector = SocketConnector(config, engine)
+        elif method == 'asyncio':
+            from showergel.liquidsoap_async import AsyncTelnetConnector
+            connector = AsyncTelnetConnector(config, engine)
+        elif config:
+            log.warning("Unknown method %s. Only 'demo', 'telnet', 'socket' or 'asyncio' are supported.", method)
+            log.warning("Falling back to FakeLiquidsoapConnector: current playout info will be incorrect.")
+
+        if connector is None:
             from showergel.demo import FakeLiquidsoapConnector
-            cls._instance = FakeLiquidsoapConnector()
+            connector = FakeLiquidsoapConnector()
+        return connector
+
+    @classmethod
+    def instances(cls) -> List[str]:
+        """
+        :return: names of configured Liquidsoap instances, the default one first
+        """
+        names = list(cls._instances)
+        if cls._default in names:
+            names.remove(cls._default)
+            names.insert(0, cls._default)
+        return names
 
     @classmethod
-    def get(cls) -> Type[TelnetConnector]:
-        if cls._instance is None:
+    def _lookup(cls, holders:dict, instance:Optional[str]):
+        if cls._default is None:
             raise RuntimeError("Please call Connection.setup(config=...) first")
-        return cls._instance
+        if instance is None:
+            instance = cls._default
+        try:
+            return holders[instance]
+        except KeyError:
+            raise KeyError(f"Unknown Liquidsoap instance: {instance}") from None
+
+    @classmethod
+    def get(cls, instance:str=None) -> Type[TelnetConnector]:
+        return cls._lookup(cls._instances, instance)
+
+    @classmethod
+    def now_playing(cls, refresh=False, instance:str=None) -> NowPlaying:
+        """
+        Return the latest ``NowPlaying`` snapshot. Set ``refresh`` if you can't
+        afford a snapshot that might be ``poll_interval`` seconds old.
+        """
+        poller = cls._lookup(cls._pollers, instance)
+        if refresh:
+            return poller.refresh()
+        return poller.get()
+
+    @classmethod
+    def now_playing_all(cls) -> Mapping[str, NowPlaying]:
+        """
+        Latest snapshot of each instance, by instance name
+        """
+        return {name: cls.now_playing(instance=name) for name in cls.instances()}
+
+    @classmethod
+    def wait_for_change(cls, generation:int, timeout:float,
+        instance:str=None) -> Optional[NowPlaying]:
+        """
+        see ``Poller.wait_for_change``
+        """
+        return cls._lookup(cls._pollers, instance).wait_for_change(generation, timeout)
+
+    @classmethod
+    def link_stats(cls, instance:str=None) -> dict:
+        """
+        see ``showergel.link_stats.LinkStats`` - empty if the current connector
+        does not talk to a real Liquidsoap.
+        """
+        stats = getattr(cls.get(instance), 'stats', None)
+        if stats is None:
+            return {}
+        return stats.to_dict()
+
+    @classmethod
+    def skip(cls, instance:str=None):
+        """
+        Skips current track, and refreshes the snapshot accordingly.
+        """
+        cls.get(instance).skip()
+        cls.now_playing(refresh=True, instance=instance)
 
 
 # test tool against a real Liquidsoap instance:
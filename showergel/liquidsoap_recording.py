@@ -0,0 +1,191 @@
+"""
+Liquidsoap sessions recording and replay
+========================================
+
+Set ``record = "/path/to/file.lsrec"`` in the ``[liquidsoap]`` section and
+Showergel will record each command sent to Liquidsoap, with its raw response
+and timing. ``ReplayLiquidsoap`` then serves such a recording back, so real-world
+responses (weird metadata, huge ``help`` on big scripts...) can be used in
+tests and benchmarks.
+
+Recordings are gzipped. After a header line, each exchange is stored as a
+fixed-size binary header (offset since the recording started and response
+delay, in seconds, then command and response lengths) followed by the command
+and the raw response. When Showergel restarts, it appends a new recording
+(header line included) to the same file.
+
+Run a replay server from the command line::
+
+    python -m showergel.liquidsoap_recording recording.lsrec --port 1234
+"""
+
+import atexit
+import gzip
+import logging
+import struct
+import zlib
+from collections import defaultdict
+from threading import Lock
+from time import monotonic, sleep
+from typing import Iterator, NamedTuple
+
+import click
+
+from showergel.fake_liquidsoap import FakeLiquidsoap, UNKNOWN_COMMAND
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"SHOWERGEL-LIQUIDSOAP-RECORDING 1\n"
+_HEADER = struct.Struct("<ddII")
+
+
+class Exchange(NamedTuple):
+    offset: float
+    delay: float
+    command: str
+    response: bytes
+
+
+class Recorder:
+    """
+    Appends exchanges to a recording file. Thread-safe.
+
+    Data is flushed at most every ``flush_interval`` seconds, so the file
+    can be read while recording (but the last exchanges may be missing until
+    ``close()``, which is called when Showergel exits).
+    """
+
+    def __init__(self, path:str, flush_interval:float=1.):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._file = gzip.open(path, 'ab')
+        self._file.write(MAGIC)
+        self._started_at = monotonic()
+        self._flushed_at = self._started_at
+        atexit.register(self.close)
+        log.info("Recording Liquidsoap sessions to %s", path)
+
+    def record(self, command:str, delay:float, response:bytes):
+        """
+        ``delay`` is the time Liquidsoap took to answer this command
+        """
+        encoded = command.encode('utf8')
+        with self._lock:
+            if self._file is None:
+                return
+            now = monotonic()
+            self._file.write(_HEADER.pack(now - self._started_at, delay, len(encoded), len(response)))
+            self._file.write(encoded)
+            self._file.write(response)
+            if now - self._flushed_at >= self.flush_interval:
+                self._file.flush()
+                self._flushed_at = now
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path:str) -> Iterator[Exchange]:
+    """
+    Reads exchanges from a recording file, including recordings appended
+    by later runs of Showergel. A truncated recording (as when Showergel was
+    killed) is read up to its last complete exchange - recordings appended
+    after it can't be read.
+    """
+    with gzip.open(path, 'rb') as recording:
+        if recording.readline() != MAGIC:
+            raise ValueError(f"{path} is not a Liquidsoap recording")
+        try:
+            while True:
+                header = recording.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                if header == MAGIC[:_HEADER.size]:
+                    # the next recording starts over
+                    recording.read(len(MAGIC) - _HEADER.size)
+                    continue
+                offset, delay, command_length, response_length = _HEADER.unpack(header)
+                command = recording.read(command_length)
+                response = recording.read(response_length)
+                if len(response) < response_length:
+                    break
+                yield Exchange(offset, delay, command.decode('utf8'), response)
+        except (EOFError, zlib.error):
+            log.warning("%s is truncated", path)
+
+
+class ReplayLiquidsoap(FakeLiquidsoap):
+    """
+    A fake Liquidsoap server answering with responses from a recording.
+
+    Each command gets its recorded responses in order, starting over when
+    exhausted, so a replay is deterministic. Responses are delayed as when
+    they were recorded, multiplied by ``timing`` (so 0 replays as fast as
+    possible). Commands absent from the recording get an error, as
+    unknown commands.
+
+    Other parameters are the same as ``FakeLiquidsoap``.
+    """
+
+    def __init__(self, path:str, timing:float=0., **kwargs):
+        self._recorded = defaultdict(list)
+        for exchange in read_recording(path):
+            self._recorded[exchange.command].append(exchange)
+        self._positions = defaultdict(int)
+        self._positions_lock = Lock()
+        self.timing = timing
+        super().__init__(**kwargs)
+
+    def restart(self):
+        super().restart()
+        with self._positions_lock:
+            self._positions.clear()
+
+    def _next_exchange(self, command:str):
+        recorded = self._recorded.get(command)
+        if not recorded:
+            return None
+        with self._positions_lock:
+            position = self._positions[command]
+            self._positions[command] = position + 1
+        return recorded[position % len(recorded)]
+
+    def respond_raw(self, command:str) -> bytes:
+        if command not in self.responses:
+            exchange = self._next_exchange(command)
+            if exchange is not None:
+                if self.timing:
+                    sleep(exchange.delay * self.timing)
+                return exchange.response + b"\r\nEND\r\n"
+        return super().respond_raw(command)
+
+    def respond(self, command:str) -> str:
+        return self.responses.get(command, UNKNOWN_COMMAND)
+
+
+@click.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=1234, show_default=True)
+@click.option('--timing', default=1., show_default=True,
+    help="Multiplies recorded response delays, 0 to answer immediately")
+def main(path, host, port, timing):
+    """
+    Replay a recording of Liquidsoap sessions, until interrupted
+    """
+    logging.basicConfig(level=logging.INFO)
+    server = ReplayLiquidsoap(path, timing=timing, address=(host, port))
+    log.info("Replaying %s, configure Showergel with %s", path, server.address_config())
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main() # pylint: disable=no-value-for-parameter
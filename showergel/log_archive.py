@@ -0,0 +1,247 @@
+"""
+====================
+Metadata log archive
+====================
+
+When ``retention_months`` is set in the ``[metadata_log]`` section, a daily
+job moves ``log`` entries older than that many months (counting from the
+start of the current month, in UTC) to monthly archive files, in
+``archive_dir``. So the ``log`` and ``log_extra`` tables stay small.
+
+Archive files are named ``log-YYYY-MM.ndjson.gz`` and hold one JSON object
+per line, as returned by ``GET /metadata_log``. They are only appended to:
+each archiving run adds a gzip member. ``GET /metadata_log`` reads them when
+the requested interval starts before the retention limit.
+"""
+
+import gzip
+import json
+import logging
+import os
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Optional, Set
+
+import arrow
+from arrow import Arrow
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.session import Session
+
+from showergel.metadata import Log, LogExtra
+from showergel.scheduler import Scheduler
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_DIR = "metadata_log_archives"
+
+
+class LogArchive:
+    """
+    Only one instance should exist in the Showergel process, and only if
+    retention is configured: call ``setup`` once, then ``get``.
+    """
+
+    BATCH_SIZE = 1000
+    _instance = None
+
+    @classmethod
+    def setup(cls, config:dict, engine:Engine):
+        """
+        Schedules the archiving job, if ``retention_months`` is configured.
+        """
+        cls._instance = None
+        archive = cls.configured(config)
+        if archive is None:
+            return
+        Scheduler.get().internal_job(archive.run, 'archive_log', args=[sessionmaker(bind=engine)], hours=24)
+        cls._instance = archive
+
+    @classmethod
+    def configured(cls, config:dict) -> Optional['LogArchive']:
+        """
+        Return:
+            a ``LogArchive`` following ``config``, without scheduling it,
+            or None if retention is not configured
+        """
+        months = int(config.get('metadata_log.retention_months', 0))
+        if months <= 0:
+            return None
+        return cls(config.get('metadata_log.archive_dir', DEFAULT_ARCHIVE_DIR), months)
+
+    @classmethod
+    def get(cls) -> Optional['LogArchive']:
+        """
+        Return:
+            the program's ``LogArchive``, or None if retention is not configured
+        """
+        return cls._instance
+
+    def __init__(self, directory:str, retention_months:int):
+        self.directory = directory
+        self.retention_months = retention_months
+
+    def cutoff(self) -> Arrow:
+        """
+        Return:
+            entries before this time should be archived
+        """
+        return arrow.utcnow().floor('month').shift(months=-self.retention_months)
+
+    def rebuild_from(self) -> date:
+        """
+        Return:
+            the first day whose rollups can be re-computed from the log
+        """
+        return self.cutoff().date()
+
+    def path(self, month:Arrow) -> str:
+        return os.path.join(self.directory, month.format("[log-]YYYY-MM[.ndjson.gz]"))
+
+    def run(self, session_factory:sessionmaker):
+        with session_factory() as db:
+            archived = self.archive(db, self.cutoff())
+        if archived:
+            _log.info("Archived %d metadata log entries to %s", archived, self.directory)
+
+    def archive(self, db:Session, cutoff:Arrow) -> int:
+        """
+        Moves entries before ``cutoff`` to archive files, by batches of
+        ``BATCH_SIZE``: each batch is written, then deleted from the DB.
+
+        Return:
+            how many entries were archived
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        archived = 0
+        while True:
+            entries = (db.query(Log)
+                .filter(Log.on_air < cutoff.datetime)
+                .order_by(Log.on_air.asc())
+                .limit(self.BATCH_SIZE)
+                .all())
+            if not entries:
+                return archived
+            by_month = {}
+            for entry in entries:
+                month = arrow.get(entry.on_air, tzinfo='utc').floor('month')
+                by_month.setdefault(month, []).append(entry.to_dict())
+            for month, serialized in by_month.items():
+                with gzip.open(self.path(month), 'at', encoding='utf8') as archive_file:
+                    for entry in serialized:
+                        archive_file.write(json.dumps(entry) + "\n")
+            ids = [entry.id for entry in entries]
+            db.query(LogExtra).filter(LogExtra.log_id.in_(ids)).delete(synchronize_session=False)
+            # search rows are kept, so archived entries can still be found
+            (db.query(Log).filter(Log.id.in_(ids))
+                .execution_options(archiving=True)
+                .delete(synchronize_session=False))
+            db.commit()
+            db.expunge_all()
+            archived += len(entries)
+
+    def read(self, start:Arrow, end:Arrow, reverse:bool=False) -> Iterator[Dict]:
+        """
+        Yields archived entries played between ``start`` and ``end`` (inclusive),
+        in chronological order, or the most recent first if ``reverse``.
+        Files are read one month at a time, so callers may stop early.
+        """
+        months = list(Arrow.range('month', start.floor('month'), end))
+        if reverse:
+            months.reverse()
+        for month in months:
+            yield from self._read_month(month, start, end, reverse)
+
+    def _read_month(self, month:Arrow, start:Arrow, end:Arrow, reverse:bool) -> List[Dict]:
+        path = self.path(month)
+        if not os.path.exists(path):
+            return []
+        entries = {}
+        with gzip.open(path, 'rt', encoding='utf8') as archive_file:
+            for line in archive_file:
+                entry = json.loads(line)
+                on_air = arrow.get(entry['on_air'])
+                # an interrupted run may have archived the same entry twice
+                if start <= on_air <= end and on_air not in entries:
+                    entries[on_air] = entry
+        return [entries[on_air] for on_air in sorted(entries, reverse=reverse)]
+
+    def archived(self, month:Arrow) -> Set[datetime]:
+        """
+        Return:
+            ``on_air`` times (naive, in UTC) of entries archived in ``month``
+        """
+        return {arrow.get(entry['on_air']).to('utc').naive
+            for entry in self._read_month(month, month, month.ceil('month'), False)}
+
+    def entries(self, start:str=None, end:str=None) -> Iterator[Dict]:
+        """
+        Yields archived entries played between ``start`` and ``end``
+        (inclusive, both optional), in chronological order.
+        """
+        cutoff = self.cutoff()
+        lower = arrow.get(start).to('utc') if start else self.first_month()
+        if lower is None or lower >= cutoff:
+            return
+        upper = min(arrow.get(end).to('utc'), cutoff) if end else cutoff
+        yield from self.read(lower, upper)
+
+    def first_month(self) -> Optional[Arrow]:
+        """
+        Return:
+            the oldest archived month, or None if nothing is archived
+        """
+        if not os.path.isdir(self.directory):
+            return None
+        months = []
+        for name in os.listdir(self.directory):
+            try:
+                months.append(arrow.get(name, "[log-]YYYY-MM[.ndjson.gz]", tzinfo='utc'))
+            except arrow.parser.ParserError:
+                pass
+        return min(months, default=None)
+
+    def complete(self, logged:List[Dict], limit:Optional[int], chronological:bool=None,
+        start:str=None, end:str=None, before:str=None, after:str=None) -> List[Dict]:
+        """
+        Adds archived entries to the result of ``Log.get`` (or ``Log.get_page``)
+        called with the same parameters, if the queried interval starts
+        before the cutoff. ``limit`` is the maximum number of entries
+        returned, or None if unlimited: archives are read month by month,
+        from the page's start, until that many entries are found.
+        """
+        cutoff = self.cutoff()
+        lower = arrow.get(start).to('utc') if start else None
+        if after:
+            after = arrow.get(after).to('utc')
+            lower = max(lower, after) if lower else after
+        if lower is not None and lower >= cutoff:
+            return logged
+        if limit is not None and not chronological and len(logged) >= limit:
+            # recent entries are all in the DB
+            return logged
+        if lower is None:
+            lower = self.first_month()
+            if lower is None:
+                return logged
+        upper = cutoff
+        if end:
+            upper = min(upper, arrow.get(end).to('utc'))
+        if before:
+            before = arrow.get(before).to('utc')
+            upper = min(upper, before)
+        archived = []
+        for entry in self.read(lower, upper, reverse=not chronological):
+            on_air = arrow.get(entry['on_air'])
+            if (after and on_air <= after) or (before and on_air >= before):
+                continue
+            archived.append(entry)
+            if limit is not None and len(archived) >= limit:
+                break
+        if not archived:
+            return logged
+        entries = sorted(archived + logged,
+            key=lambda entry: arrow.get(entry['on_air']),
+            reverse=not chronological)
+        if limit is not None:
+            entries = entries[:limit]
+        return entries
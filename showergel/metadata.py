@@ -7,13 +7,22 @@ This module contains functions that process and store the metadata of tracks
 played by Liquidsoap.
 """
 
+import atexit
 import logging
 import re
-from typing import Type, Dict, List, Tuple
+from datetime import date, datetime, time, timedelta, timezone
+from itertools import groupby, islice
+from queue import Queue, Empty
+from threading import Thread, Lock
+from typing import Type, Dict, List, Set, Tuple, Iterable, Iterator, Optional
 
 import arrow
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, Date, Float, UniqueConstraint, bindparam, event, func, insert, or_, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.sqlite import DATETIME
@@ -28,6 +37,9 @@ _log = logging.getLogger(__name__)
 class Log(Base):
     __tablename__ = 'log'
 
+    # columns that may be set from metadata
+    _METADATA_COLUMNS = ('artist', 'title', 'album', 'source', 'initial_uri')
+
     id = Column(Integer, primary_key=True)
     on_air = Column(DATETIME, nullable=False, unique=True, index=True)
     artist = Column(String)
@@ -39,45 +51,54 @@ class Log(Base):
     extra = relationship("LogExtra", back_populates="log", lazy='joined')
 
     @staticmethod
-    def save_metadata(config, db, data:Dict):
+    def check_metadata(data) -> None:
+        """
+        Raises ``ValueError`` if ``data`` can't be saved by ``save_metadata``
+        """
+        if not data or not isinstance(data, dict):
+            raise ValueError("No JSON data POSTed - maybe headers are missing")
+        if 'on_air' in data:
+            try:
+                arrow.get(data['on_air'], tzinfo='local')
+            except (arrow.parser.ParserError, TypeError) as error:
+                raise ValueError(f"Can't parse on_air: {error}") from error
+
+    @staticmethod
+    def save_metadata(config, db, data:Dict, received_at:datetime=None):
         """
         Save the metadata provided by Liquidsoap.
+        If ``data`` has no ``on_air`` time, we use ``received_at`` (or now).
 
         Repeated posts with the same artist and title will be ignored.
 
         Some fields are not posted as metadata by Liquidsoap (starting from v2),
         especially ``initial_uri``, ``source``, ``on_air``, and many possible
         things that the user might have set in ``extra_fields``.
-        So we also query for more metadata via ``Connection``, and keep it only
-        if artist and title match.
+        So we also read the ``NowPlaying`` snapshot held by ``Connection``, and
+        keep it only if artist and title match.
 
         Fields that do not fit into our ``log`` table are saved to ``log_extra``
         if they match one in the ``extra_fields`` configuration.
         Empty values are not saved.
         """
-        connection = Connection.get()
-        if connection:
-            current = connection.current()
-            if current and data.get('title') == current.get('title') and data.get('artist') == current.get('artist'):
-                data.update(current)
+        current = Connection.now_playing().metadata
+        if not Log._same_track(data, current):
+            # the poller may not have noticed the track change yet
+            current = Connection.now_playing(refresh=True).metadata
+        if current and Log._same_track(data, current):
+            data.update(current)
 
         if 'on_air' in data:
             on_air = arrow.get(data['on_air'], tzinfo='local').to('utc').datetime
+        elif received_at:
+            on_air = received_at
         else:
             on_air = arrow.get(tzinfo='local').to('utc').datetime
-        log_entry = Log(on_air=on_air)
-
-        if not data.get('initial_uri') and data.get('source_url'):
-            log_entry.initial_uri = data['source_url']
-            del data['source_url']
-
-        for column in ['artist', 'title', 'album', 'source', 'initial_uri']:
-            if data.get(column):
-                setattr(log_entry, column, data[column])
+        log_entry = Log(on_air=on_air, **Log._columns(data))
 
         if 'artist' in data and 'title' in data:
-            latest = Log.get(db, limit=1)
-            if latest and latest[0]['artist'] == data['artist'] and latest[0]['title'] == data['title']:
+            latest = LatestTrack.get(db)
+            if latest and latest['artist'] == data['artist'] and latest['title'] == data['title']:
                 return
 
         db.add(log_entry)
@@ -86,10 +107,145 @@ class Log(Base):
         for couple in FieldFilter.filter(data, config=config):
             db.add(LogExtra(log=log_entry, key=couple[0], value=couple[1]))
 
-    @classmethod
-    def get(cls, db:Type[Session], start:String=None, end:String=None,
-        limit:int=10, chronological:bool=None) -> List:
+    @staticmethod
+    def insert_many(config, db, entries:Iterable[Dict], chunk_size:int=500,
+        archive=None) -> Dict[str, int]:
+        """
+        Bulk-inserts metadata entries, by multi-row inserts of ``chunk_size``
+        entries, and commits after each chunk.
+
+        Unlike ``save_metadata`` we don't ask Liquidsoap, and don't compare
+        with the previous track: each entry must provide its ``on_air`` time,
+        and entries whose ``on_air`` is already logged are skipped. So a
+        failed import can be simply started over.
+        ``LogRollup`` is then re-computed for the days concerned, and
+        entries are added to ``LogSearch``.
+        If given the program's ``archive`` (see ``showergel.log_archive``),
+        entries older than its cutoff are also skipped if they're already
+        archived. Days before the cutoff may be partly archived, so they're
+        not re-computed: entries inserted there are added to their rollups instead.
+
+        :return: how many entries were ``inserted`` and ``skipped``
+        """
+        summary = {'inserted': 0, 'skipped': 0}
+        first = last = None
+        # the latest entry before rebuild_from, not counted yet
+        pending = None
+        cutoff = archive.cutoff().naive if archive else None
+        rebuild_from = archive.rebuild_from() if archive else None
+        archived = {}
+        entries = iter(entries)
+        while True:
+            chunk = list(islice(entries, chunk_size))
+            if not chunk:
+                break
+            rows = {}
+            extras = {}
+            for data in chunk:
+                on_air = arrow.get(data['on_air'], tzinfo='local').to('utc').naive
+                if on_air in rows or (cutoff and on_air < cutoff
+                        and on_air in Log._archived(archive, archived, on_air)):
+                    summary['skipped'] += 1
+                    continue
+                # a multi-row insert needs the same columns in each row
+                row = dict.fromkeys(Log._METADATA_COLUMNS)
+                row.update(Log._columns(data))
+                row['on_air'] = on_air
+                rows[on_air] = row
+                extras[on_air] = FieldFilter.filter(data, config=config)
+            inserted = Log._insert_rows(db, list(rows.values()))
+            extra_rows = [
+                {'log_id': log_id, 'key': key, 'value': value}
+                for log_id, on_air in inserted
+                for key, value in extras[on_air]
+            ]
+            if extra_rows:
+                db.execute(insert(LogExtra.__table__), extra_rows)
+            LogSearch.index(db, [LogSearch._row(on_air, rows[on_air], extras[on_air])
+                for _, on_air in inserted])
+            db.commit()
+            older = []
+            for _, on_air in inserted:
+                if rebuild_from and on_air.date() < rebuild_from:
+                    older.append(rows[on_air])
+                    continue
+                first = min(first, on_air) if first else on_air
+                last = max(last, on_air) if last else on_air
+            if older:
+                # its airtime lasts until the next entry, maybe in the next chunk
+                if pending:
+                    older.append(pending)
+                older.sort(key=lambda row: row['on_air'])
+                pending = older.pop()
+                LogRollup.count(db, older, following=pending)
+            summary['inserted'] += len(inserted)
+            summary['skipped'] += len(rows) - len(inserted)
+        # these inserts are not seen by the ORM
+        LatestTrack.forget()
+        if first:
+            LogRollup.rebuild(db, first.date(), last.date())
+        if pending:
+            LogRollup.count(db, [pending])
+        return summary
+
+    @staticmethod
+    def _archived(archive, archived:Dict, on_air:datetime) -> Set[datetime]:
+        """
+        ``on_air`` times archived in the month of ``on_air``,
+        read once per month into the ``archived`` cache.
+        """
+        month = arrow.get(on_air).floor('month')
+        if month not in archived:
+            archived[month] = archive.archived(month)
+        return archived[month]
+
+    @staticmethod
+    def _insert_rows(db, rows:List[Dict]) -> List[Tuple[int, datetime]]:
+        """
+        Inserts ``rows`` whose ``on_air`` is not logged yet.
+        We don't use ``RETURNING``, which needs SQLite 3.35, and statements
+        stay under the 999 variables allowed before SQLite 3.32.
 
+        :return: ``id`` and ``on_air`` of inserted rows
+        """
+        table = Log.__table__
+        inserted = []
+        per_statement = 999 // (len(Log._METADATA_COLUMNS) + 1)
+        for start in range(0, len(rows), per_statement):
+            on_airs = [row['on_air'] for row in rows[start:start + per_statement]]
+            logged = set(db.execute(select(table.c.on_air)
+                .where(table.c.on_air.in_(on_airs))).scalars())
+            new_rows = [row for row in rows[start:start + per_statement]
+                if row['on_air'] not in logged]
+            if not new_rows:
+                continue
+            db.execute(sqlite_insert(table).values(new_rows)
+                .on_conflict_do_nothing(index_elements=['on_air']))
+            inserted.extend(db.execute(select(table.c.id, table.c.on_air)
+                .where(table.c.on_air.in_([row['on_air'] for row in new_rows]))).all())
+        return inserted
+
+    @staticmethod
+    def _columns(data:Dict) -> Dict:
+        """
+        Values of ``log`` columns (except ``on_air``) found in ``data``.
+        ``source_url`` is moved to ``initial_uri`` if the latter is missing.
+        """
+        columns = {}
+        if not data.get('initial_uri') and data.get('source_url'):
+            columns['initial_uri'] = data.pop('source_url')
+        for column in Log._METADATA_COLUMNS:
+            if data.get(column):
+                columns[column] = data[column]
+        return columns
+
+    @staticmethod
+    def _same_track(data:Dict, current) -> bool:
+        return data.get('title') == current.get('title') and data.get('artist') == current.get('artist')
+
+    @classmethod
+    def _query(cls, db:Type[Session], start:String=None, end:String=None,
+        chronological:bool=None, before:String=None, after:String=None):
         query = db.query(cls)
 
         if start:
@@ -98,11 +254,21 @@ class Log(Base):
         if end:
             end_dt = arrow.get(end).to('utc').datetime
             query = query.filter(cls.on_air <= end_dt)
+        if after:
+            query = query.filter(cls.on_air > arrow.get(after).to('utc').datetime)
+        if before:
+            query = query.filter(cls.on_air < arrow.get(before).to('utc').datetime)
 
         if chronological:
-            query = query.order_by(cls.on_air.asc())
+            return query.order_by(cls.on_air.asc())
         else:
-            query = query.order_by(cls.on_air.desc())
+            return query.order_by(cls.on_air.desc())
+
+    @classmethod
+    def get(cls, db:Type[Session], start:String=None, end:String=None,
+        limit:int=10, chronological:bool=None) -> List:
+
+        query = cls._query(db, start, end, chronological)
 
         if not(start and end):
             if not limit:
@@ -111,6 +277,95 @@ class Log(Base):
 
         return [l.to_dict() for l in query]
 
+    @classmethod
+    def get_page(cls, db:Type[Session], page_size:int, start:String=None, end:String=None,
+        chronological:bool=None, before:String=None, after:String=None) -> List:
+        """
+        Keyset pagination on ``on_air``: returns up to ``page_size + 1``
+        entries after ``after`` and before ``before`` (both exclusive), within
+        ``start`` and ``end`` (inclusive).
+        Call ``paginate`` on the result to get the page and the next cursor.
+        """
+        query = cls._query(db, start, end, chronological, before, after)
+        return [l.to_dict() for l in query.limit(page_size + 1)]
+
+    @staticmethod
+    def paginate(entries:List[Dict], page_size:int) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Return:
+            the first ``page_size`` entries, and the cursor of the next page:
+            the ``on_air`` of the last one if there are more entries, None otherwise
+        """
+        if len(entries) > page_size:
+            entries = entries[:page_size]
+            return entries, entries[-1]['on_air']
+        return entries, None
+
+    @staticmethod
+    def iter_entries(session_factory:sessionmaker, start:String=None, end:String=None,
+        chunk_size:int=1000) -> Iterator[Dict]:
+        """
+        Yields entries played between ``start`` and ``end`` (inclusive),
+        chronologically, as ``to_dict`` does. Entries are read by chunks of
+        ``chunk_size``, each in its own session: memory use does not depend
+        on how many entries match, and no transaction stays open while the
+        caller consumes entries - so it does not prevent writing to the log.
+        """
+        log = Log.__table__
+        extra = LogExtra.__table__
+        page = select(log.c.id).order_by(log.c.on_air.asc()).limit(chunk_size)
+        if start:
+            page = page.where(log.c.on_air >= arrow.get(start).to('utc').datetime)
+        if end:
+            page = page.where(log.c.on_air <= arrow.get(end).to('utc').datetime)
+        after = None
+        while True:
+            chunk = page if after is None else page.where(log.c.on_air > after)
+            chunk = chunk.subquery()
+            query = (select(log.c.id, log.c.on_air, log.c.artist, log.c.title, log.c.album,
+                    log.c.source, log.c.initial_uri, extra.c.key, extra.c.value)
+                .select_from(log.join(chunk, chunk.c.id == log.c.id)
+                    .outerjoin(extra, extra.c.log_id == log.c.id))
+                .order_by(log.c.on_air.asc(), log.c.id.asc()))
+            with session_factory() as db:
+                rows = db.execute(query).all()
+            count = 0
+            for _, group in groupby(rows, key=lambda row: row.id):
+                first = next(group)
+                entry = {
+                    'on_air': arrow.get(first.on_air, tzinfo='utc').isoformat(),
+                    'artist': first.artist,
+                    'title': first.title,
+                    'album': first.album,
+                    'source': first.source,
+                    'initial_uri': first.initial_uri,
+                }
+                for row in (first, *group):
+                    if row.key is not None:
+                        entry[row.key] = row.value
+                count += 1
+                yield entry
+            if count < chunk_size:
+                return
+            after = rows[-1].on_air
+
+    @staticmethod
+    def extra_keys(db:Session, start:String=None, end:String=None) -> List[str]:
+        """
+        Return:
+            keys of ``log_extra`` rows attached to entries played between
+            ``start`` and ``end`` (inclusive), sorted
+        """
+        log = Log.__table__
+        extra = LogExtra.__table__
+        query = (select(extra.c.key).distinct()
+            .select_from(extra.join(log, extra.c.log_id == log.c.id)))
+        if start:
+            query = query.where(log.c.on_air >= arrow.get(start).to('utc').datetime)
+        if end:
+            query = query.where(log.c.on_air <= arrow.get(end).to('utc').datetime)
+        return sorted(db.execute(query).scalars())
+
     def to_dict(self):
         d = {
             'on_air': arrow.get(self.on_air, tzinfo='utc').isoformat(),
@@ -127,6 +382,557 @@ class Log(Base):
         return d
 
 
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _as_utc(value:datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+class LatestTrack:
+    """
+    Keeps artist, title and source of the most recent ``log`` entry in memory,
+    so ``Log.save_metadata`` can ignore repeated posts without querying the DB,
+    and ``LogRollup`` can count the airtime of the previous track.
+
+    It's loaded from the DB on first use, then updated after each ``Log``
+    insertion (by whatever session), and forgotten when a session rolls back or
+    bulk-deletes ``log`` rows, so it will be re-loaded. Thread-safe.
+    """
+
+    _lock = Lock()
+    _latest = None
+    _loaded = False
+
+    @classmethod
+    def get(cls, db) -> Dict:
+        """
+        ``db`` may be a ``Session`` or a ``Connection``.
+
+        :return: a dict with ``on_air``, ``artist``, ``title`` and ``source``
+            of the most recent entry, or None if the log is empty
+        """
+        with cls._lock:
+            if not cls._loaded:
+                row = db.execute(select(Log.on_air, Log.artist, Log.title, Log.source)
+                    .order_by(Log.on_air.desc())
+                    .limit(1)).first()
+                if row is not None:
+                    cls._latest = {
+                        'on_air': _as_utc(row.on_air),
+                        'artist': row.artist,
+                        'title': row.title,
+                        'source': row.source,
+                    }
+                cls._loaded = True
+            return cls._latest
+
+    @classmethod
+    def inserted(cls, entry:'Log') -> Optional[Dict]:
+        """
+        :return: the previous latest entry, if ``entry`` is the new one
+        """
+        with cls._lock:
+            if not cls._loaded:
+                return None
+            on_air = _as_utc(entry.on_air)
+            previous = cls._latest
+            if previous is None or on_air >= previous['on_air']:
+                cls._latest = {
+                    'on_air': on_air,
+                    'artist': entry.artist,
+                    'title': entry.title,
+                    'source': entry.source,
+                }
+                return previous
+            return None
+
+    @classmethod
+    def forget(cls):
+        with cls._lock:
+            cls._latest = None
+            cls._loaded = False
+
+
+class LogRollup(Base):
+    """
+    Plays and airtime per day (in UTC), artist, title and source, so
+    statistics don't have to go through the whole log.
+    Missing artist, title or source are stored as empty strings.
+
+    Rows are updated on each ``Log`` insertion, in the same transaction:
+    the new track is counted as played, and its predecessor gets the time
+    between them as airtime (up to ``MAX_AIRTIME`` seconds, in case
+    Liquidsoap was stopped). Entries without artist nor title, like
+    scheduled commands, are not counted - but they end the previous track.
+    """
+    __tablename__ = 'log_rollup'
+    __table_args__ = (UniqueConstraint('day', 'artist', 'title', 'source'),)
+
+    MAX_AIRTIME = 3600.
+    GROUPS = {
+        'artist': ('artist',),
+        'title': ('artist', 'title'),
+        'source': ('source',),
+        'day': ('day',),
+    }
+    ORDERS = ('plays', 'airtime')
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False, index=True)
+    artist = Column(String, nullable=False, default='')
+    title = Column(String, nullable=False, default='')
+    source = Column(String, nullable=False, default='')
+    plays = Column(Integer, nullable=False, default=0)
+    airtime = Column(Float, nullable=False, default=0.)
+
+    @staticmethod
+    def _is_track(entry) -> bool:
+        return bool(entry['artist'] or entry['title'])
+
+    @classmethod
+    def add(cls, connection, on_air:datetime, artist:str, title:str, source:str,
+        plays:int=0, airtime:float=0.):
+        table = cls.__table__
+        statement = sqlite_insert(table).values(
+            day=_as_utc(on_air).date(),
+            artist=artist or '',
+            title=title or '',
+            source=source or '',
+            plays=plays,
+            airtime=airtime,
+        )
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['day', 'artist', 'title', 'source'],
+            set_={
+                'plays': table.c.plays + statement.excluded.plays,
+                'airtime': table.c.airtime + statement.excluded.airtime,
+            },
+        ))
+
+    @classmethod
+    def inserted(cls, connection, entry:Log, previous:Optional[Dict]):
+        """
+        Counts ``entry``, and the airtime of the ``previous`` one
+        """
+        on_air = _as_utc(entry.on_air)
+        if previous and cls._is_track(previous) and on_air > previous['on_air']:
+            airtime = min((on_air - previous['on_air']).total_seconds(), cls.MAX_AIRTIME)
+            cls.add(connection, previous['on_air'], previous['artist'], previous['title'],
+                previous['source'], airtime=airtime)
+        if entry.artist or entry.title:
+            cls.add(connection, on_air, entry.artist, entry.title, entry.source, plays=1)
+
+    @classmethod
+    def count(cls, db:Session, entries:List[Dict], following:Dict=None):
+        """
+        Adds ``entries`` (``log`` rows, as dictionaries) to rollups, without
+        looking at the rest of the log: each one's airtime lasts until the
+        next one in ``entries``, the last one's until ``following`` if given.
+        """
+        entries = sorted(entries, key=lambda entry: entry['on_air'])
+        for entry, after in zip(entries, entries[1:] + [following]):
+            if not cls._is_track(entry):
+                continue
+            airtime = 0.
+            if after:
+                airtime = min((after['on_air'] - entry['on_air']).total_seconds(), cls.MAX_AIRTIME)
+            cls.add(db, entry['on_air'], entry['artist'], entry['title'], entry['source'],
+                plays=1, airtime=airtime)
+        db.commit()
+
+    @classmethod
+    def rebuild(cls, db:Session, first_day:date=None, last_day:date=None):
+        """
+        Re-computes rollups of days from ``first_day`` to ``last_day``
+        (inclusive, all days if omitted) from the log. Archived entries are
+        not in the log anymore, so this would forget them: don't rebuild
+        days before ``LogArchive.cutoff()``.
+        """
+        log = Log.__table__
+        table = cls.__table__
+        delete = table.delete()
+        played = select(
+            log.c.on_air, log.c.artist, log.c.title, log.c.source,
+            func.lead(log.c.on_air).over(order_by=log.c.on_air).label('next_on_air'),
+        )
+        if first_day:
+            delete = delete.where(table.c.day >= first_day)
+            played = played.where(log.c.on_air >= datetime.combine(first_day, time()))
+        if last_day:
+            delete = delete.where(table.c.day <= last_day)
+            # the next track may start on the next day
+            played = played.where(log.c.on_air < datetime.combine(last_day + timedelta(days=2), time()))
+        played = played.subquery()
+        day = func.date(played.c.on_air)
+        artist = func.coalesce(played.c.artist, '')
+        title = func.coalesce(played.c.title, '')
+        source = func.coalesce(played.c.source, '')
+        # julianday() is in days, not exact: round to milliseconds
+        airtime = func.coalesce(func.round(
+            (func.julianday(played.c.next_on_air) - func.julianday(played.c.on_air)) * 86400, 3), 0)
+        rollups = (select(day, artist, title, source,
+                func.count(),
+                func.sum(func.min(airtime, cls.MAX_AIRTIME)),
+            )
+            .where(or_(artist != '', title != ''))
+            .group_by(day, artist, title, source))
+        if last_day:
+            rollups = rollups.where(day <= last_day.isoformat())
+        db.execute(delete)
+        db.execute(table.insert().from_select(
+            ['day', 'artist', 'title', 'source', 'plays', 'airtime'], rollups))
+        db.commit()
+
+    @classmethod
+    def stats(cls, db:Session, by:str, start:String=None, end:String=None,
+        order:str='plays', limit:int=10) -> List[Dict]:
+        """
+        Sums plays and airtime (in seconds) between days ``start`` and
+        ``end`` (inclusive), grouped ``by`` one of ``GROUPS``, sorted by
+        ``order`` (one of ``ORDERS``, but results grouped by day are sorted
+        chronologically). Raises ``ValueError`` on invalid parameters.
+        """
+        if by not in cls.GROUPS:
+            raise ValueError(f"by should be one of {', '.join(cls.GROUPS)}")
+        if order not in cls.ORDERS:
+            raise ValueError(f"order should be one of {', '.join(cls.ORDERS)}")
+        columns = [getattr(cls, name) for name in cls.GROUPS[by]]
+        plays = func.sum(cls.plays).label('plays')
+        airtime = func.sum(cls.airtime).label('airtime')
+        query = select(*columns, plays, airtime).group_by(*columns)
+        if start:
+            query = query.where(cls.day >= arrow.get(start).date())
+        if end:
+            query = query.where(cls.day <= arrow.get(end).date())
+        if by == 'day':
+            query = query.order_by(cls.day.asc())
+        else:
+            if order == 'plays':
+                query = query.order_by(plays.desc(), airtime.desc(), *columns)
+            else:
+                query = query.order_by(airtime.desc(), plays.desc(), *columns)
+            query = query.limit(int(limit) if limit else 10)
+        results = []
+        for row in db.execute(query):
+            result = row._asdict()
+            if by == 'day':
+                result['day'] = result['day'].isoformat()
+            results.append(result)
+        return results
+
+
+class LogSearch:
+    """
+    Full-text index of the log, in the ``log_search`` FTS5 table: artist,
+    title, album, initial URI and the values of ``log_extra`` fields listed
+    in ``search_fields``. Rows keep a copy of the entry's main fields, so
+    they stay searchable once the entry is archived. Their rowid is derived
+    from ``on_air`` (see ``key``), as ``log`` ids of archived entries may
+    be reused. Search rows are deleted with their entry, unless it's
+    deleted with the ``archiving`` execution option.
+
+    Entries are indexed on insertion, in the same transaction. If the table
+    is missing (SQLite compiled without FTS5, or ``showergel update`` was not
+    run) indexing is skipped and ``available`` is False.
+    """
+
+    CREATE = ("CREATE VIRTUAL TABLE IF NOT EXISTS log_search USING fts5("
+        "on_air UNINDEXED, artist, title, album, source UNINDEXED, initial_uri, extra)")
+    INSERT = text("INSERT INTO log_search"
+        "(rowid, on_air, artist, title, album, source, initial_uri, extra) VALUES "
+        "(:key, :on_air, :artist, :title, :album, :source, :initial_uri, :extra)")
+    RESULT_COLUMNS = ('on_air', 'artist', 'title', 'album', 'source', 'initial_uri')
+    # bm25 weights of each column: URIs and extra fields matter less
+    RANK = "bm25(log_search, 0, 4, 4, 2, 0, 1, 1)"
+    ORDERS = ('rank', 'recent')
+
+    _fields:frozenset = frozenset()
+    _available:Optional[bool] = None
+
+    @classmethod
+    def setup(cls, config):
+        cls._fields = frozenset(config.get('metadata_log.search_fields', []))
+        cls._available = None
+
+    @classmethod
+    def create(cls, connection):
+        try:
+            connection.exec_driver_sql(cls.CREATE)
+        except OperationalError as error:
+            _log.warning("Full-text search of the metadata log is not available: %s", error)
+        cls._available = None
+
+    @classmethod
+    def available(cls, connection) -> bool:
+        if cls._available is None:
+            cls._available = connection.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'log_search'"
+            )).first() is not None
+            if not cls._available:
+                _log.warning("log_search table is missing, maybe you should run `showergel update`")
+        return cls._available
+
+    @staticmethod
+    def key(on_air:datetime) -> int:
+        """
+        Return:
+            the rowid of the entry played at ``on_air``: microseconds since
+            the epoch, as ``on_air`` is unique
+        """
+        return (_as_utc(on_air) - _EPOCH) // timedelta(microseconds=1)
+
+    @classmethod
+    def _row(cls, on_air:datetime, columns:Dict, extras:Iterable[Tuple[str, str]]) -> Dict:
+        row = {column: columns.get(column) for column in cls.RESULT_COLUMNS}
+        row['key'] = cls.key(on_air)
+        row['on_air'] = arrow.get(on_air, tzinfo='utc').isoformat()
+        row['extra'] = " ".join(value for key, value in extras if key in cls._fields)
+        return row
+
+    @classmethod
+    def index(cls, connection, rows:List[Dict]):
+        if rows and cls.available(connection):
+            connection.execute(cls.INSERT, rows)
+
+    @classmethod
+    def inserted(cls, connection, entry:Log):
+        columns = {column: getattr(entry, column) for column in cls.RESULT_COLUMNS}
+        cls.index(connection, [cls._row(entry.on_air, columns, ())])
+
+    @classmethod
+    def extra_inserted(cls, connection, extra:'LogExtra'):
+        if extra.key in cls._fields and cls.available(connection):
+            log = Log.__table__
+            on_air = connection.execute(select(log.c.on_air).where(log.c.id == extra.log_id)).scalar()
+            connection.execute(text(
+                "UPDATE log_search SET extra = trim(extra || ' ' || :value) WHERE rowid = :key"
+            ), {'value': extra.value, 'key': cls.key(on_air)})
+
+    @classmethod
+    def deleting(cls, connection, whereclause):
+        """
+        Deletes search rows of ``log`` entries matching ``whereclause``
+        """
+        if not cls.available(connection):
+            return
+        log = Log.__table__
+        query = select(log.c.on_air)
+        if whereclause is not None:
+            query = query.where(whereclause)
+        cls.deleted(connection, connection.execute(query).scalars())
+
+    @classmethod
+    def deleted(cls, connection, on_airs:Iterable[datetime]):
+        """
+        Deletes search rows of ``log`` entries played at ``on_airs``
+        """
+        if not cls.available(connection):
+            return
+        keys = [cls.key(on_air) for on_air in on_airs]
+        # stay under the 999 variables allowed before SQLite 3.32
+        for start in range(0, len(keys), 999):
+            connection.execute(text("DELETE FROM log_search WHERE rowid IN :keys")
+                .bindparams(bindparam('keys', expanding=True)), {'keys': keys[start:start + 999]})
+
+    @classmethod
+    def fill(cls, db:Session, chunk_size:int=1000) -> int:
+        """
+        Indexes the whole log, if the index is empty (when upgrading).
+
+        Return:
+            how many entries were indexed
+        """
+        if not cls.available(db) or db.execute(text("SELECT 1 FROM log_search LIMIT 1")).first():
+            return 0
+        log = Log.__table__
+        extra = LogExtra.__table__
+        query = (select(log.c.id, log.c.on_air, log.c.artist, log.c.title, log.c.album,
+                log.c.source, log.c.initial_uri, extra.c.key, extra.c.value)
+            .select_from(log.outerjoin(extra, extra.c.log_id == log.c.id))
+            .order_by(log.c.id))
+        indexed = 0
+        rows = []
+        logged = db.execute(query.execution_options(yield_per=chunk_size))
+        for _, group in groupby(logged, key=lambda row: row.id):
+            group = list(group)
+            first = group[0]
+            extras = [(row.key, row.value) for row in group if row.key is not None]
+            rows.append(cls._row(first.on_air, first._asdict(), extras))
+            if len(rows) >= chunk_size:
+                db.execute(cls.INSERT, rows)
+                indexed += len(rows)
+                rows = []
+        if rows:
+            db.execute(cls.INSERT, rows)
+            indexed += len(rows)
+        db.commit()
+        return indexed
+
+    @staticmethod
+    def match_expression(query:str) -> str:
+        """
+        Turns the user's ``query`` into an FTS5 expression matching entries
+        that contain all its words, the last one being a prefix.
+        Quoting words avoids syntax errors on characters like ``-`` or ``/``.
+        """
+        words = query.split()
+        if not words:
+            raise ValueError("q should contain at least one word")
+        quoted = ['"' + word.replace('"', '""') + '"' for word in words]
+        return " ".join(quoted) + "*"
+
+    @classmethod
+    def search(cls, db:Session, query:str, limit:int=10, offset:int=0,
+        order:str='rank') -> List[Dict]:
+        """
+        Entries matching ``query``, the most relevant first (or the most
+        ``recent``, depending on ``order``). Returns up to ``limit`` entries,
+        skipping the first ``offset`` ones.
+        Raises ``ValueError`` on invalid parameters.
+        """
+        if order not in cls.ORDERS:
+            raise ValueError(f"order should be one of {', '.join(cls.ORDERS)}")
+        sort = f"{cls.RANK}, on_air DESC" if order == 'rank' else "on_air DESC"
+        rows = db.execute(text(
+            f"SELECT {', '.join(cls.RESULT_COLUMNS)} FROM log_search "
+            f"WHERE log_search MATCH :match ORDER BY {sort} LIMIT :limit OFFSET :offset"
+        ), {'match': cls.match_expression(query), 'limit': limit, 'offset': offset})
+        return [row._asdict() for row in rows]
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def _tables_created(target, connection, **kw): # pylint: disable=unused-argument
+    LogSearch.create(connection)
+
+@event.listens_for(Log, 'before_insert')
+def _log_inserting(mapper, connection, target): # pylint: disable=unused-argument
+    # load it now, as the new entry will be visible afterwards
+    LatestTrack.get(connection)
+
+@event.listens_for(Log, 'after_insert')
+def _log_inserted(mapper, connection, target): # pylint: disable=unused-argument
+    previous = LatestTrack.inserted(target)
+    LogRollup.inserted(connection, target, previous)
+    LogSearch.inserted(connection, target)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _session_rolled_back(session, previous_transaction): # pylint: disable=unused-argument
+    LatestTrack.forget()
+
+@event.listens_for(Session, 'do_orm_execute')
+def _orm_executing(orm_execute_state):
+    if orm_execute_state.is_delete and orm_execute_state.bind_mapper is Log.__mapper__ \
+            and not orm_execute_state.execution_options.get('archiving'):
+        LogSearch.deleting(orm_execute_state.session, orm_execute_state.statement.whereclause)
+
+@event.listens_for(Log, 'after_delete')
+def _log_deleted(mapper, connection, target): # pylint: disable=unused-argument
+    LogSearch.deleted(connection, [target.on_air])
+
+@event.listens_for(Session, 'after_bulk_delete')
+def _log_bulk_deleted(delete_context):
+    if delete_context.mapper.class_ is Log:
+        LatestTrack.forget()
+
+
+class MetadataWriter:
+    """
+    Saves metadata posted by Liquidsoap from a background thread, so
+    ``POST /metadata_log`` can return immediately. Waiting entries are saved
+    by batches of up to ``BATCH_SIZE``, one transaction per batch.
+
+    Only one instance should exist in the Showergel process:
+    call ``setup`` once, then access the instance with ``get``.
+    """
+
+    BATCH_SIZE = 100
+    _instance = None
+
+    @classmethod
+    def setup(cls, engine:Engine, config:dict):
+        if cls._instance is not None:
+            cls._instance.stop()
+        cls._instance = cls(engine, config)
+
+    @classmethod
+    def get(cls) -> 'MetadataWriter':
+        if cls._instance is None:
+            raise RuntimeError("Please call MetadataWriter.setup() first")
+        return cls._instance
+
+    def __init__(self, engine:Engine, config:dict):
+        self._sessionmaker = sessionmaker(bind=engine)
+        self._config = config
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name="metadata-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, data:Dict):
+        """
+        Queue ``data`` for ``Log.save_metadata`` - call ``Log.check_metadata`` before.
+        """
+        self._queue.put((data, arrow.utcnow().datetime))
+
+    def join(self):
+        """
+        Blocks until all submitted metadata is saved
+        """
+        self._queue.join()
+
+    def stop(self, timeout:float=10.):
+        """
+        Saves waiting entries, then stops the writer thread
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self._queue.get()
+            taken = 1
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                    taken += 1
+                except Empty:
+                    break
+            stopping = item is None
+            try:
+                if batch:
+                    self._save(batch)
+            finally:
+                for _ in range(taken):
+                    self._queue.task_done()
+
+    def _save(self, batch:List[Tuple[Dict, datetime]]):
+        """
+        Saves ``batch`` in a single transaction. If it fails, entries are
+        saved one by one so only the faulty one is lost.
+        """
+        with self._sessionmaker() as db:
+            try:
+                for data, received_at in batch:
+                    Log.save_metadata(self._config, db, data, received_at)
+                db.commit()
+                return
+            except Exception: # pylint: disable=broad-except
+                db.rollback()
+                if len(batch) == 1:
+                    _log.exception("Can't save metadata %r", batch[0][0])
+                    return
+        for item in batch:
+            self._save([item])
+
+
 class LogExtra(Base):
     __tablename__ = 'log_extra'
 
@@ -139,6 +945,9 @@ class LogExtra(Base):
 
     log = relationship("Log", back_populates="extra")
 
+@event.listens_for(LogExtra, 'after_insert')
+def _extra_inserted(mapper, connection, target): # pylint: disable=unused-argument
+    LogSearch.extra_inserted(connection, target)
 
 
 class FieldFilter(object):
@@ -146,8 +955,16 @@ class FieldFilter(object):
     # will always be called with the same config object, so we don't need much
     # thread-safety
 
+    LOG_COLUMNS = frozenset(('on_air', 'artist', 'title', 'album', 'source', 'initial_uri'))
+    _DECISIONS_CACHE_SIZE = 1024
+    # decisions about a key
+    _REJECTED = 0
+    _LOG_COLUMN = 1
+    _EXTRA = 2
+
     _fields:set = None
-    _wildcards:list = None
+    _wildcards:re.Pattern = None
+    _decisions:dict = {}
 
     @classmethod
     def setup(cls, config):
@@ -159,14 +976,35 @@ class FieldFilter(object):
         wildcards = list()
         for entry in extra_fields:
             if '*' in entry:
-                wildcards.append(re.compile(entry.strip().replace('*', '.*')))
+                wildcards.append(entry.strip().replace('*', '.*'))
             else:
                 fields.add(entry.strip())
         cls._fields = fields
-        cls._wildcards = wildcards
+        if wildcards:
+            cls._wildcards = re.compile("|".join(f"(?:{rule})" for rule in wildcards))
+        else:
+            cls._wildcards = None
+        cls._decisions = {}
         _log.debug("Will keep metadata fields %r", fields)
         _log.debug("Will keep medadata fields matching %r", wildcards)
 
+    @classmethod
+    def _decide(cls, key:str) -> int:
+        try:
+            return cls._decisions[key]
+        except KeyError:
+            pass
+        if key in cls._fields or (cls._wildcards is not None and cls._wildcards.match(key)):
+            decision = cls._EXTRA
+        elif key in cls.LOG_COLUMNS:
+            decision = cls._LOG_COLUMN
+        else:
+            decision = cls._REJECTED
+        if len(cls._decisions) >= cls._DECISIONS_CACHE_SIZE:
+            cls._decisions = {}
+        cls._decisions[key] = decision
+        return decision
+
     @classmethod
     def filter(cls, data:Dict, config:dict=None, only_extra=True) -> List[Tuple[str, str]]:
         """
@@ -186,15 +1024,6 @@ class FieldFilter(object):
                 raise ValueError("FieldFilter is not configured yet ! Caller should provide config, or call .setup(config) before.")
             else:
                 cls.setup(config)
-        result = list()
-        for k, v in data.items():
-            if k and v and (
-                ((not only_extra) and k in [
-                'on_air', 'artist', 'title', 'album', 'source', 'initial_uri'])
-                or
-                (k in cls._fields)
-                or
-                (any(rule.match(k) for rule in cls._wildcards))
-            ):
-                result.append((k, v))
-        return result
+        keep_from = cls._EXTRA if only_extra else cls._LOG_COLUMN
+        decide = cls._decide
+        return [(k, v) for k, v in data.items() if k and v and decide(k) >= keep_from]
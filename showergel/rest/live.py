@@ -2,7 +2,12 @@
 RESTful interface to current playout
 ====================================
 """
+import json
+from time import monotonic
+from typing import Optional
+
 import arrow
+from bottle import request, response, HTTPError
 
 from showergel.showergel_bottle import ShowergelBottle
 from showergel.liquidsoap_connector import Connection
@@ -11,25 +16,114 @@ from showergel.cartfolders import CartFolders
 
 live_app = ShowergelBottle()
 
+def _instance() -> Optional[str]:
+    """
+    :return: the Liquidsoap instance name given in the query string, if any
+    """
+    instance = request.query.get('instance') or None
+    if instance is not None and instance not in Connection.instances():
+        raise HTTPError(status=404, body=f"Unknown Liquidsoap instance: {instance}")
+    return instance
+
+def _live_dict(now_playing) -> dict:
+    metadata = dict(now_playing.metadata)
+    metadata["server_time"] = arrow.now().isoformat()
+    metadata["liquidsoap_connected"] = now_playing.connected
+    if now_playing.remaining is not None:
+        metadata["remaining"] = now_playing.remaining
+    return metadata
+
 @live_app.get("/live")
 def get_live():
     """
     The returned JSON object might contain many more fields, depending on what's
     in the current track's metadata. You can reasonably expect ``title`` and ``artist``.
 
+    :query instance: *optional* Liquidsoap instance name (see ``GET /parameters``)
     :>json source: name of the currently playing source
     :>json on_air: current track start time
     :>json status: status of the current source ("playing" or "connected to ...")
     :>json server_time: server's datetime
+    :>json liquidsoap_connected: false while Showergel can't reach Liquidsoap
     :>json remaining: *maybe* remaining duration of current source, in seconds
     """
-    connection = Connection.get()
-    metadata = connection.current()
-    metadata["server_time"] = arrow.now().isoformat()
-    remaining = connection.remaining()
-    if remaining is not None:
-        metadata["remaining"] = remaining
-    return metadata
+    return _live_dict(Connection.now_playing(instance=_instance()))
+
+@live_app.get("/live/all")
+def get_live_all():
+    """
+    Same as ``GET /live`` for all Liquidsoap instances: the returned object
+    contains one such object per instance name.
+    """
+    return {name: _live_dict(now_playing)
+        for name, now_playing in Connection.now_playing_all().items()}
+
+def live_events(heartbeat:float, duration:float, instance:str=None):
+    """
+    Generates Server-Sent Events: a ``message`` carrying the same object as
+    ``GET /live`` each time the snapshot changes, and ``heartbeat`` events
+    (carrying only ``server_time``) when nothing happened for ``heartbeat``
+    seconds. Stops after ``duration`` seconds - browsers will reconnect.
+    """
+    now_playing = Connection.now_playing(instance=instance)
+    yield f"retry: 1000\ndata: {json.dumps(_live_dict(now_playing))}\n\n"
+    stop_at = monotonic() + duration
+    while monotonic() < stop_at:
+        changed = Connection.wait_for_change(now_playing.generation, heartbeat, instance)
+        if changed:
+            now_playing = changed
+            yield f"data: {json.dumps(_live_dict(now_playing))}\n\n"
+        else:
+            server_time = json.dumps({"server_time": arrow.now().isoformat()})
+            yield f"event: heartbeat\ndata: {server_time}\n\n"
+
+@live_app.get("/live/stream")
+def get_live_stream():
+    """
+    Streams ``GET /live`` updates as
+    `Server-Sent Events <https://html.spec.whatwg.org/multipage/server-sent-events.html>`_:
+    an event is sent only when the track, source or status changes, or when
+    Liquidsoap restarted. Clients are expected to count ``remaining`` down locally.
+
+    ``heartbeat`` events, carrying only ``server_time``, are sent after
+    ``stream_heartbeat`` seconds of silence (defaults to 15, from the
+    ``[liquidsoap]`` section). The stream is closed after ``stream_duration``
+    seconds (defaults to 600), browsers' ``EventSource`` will reconnect
+    automatically.
+
+    :query instance: *optional* Liquidsoap instance name
+    """
+    instance = _instance()
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    if not request.environ.get('wsgi.multithread'):
+        # a mono-threaded server can't afford to hold the connection:
+        # send one event and let the client reconnect, as if polling
+        duration = 0.
+    else:
+        duration = float(live_app.config.get('liquidsoap.stream_duration', 600))
+    heartbeat = float(live_app.config.get('liquidsoap.stream_heartbeat', 15))
+    return live_events(heartbeat, duration, instance)
+
+@live_app.get("/live/link_stats")
+def get_link_stats():
+    """
+    Statistics about commands sent to Liquidsoap since Showergel started,
+    to tell if slowness comes from Liquidsoap itself or from Showergel waiting
+    for a connection. Durations are in seconds, sizes in bytes. Percentiles
+    are estimated from histograms' buckets.
+    This is empty if Showergel is not connected to a real Liquidsoap.
+
+    :query instance: *optional* Liquidsoap instance name
+    :>json since: when statistics started
+    :>json reconnects: how many times a connection had to be re-opened
+    :>json commands: for each command name (``uptime``, ``*.metadata``...),
+        round-trip time (``rtt``) and response ``size`` histograms, and the
+        number of ``errors``
+    :>json waits: time spent waiting for a session or a lock, before sending
+        commands
+    """
+    return Connection.link_stats(_instance())
 
 @live_app.get("/parameters")
 def get_parameters():
@@ -38,14 +132,18 @@ def get_parameters():
 
     :>json name: instance name (appears as interface's title)
     :>json version: showergel's version
+    :query instance: *optional* Liquidsoap instance name
     :>json commands: list of available Liquidsoap commands
+    :>json liquidsoap_instances: names of configured Liquidsoap instances,
+        the default one first
     """
-    connection = Connection.get()
+    now_playing = Connection.now_playing(instance=_instance())
     return {
         "name": live_app.config.get("interface.name", "Showergel"),
         "version": get_version(),
-        "commands": connection.commands,
-        "liquidsoap_version": connection.connected_liquidsoap_version,
+        "commands": list(now_playing.commands),
+        "liquidsoap_version": now_playing.liquidsoap_version,
+        "liquidsoap_instances": Connection.instances(),
         "cartfolders": CartFolders.get().names(),
     }
 
@@ -53,6 +151,8 @@ def get_parameters():
 def delete_live():
     """
     Skips current track: this sends a skip command to the first Liquidsoap output.
+
+    :query instance: *optional* Liquidsoap instance name
     """
-    Connection.get().skip()
+    Connection.skip(_instance())
     return {}
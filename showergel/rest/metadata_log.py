@@ -3,13 +3,23 @@ Metadata log RESTful interface
 ==============================
 """
 
-from bottle import request, HTTPError
+import csv
+import io
+import json
+from typing import Dict, Iterator, List
+
+import arrow
+from bottle import request, response, HTTPError
+from sqlalchemy.orm import sessionmaker
 
 from showergel.showergel_bottle import ShowergelBottle
-from showergel.metadata import Log
+from showergel.metadata import Log, LogRollup, LogSearch, MetadataWriter
+from showergel.log_archive import LogArchive
 
 metadata_log_app = ShowergelBottle()
 
+MAX_PAGE_SIZE = 1000
+
 @metadata_log_app.get("/metadata_log")
 def get_metadata_log(db):
     """
@@ -23,28 +33,260 @@ def get_metadata_log(db):
     :query bool chronological: may be set to anything non-empty (use ``1`` or ``true``),
         otherwise results are sorted recent first.
         Doesn't affect the interpretation of ``start`` and ``end``.
-    
+    :query int page_size: paginates results (up to 1000 per page), instead of
+        applying ``limit``. Pass the ``next`` cursor of the response as
+        ``after`` (if ``chronological``) or ``before`` to get the following page.
+    :query string after: only return items played after this cursor (or ISO 8601 time)
+    :query string before: only return items played before this cursor (or ISO 8601 time)
+
+    If ``retention_months`` is configured and ``start`` is older than that,
+    matching entries are also read from archive files.
+
     :>json metadata_log: logged metadata matching the query parameters.
+    :>json next: with ``page_size``, the cursor of the next page,
+        or null if this is the last one.
     """
+    params = {
+        'start': request.params.start,
+        'end': request.params.end,
+        'chronological': bool(request.params.chronological),
+    }
+    archive = LogArchive.get()
+    try:
+        if request.params.page_size:
+            page_size = int(request.params.page_size)
+            if not 0 < page_size <= MAX_PAGE_SIZE:
+                raise ValueError(f"page_size should be between 1 and {MAX_PAGE_SIZE}")
+            params['before'] = request.params.before
+            params['after'] = request.params.after
+            logged = Log.get_page(db, page_size, **params)
+            if archive:
+                logged = archive.complete(logged, page_size + 1, **params)
+            logged, next_cursor = Log.paginate(logged, page_size)
+            return {
+                'metadata_log': logged,
+                'next': next_cursor,
+            }
+        logged = Log.get(db, limit=request.params.limit, **params)
+        if archive and params['start']:
+            limit = None
+            if not params['end']:
+                limit = int(request.params.limit or 10)
+            logged = archive.complete(logged, limit, **params)
+    except (ValueError, arrow.parser.ParserError) as value_error:
+        raise HTTPError(status=400, body=str(value_error))
     return {
-        'metadata_log': Log.get(db,
+        'metadata_log': logged
+    }
+
+@metadata_log_app.get("/metadata_log/stats")
+def get_metadata_log_stats(db):
+    """
+    Counts plays and airtime, for example to get this month's top artists,
+    or each source's airtime last week.
+    Days are in UTC.
+
+    :query string by: how to group results: ``artist`` (default), ``title``
+        (counts each artist and title pair), ``source`` or ``day``.
+    :query string start: first day (ISO 8601 format) counted, optional
+    :query string end: last day counted (inclusive), optional
+    :query string order: sort results by ``plays`` (default) or ``airtime``.
+        Results grouped by day are sorted chronologically.
+    :query int limit: restricts the number of results (and defaults to 10).
+        It is ignored when grouping by day.
+
+    :>json stats: for each group, its fields (like ``artist``), ``plays``,
+        and ``airtime`` in seconds.
+    """
+    try:
+        stats = LogRollup.stats(db,
+            by=request.params.by or 'artist',
             start=request.params.start,
             end=request.params.end,
+            order=request.params.order or 'plays',
             limit=request.params.limit,
-            chronological=bool(request.params.chronological),
         )
+    except ValueError as value_error:
+        raise HTTPError(status=400, body=str(value_error))
+    return {
+        'stats': stats,
+    }
+
+@metadata_log_app.get("/metadata_log/search")
+def search_metadata_log(db):
+    """
+    Finds logged items whose artist, title, album, initial URI or extra fields
+    listed in ``search_fields`` contain all the words of ``q`` (the last word
+    may be the beginning of a word), for example to know when a track was
+    last played. Archived entries (see ``retention_months``) are included.
+
+    :query string q: words to search
+    :query string order: ``rank`` (default) sorts the most relevant items first,
+        ``recent`` the most recently played.
+    :query int page_size: how many items are returned (defaults to 10, up to 1000)
+    :query int offset: how many items to skip, use ``next`` from the previous page
+
+    :>json metadata_log: matching items, with their main fields
+    :>json next: ``offset`` of the next page, or null if this is the last one.
+    """
+    if not LogSearch.available(db):
+        raise HTTPError(status=501, body="Full-text search is not available, see Showergel's log")
+    try:
+        page_size = int(request.params.page_size or 10)
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise ValueError(f"page_size should be between 1 and {MAX_PAGE_SIZE}")
+        offset = int(request.params.offset or 0)
+        if offset < 0:
+            raise ValueError("offset should be positive")
+        found = LogSearch.search(db, request.params.q,
+            limit=page_size + 1,
+            offset=offset,
+            order=request.params.order or 'rank',
+        )
+    except ValueError as value_error:
+        raise HTTPError(status=400, body=str(value_error))
+    return {
+        'metadata_log': found[:page_size],
+        'next': offset + page_size if len(found) > page_size else None,
     }
 
+EXPORT_COLUMNS = ['on_air', 'artist', 'title', 'album', 'source', 'initial_uri']
+EXPORT_CHUNK = 500
+
+@metadata_log_app.get("/metadata_log/export.<file_format:re:csv|ndjson>")
+def export_metadata_log(db, file_format):
+    """
+    Downloads all items played between ``start`` and ``end``, chronologically,
+    as CSV (``/metadata_log/export.csv``) or NDJSON (``/metadata_log/export.ndjson``).
+    The response is streamed, so it can be used for large reports.
+    In CSV, each extra field logged in that period gets its own column.
+    Archived entries (see ``retention_months``) are included.
+
+    :query string start: (ISO 8601 format) define an inclusive interval, optional
+    :query string end: define an inclusive interval, optional
+    """
+    start = request.params.start
+    end = request.params.end
+    try:
+        for bound in (start, end):
+            if bound:
+                arrow.get(bound)
+    except ValueError as value_error:
+        raise HTTPError(status=400, body=str(value_error))
+
+    archive = LogArchive.get()
+    entries = _export_entries(sessionmaker(bind=db.get_bind()), start, end)
+    filename = "showergel-" + (start or "start") + "-" + (end or "now")
+    response.set_header('Content-Disposition',
+        f'attachment; filename="{filename.replace(":", "")}.{file_format}"')
+    if file_format == 'ndjson':
+        response.content_type = "application/x-ndjson; charset=utf-8"
+        return _chunks(json.dumps(entry) + "\n" for entry in entries)
+
+    keys = set(Log.extra_keys(db, start, end))
+    if archive:
+        for entry in archive.entries(start, end):
+            keys.update(entry.keys())
+    columns = EXPORT_COLUMNS + sorted(keys.difference(EXPORT_COLUMNS))
+    response.content_type = "text/csv; charset=utf-8"
+    return _csv_lines(columns, entries)
+
+def _export_entries(session_factory:sessionmaker, start:str, end:str) -> Iterator[Dict]:
+    """
+    Archived entries first, then the DB's - in their own sessions, because
+    the request's one is closed before the response is sent.
+    """
+    archive = LogArchive.get()
+    if archive:
+        yield from archive.entries(start, end)
+    yield from Log.iter_entries(session_factory, start, end)
+
+def _csv_lines(columns:List[str], entries:Iterator[Dict]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, columns, restval="", extrasaction='ignore')
+    writer.writeheader()
+    for count, entry in enumerate(entries, start=1):
+        writer.writerow(entry)
+        if count % EXPORT_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _chunks(lines:Iterator[str]) -> Iterator[str]:
+    """
+    Groups ``lines`` by ``EXPORT_CHUNK``, so the server writes less often
+    """
+    lines = iter(lines)
+    for first in lines:
+        chunk = [first]
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= EXPORT_CHUNK:
+                break
+        yield "".join(chunk)
+
 @metadata_log_app.post("/metadata_log")
 def post_metadata_log(db):
     """
     Should be called by Liquidsoap to save tracks' metadata.
     See :ref:`liq_metadata`.
+
+    Metadata is only validated here: it's saved in background, so Liquidsoap
+    does not wait for the database.
     """
     try:
-        if not request.json:
-            raise ValueError("No JSON data POSTed - maybe headers are missing")
-        Log.save_metadata(metadata_log_app.config, db, request.json)
+        Log.check_metadata(request.json)
     except ValueError as value_error:
         raise HTTPError(status=400, body=str(value_error))
+    MetadataWriter.get().submit(request.json)
     return {}
+
+
+BULK_MAX_ERRORS = 100
+
+@metadata_log_app.post("/metadata_log/bulk")
+def post_metadata_log_bulk(db):
+    """
+    Imports many metadata entries at once, for example to migrate the playout
+    history of another automation system.
+    Each line of the request body (as ``application/x-ndjson``) should be a
+    JSON object, like what Liquidsoap posts to ``/metadata_log``, including
+    its ``on_air`` time.
+
+    Entries whose ``on_air`` time is already logged (or archived) are skipped,
+    so the same file can be posted again if an import failed.
+    Invalid lines are skipped too.
+
+    :>json int inserted: how many entries were saved
+    :>json int skipped: entries ignored because their ``on_air`` time was already logged or archived
+    :>json int invalid: lines ignored because they're not valid JSON or miss ``on_air``
+    :>json errors: explanations of the first invalid lines
+    """
+    report = {'invalid': 0, 'errors': []}
+    summary = Log.insert_many(metadata_log_app.config, db, _read_ndjson(request.body, report),
+        archive=LogArchive.get())
+    summary.update(report)
+    return summary
+
+def _read_ndjson(body, report:dict):
+    """
+    Yields valid entries from ``body``, counting invalid ones in ``report``
+    """
+    for number, line in enumerate(body, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+            Log.check_metadata(data)
+            if 'on_air' not in data:
+                raise ValueError("on_air is missing")
+        except ValueError as value_error:
+            report['invalid'] += 1
+            if len(report['errors']) < BULK_MAX_ERRORS:
+                report['errors'].append(f"line {number}: {value_error}")
+            continue
+        yield data
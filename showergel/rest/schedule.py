@@ -21,16 +21,20 @@ def put_schedule(db):
 
     :<json command: Liquidsoap command
     :<json when: Event time (ISO 8601 with time zone info)
+    :<json instance: *optional* name of the Liquidsoap instance that will run
+        the command (see ``GET /parameters``)
     :>json event_id: created event's ID
     :>json type: will always be "command" in that case
     :>json what: given command
     :>json when: given command execution time
+    :>json instance: given instance name, or null
     """
     scheduler = Scheduler.get()
     try:
         return scheduler.command(
             request.json.get('command'),
             request.json.get('when'),
+            request.json.get('instance'),
         )
     except (ValueError, TypeError, AttributeError) as error:
         _log.exception(error)
@@ -51,10 +55,13 @@ def put_schedule_cartfolder(db):
     :<json hour: Hour of day (0-23)
     :<json minute:
     :<json timezone: for example "Europe/Paris"
+    :<json instance: *optional* name of the Liquidsoap instance whose queue
+        will receive the cart
     :>json event_id: created event's ID
     :>json type: will always be "cartfolder" in that case
     :>json what: given name
     :>json when: given next playout time
+    :>json instance: given instance name, or null
     """
     scheduler = Scheduler.get()
     try:
@@ -64,7 +71,8 @@ def put_schedule_cartfolder(db):
             p['day_of_week'],
             int(p['hour']),
             int(p['minute']),
-            p['timezone']
+            p['timezone'],
+            p.get('instance'),
         )
     except (ValueError, TypeError, KeyError) as error:
         _log.exception(error)
@@ -82,6 +90,7 @@ def get_schedule(db):
      * ``when`` event's next occurence (ISO time)
      * ``type`` event type: cartfolder or command
      * ``what`` event parameter: cartfolder name, complete command.
+     * ``instance`` name of the Liquidsoap instance running it, null for the default one
     """
     return Scheduler.get().upcoming()
 
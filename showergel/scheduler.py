@@ -13,6 +13,7 @@ import logging
 from sqlalchemy.orm import Session
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
 from apscheduler.events import EVENT_JOB_ERROR
 from apscheduler.job import Job
@@ -28,13 +29,13 @@ _log = logging.getLogger(__name__)
 # Scheduled "jobs" should be independant functions because APS must be able to
 # serialize all their parameters (that wouldn't work with self:Scheduler)
 
-def _do_command(command):
+def _do_command(command, instance=None):
     """
     One-time scheduled Liquidsoap command
     """
-    connection = Connection.get()
+    connection = Connection.get(instance)
     _log.info("Running scheduled command: %s", command)
-    result = connection.command(command)
+    result = connection.command(command, priority=True)
     _log.info("Liquidsoap replied: %s", result)
     Scheduler.dbsession.add(Log(
         on_air=arrow.get(tzinfo='local').to('utc').datetime,
@@ -43,7 +44,7 @@ def _do_command(command):
     ))
     Scheduler.dbsession.commit()
 
-def _do_enqueue_cart(cartname):
+def _do_enqueue_cart(cartname, instance=None):
     """
     Function called each time a cart is scheduled. Pushes the next file to queue.
     """
@@ -57,10 +58,10 @@ def _do_enqueue_cart(cartname):
     except EmptyCartException:
         _log.info("Cart %s should play now, but its folder is empty", cartname)
         return
-    connection = Connection.get()
+    connection = Connection.get(instance)
     command = f"{CartFolders.liquidsoap_queue}.push {nextpath}"
     _log.debug("Enqueuing cart folder: %s", command)
-    result = connection.command(command)
+    result = connection.command(command, priority=True)
     _log.debug("Liquidsoap replied: %s", result)
 
 
@@ -77,7 +78,8 @@ def serialize(job:Job) -> Dict:
         'event_id': job.id,
         'type': job.name,
         'what': job.args[0],
-        'when': when
+        'when': when,
+        'instance': job.kwargs.get('instance'),
     }
 
 class Scheduler:
@@ -112,13 +114,13 @@ class Scheduler:
         return cls.__instance
 
     def __init__(self, dbsession:Session, store_in_memory):
-        if store_in_memory:
-            self.scheduler = BackgroundScheduler()
-        else:
-            jobstores = {
-                'default': SQLAlchemyJobStore(engine=dbsession.get_bind())
-            }
-            self.scheduler = BackgroundScheduler(jobstores=jobstores)
+        # Showergel's own periodic jobs are not persisted, nor listed as events
+        jobstores = {
+            'internal': MemoryJobStore(),
+        }
+        if not store_in_memory:
+            jobstores['default'] = SQLAlchemyJobStore(engine=dbsession.get_bind())
+        self.scheduler = BackgroundScheduler(jobstores=jobstores)
         self.scheduler.add_listener(self._on_job_error, EVENT_JOB_ERROR)
         self.scheduler.start()
 
@@ -132,7 +134,20 @@ class Scheduler:
         if event.exception:
             _log.exception(event.exception)
 
-    def command(self, command:str, when:str) -> dict:
+    @staticmethod
+    def _instance_kwargs(instance:str=None) -> dict:
+        """
+        Jobs only get an ``instance`` parameter if given one, so they run on
+        the default Liquidsoap instance otherwise.
+        Raises ``ValueError`` if ``instance`` does not exist.
+        """
+        if instance is None:
+            return {}
+        if instance not in Connection.instances():
+            raise ValueError(f"Unknown Liquidsoap instance: {instance}")
+        return {'instance': instance}
+
+    def command(self, command:str, when:str, instance:str=None) -> dict:
         """
         Squedule a Liquidsoap command. It will raise ``KeyError`` if a command
         was already scheduled at given date, or ``ValueError`` if given unusable
@@ -140,6 +155,8 @@ class Scheduler:
         Parameters:
             command (str): a complete Liquidsoap telnet command
             when (str): **UTC** time
+            instance (str): name of the Liquidsoap instance that will run the
+                command, defaults to the default one
         Return:
             (dict): serialized event info (see ``serialize``)
         """
@@ -148,11 +165,13 @@ class Scheduler:
             raise ValueError("Please schedule something in the future, given date is in the past")
         if not command:
             raise ValueError("Please provide a non-empty command")
+        kwargs = self._instance_kwargs(instance)
         try:
             job = self.scheduler.add_job(_do_command,
                 id=str(run_date.float_timestamp),
                 name='command',
                 args=[command],
+                kwargs=kwargs,
                 trigger='date',
                 run_date=run_date.datetime,
             )
@@ -160,7 +179,8 @@ class Scheduler:
             raise KeyError("A job is already scheduled at that time. Remove the existing one first")
         return serialize(job)
 
-    def cartfolder(self, name:str, day_of_week:str, hour:int, minute:int, timezone:str) -> dict:
+    def cartfolder(self, name:str, day_of_week:str, hour:int, minute:int, timezone:str,
+        instance:str=None) -> dict:
         """
         Schedule a cartfolder to play weekly at a given time.
 
@@ -172,10 +192,13 @@ class Scheduler:
             hour (int):
             minute (int):
             timezone (str): for example "Europe/Paris"
+            instance (str): name of the Liquidsoap instance whose queue will
+                receive the cart, defaults to the default one
         Return:
             (dict): serialized event info (see ``serialize``)
         """
         _ = CartFolders.get()[name] # checks it exists
+        kwargs = self._instance_kwargs(instance)
         try:
             h = str(hour).zfill(2)
             m = str(minute).zfill(2)
@@ -183,6 +206,7 @@ class Scheduler:
                 id=f"{day_of_week}{h}{m}00{timezone}".replace('/', '_'), # thanks to the 00 we're ready for second precison
                 name='cartfolder',
                 args=[name],
+                kwargs=kwargs,
                 trigger='cron',
                 day_of_week=day_of_week,
                 hour=hour,
@@ -193,13 +217,30 @@ class Scheduler:
         return serialize(job)
 
 
+    def internal_job(self, func, job_id:str, args:list=None, **interval):
+        """
+        Runs ``func`` periodically, starting in a minute. ``interval`` is given
+        as APScheduler's ``interval`` trigger parameters, like ``hours=24``.
+        Internal jobs are not persisted, nor listed by ``upcoming``.
+        """
+        self.scheduler.add_job(func,
+            id=job_id,
+            name=job_id,
+            args=args,
+            trigger='interval',
+            jobstore='internal',
+            replace_existing=True,
+            next_run_time=arrow.utcnow().shift(minutes=1).datetime,
+            **interval,
+        )
+
     def upcoming(self) -> List[Dict]:
         """
         Return:
             (list): upcoming events descriptions
         """
         events = {}
-        for job in self.scheduler.get_jobs():
+        for job in self.scheduler.get_jobs(jobstore='default'):
             as_dict = serialize(job)
             events[as_dict['when']] = as_dict
         return events
@@ -209,6 +250,6 @@ class Scheduler:
         May raise KeyError if ``event_id`` does not exists
         """
         try:
-            self.scheduler.remove_job(event_id)
+            self.scheduler.remove_job(event_id, jobstore='default')
         except JobLookupError:
             raise KeyError("Event not found")
@@ -2,13 +2,14 @@ import logging
 from unittest import TestCase
 
 from webtest import TestApp
+from sqlalchemy import text
 from sqlalchemy.orm import sessionmaker
 import bottle
 from bottle.ext import sqlalchemy
 
 from showergel import app
 from showergel.db import Base
-from showergel.metadata import Log, LogExtra
+from showergel.metadata import Log, LogExtra, LogRollup
 
 APP_CONFIG = {
     'db.sqlalchemy': {
@@ -54,4 +55,6 @@ class ShowergelTestCase(TestCase):
         super().tearDownClass()
         cls.session.query(LogExtra).delete(synchronize_session=False)
         cls.session.query(Log).delete(synchronize_session=False)
+        cls.session.query(LogRollup).delete(synchronize_session=False)
+        cls.session.execute(text("DELETE FROM log_search"))
         cls.session.commit()
@@ -0,0 +1,493 @@
+import asyncio
+import os
+import tempfile
+from threading import Thread
+from time import sleep, monotonic
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+from showergel.liquidsoap_connector import TelnetConnector, TelnetSession, ResponseReader, \
+    SocketConnector, Connection, MetadataParser, iter_lines
+from showergel.liquidsoap_async import AsyncTelnetConnector
+from showergel.db import Base
+from showergel.fake_liquidsoap import FakeLiquidsoap, FakeLiquidsoapSocket, UNKNOWN_COMMAND
+from showergel.link_stats import Histogram, command_name
+from showergel.liquidsoap_recording import ReplayLiquidsoap, read_recording
+
+HELP = """Available commands:
+| exit
+| help [<command>]
+| list
+| out.metadata
+| out.remaining
+| out.skip
+| out.status
+| quit
+| request.on_air
+| uptime
+| version
+Type "help <command>" for more information."""
+
+RESPONSES = {
+    'uptime': "0d 01h 02m 03s",
+    'help': HELP,
+    'version': "Liquidsoap 2.1.4",
+    'request.on_air': "4",
+    'out.metadata': '--- 1 ---\nartist="Tester"\ntitle="Stubbed song"\non_air="2023/01/02 03:04:05"',
+    'out.remaining': "42.00",
+    'out.skip': "Done",
+    'out.status': "on",
+}
+
+
+class TestResponseReader(TestCase):
+
+    def test_split_responses(self):
+        reader = ResponseReader()
+        stream = b"0d 01h 02m 03s\r\nEND\r\nEND\r\nLEGEND\r\nTHE END\r\nEND\r\n"
+        # feed byte per byte, so the terminator is split in all possible ways
+        responses = []
+        for i in range(len(stream)):
+            reader.feed(stream[i:i+1])
+            response = reader.next_response()
+            while response is not None:
+                responses.append(response)
+                response = reader.next_response()
+        self.assertListEqual(responses, [b"0d 01h 02m 03s", b"", b"LEGEND\r\nTHE END"])
+
+    def test_iter_lines(self):
+        raw = b'title="caf\xc3\xa9"\r\napic="\xff\xfe"\r\nartist="me"'
+        self.assertListEqual(list(iter_lines(raw)), ['title="caf\u00e9"', 'artist="me"'])
+        self.assertListEqual(list(iter_lines(raw, raw.index(b"artist"))), ['artist="me"'])
+
+    def test_telnet_negotiation(self):
+        sent = []
+        class FakeSocket:
+            def sendall(self, data):
+                sent.append(data)
+        session = TelnetSession('localhost', 1234, 1)
+        session._sock = FakeSocket()
+        # IAC DO ECHO, then an escaped 0xff, then IAC WILL split in two chunks
+        self.assertEqual(session._process_telnet(b"a\xff\xfd\x01b\xff\xffc\xff"), b"ab\xffc")
+        self.assertEqual(session._process_telnet(b"\xfb\x03d"), b"d")
+        self.assertListEqual(sent, [b"\xff\xfc\x01", b"\xff\xfe\x03"])
+
+
+class TestMetadataParser(TestCase):
+
+    RAW = b'--- 1 ---\r\ntitle="caf\xc3\xa9 = bar"\r\napic="' + b'A' * 100 + \
+        b'"\r\nbroken="\xff"\r\nempty=""\r\ngenre="rock"\r\ntracknumber="2"\r\nnot metadata'
+
+    def test_parse(self):
+        parser = MetadataParser()
+        start = self.RAW.index(b"\n") + 1
+        self.assertDictEqual(parser.parse(self.RAW, start), {
+            'title': "caf\u00e9 = bar",
+            'apic': "A" * 100,
+            'empty': "",
+            'genre': "rock",
+            'tracknumber': "2",
+        })
+
+    def test_filters(self):
+        parser = MetadataParser(fields=["track*"], max_size=50)
+        start = self.RAW.index(b"\n") + 1
+        self.assertDictEqual(parser.parse(self.RAW, start), {
+            'title': "caf\u00e9 = bar",
+            'tracknumber': "2",
+        })
+
+
+class TestLinkStats(TestCase):
+
+    def test_command_name(self):
+        self.assertEqual(command_name("uptime"), "uptime")
+        self.assertEqual(command_name("out.metadata"), "*.metadata")
+        self.assertEqual(command_name("queue.push /music/song.mp3"), "*.push")
+        self.assertEqual(command_name("request.metadata 4"), "request.metadata")
+
+    def test_histogram(self):
+        histogram = Histogram((1, 10, 100))
+        for value in (0.5, 2, 3, 5, 8, 50, 1000):
+            histogram.record(value)
+        stats = histogram.to_dict()
+        self.assertEqual(stats['count'], 7)
+        self.assertEqual(stats['max'], 1000)
+        self.assertEqual(stats['p50'], 10)
+        self.assertEqual(stats['p99'], 1000)
+        self.assertDictEqual(stats['buckets'], {'<=1': 1, '<=10': 4, '<=100': 1, '>100': 1})
+        self.assertIsNone(Histogram((1,)).to_dict()['p50'])
+
+
+class TestConnection(TestCase):
+
+    def test_instances_config(self):
+        configs = Connection._instances_config({
+            'interface.name': "Test",
+            'liquidsoap.method': "telnet",
+            'liquidsoap.host': "localhost",
+            'liquidsoap.port': 1234,
+            'liquidsoap.backup.port': 1235,
+            'liquidsoap.web.method': "socket",
+            'liquidsoap.web.path': "/tmp/web.sock",
+        })
+        self.assertListEqual(list(configs.keys()), ['default', 'backup', 'web'])
+        self.assertEqual(configs['default']['liquidsoap.port'], 1234)
+        self.assertNotIn('liquidsoap.backup.port', configs['default'])
+        self.assertEqual(configs['backup']['liquidsoap.port'], 1235)
+        self.assertEqual(configs['backup']['liquidsoap.host'], "localhost")
+        self.assertEqual(configs['web']['liquidsoap.method'], "socket")
+        self.assertEqual(configs['web']['interface.name'], "Test")
+
+        # [liquidsoap] without method only holds shared settings
+        configs = Connection._instances_config({
+            'liquidsoap.timeout': 2,
+            'liquidsoap.fm.method': "telnet",
+        })
+        self.assertListEqual(list(configs.keys()), ['fm'])
+        self.assertEqual(configs['fm']['liquidsoap.timeout'], 2)
+
+        # instances don't share a recording file
+        configs = Connection._instances_config({
+            'liquidsoap.record': "/tmp/showergel.lsrec",
+            'liquidsoap.fm.method': "telnet",
+            'liquidsoap.web.method': "socket",
+            'liquidsoap.web.record': "/tmp/web.lsrec",
+            'liquidsoap.dab.method': "telnet",
+        })
+        self.assertEqual(configs['fm']['liquidsoap.record'], "/tmp/showergel.fm.lsrec")
+        self.assertEqual(configs['web']['liquidsoap.record'], "/tmp/web.lsrec")
+        self.assertEqual(configs['dab']['liquidsoap.record'], "/tmp/showergel.dab.lsrec")
+
+
+class TestFakeLiquidsoap(TestCase):
+
+    def setUp(self):
+        self.server = FakeLiquidsoap(picture_size=8192)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_playout(self):
+        connector = TelnetConnector(self.server.config(metadata_max_size=4096))
+        connector._reconnect_thread.join(2)
+        current = connector.current()
+        self.assertEqual(current['title'], "Track 0")
+        self.assertNotIn('apic', current)
+        self.assertLessEqual(current['remaining'], 180.)
+        connector.skip()
+        self.assertEqual(connector.current()['title'], "Track 1")
+
+        self.server.restart()
+        self.assertEqual(connector.current()['status'], "can't reach Liquidsoap")
+        self.assertTrue(connector.wait_available(2))
+        self.assertEqual(connector.current()['title'], "Track 0")
+        self.assertEqual(connector.stats.reconnects, 1)
+
+    def test_setup_closes_previous(self):
+        Connection.setup(self.server.config())
+        previous = Connection.get()
+        self.assertTrue(previous.wait_available(2))
+        Connection.setup({})
+        self.assertFalse(previous.available)
+        self.assertIsNone(previous.command("version"))
+
+
+class TestRecording(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "session.lsrec")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_append(self):
+        server = FakeLiquidsoap(responses=RESPONSES)
+        try:
+            for _ in range(2):
+                connector = TelnetConnector(server.config(record=self.path))
+                connector._reconnect_thread.join(2)
+                connector.skip()
+                connector.close()
+        finally:
+            server.stop()
+        commands = [exchange.command for exchange in read_recording(self.path)]
+        self.assertEqual(commands.count("uptime"), 2)
+        self.assertEqual(commands.count("out.skip"), 2)
+
+    def test_record_and_replay(self):
+        weird_metadata = b'--- 1 ---\r\ntitle="Recorded"\r\ncomment="\xc3\x28"\r\nartist="Me"'
+        server = FakeLiquidsoap()
+        connector = TelnetConnector(server.config(record=self.path))
+        connector._reconnect_thread.join(2)
+        server.respond_raw = lambda command: weird_metadata + b"\r\nEND\r\n" \
+            if command == "out.metadata" else FakeLiquidsoap.respond_raw(server, command)
+        connector.current()
+        connector.skip()
+        connector.close()
+        server.stop()
+
+        exchanges = list(read_recording(self.path))
+        commands = [exchange.command for exchange in exchanges]
+        self.assertListEqual(commands[:2], ["uptime", "help"])
+        self.assertIn("out.skip", commands)
+        metadata = [exchange for exchange in exchanges if exchange.command == "out.metadata"]
+        self.assertEqual(metadata[0].response, weird_metadata)
+        self.assertGreaterEqual(metadata[0].offset, 0.)
+
+        replay = ReplayLiquidsoap(self.path)
+        try:
+            connector = TelnetConnector(replay.config())
+            connector._reconnect_thread.join(2)
+            replayed = connector.current()
+            self.assertEqual(replayed['title'], "Recorded")
+            self.assertEqual(replayed['artist'], "Me")
+            self.assertNotIn('comment', replayed)
+            self.assertListEqual(connector.command("nope"), [UNKNOWN_COMMAND])
+        finally:
+            replay.stop()
+
+
+class TestTelnetConnector(TestCase):
+
+    connector_class = TelnetConnector
+
+    def setUp(self):
+        self.server = self.start_server()
+
+    def start_server(self, address=None):
+        if address is None:
+            return FakeLiquidsoap(responses=RESPONSES)
+        return FakeLiquidsoap(address, responses=RESPONSES)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def connect(self, engine=None, **config):
+        connector = self.connector_class(self.server.config(**config), engine)
+        # let the connection thread load the commands list
+        reconnect_thread = connector._reconnect_thread
+        if reconnect_thread:
+            reconnect_thread.join(2)
+        self.assertTrue(connector.available)
+        return connector
+
+    def test_current(self):
+        connector = self.connect()
+        self.assertEqual(connector.connected_liquidsoap_version, "Liquidsoap 2.1.4")
+        self.assertIn('out.skip', connector.commands)
+        current = connector.current()
+        self.assertEqual(current['title'], "Stubbed song")
+        self.assertEqual(current['uptime'], "1:02:03")
+        self.assertEqual(current['remaining'], 42.)
+        self.assertEqual(connector.remaining(), 42.)
+
+    def test_metadata_cache(self):
+        connector = self.connect()
+        connector.current()
+        connector.current()
+        self.assertEqual(1, self.server.received.count("out.metadata"))
+
+        # next track
+        self.server.responses['request.on_air'] = "5"
+        self.server.responses['out.metadata'] = '--- 1 ---\ntitle="Next song"'
+        self.assertEqual(connector.current()['title'], "Next song")
+        self.assertEqual(2, self.server.received.count("out.metadata"))
+
+        # a live source takes over, the request stays on air
+        self.server.responses['out.remaining'] = "-1."
+        self.server.responses['out.metadata'] = '--- 1 ---\ntitle="Live show"'
+        self.assertEqual(connector.current()['title'], "Live show")
+        self.assertEqual(connector.current()['title'], "Live show")
+        self.assertEqual(3, self.server.received.count("out.metadata"))
+
+        # back to the playlist, then another track with the same RID
+        self.server.responses['out.remaining'] = "100.00"
+        self.server.responses['out.metadata'] = '--- 1 ---\ntitle="Back song"'
+        self.assertEqual(connector.current()['title'], "Back song")
+        self.server.responses['out.remaining'] = "180.00"
+        self.server.responses['out.metadata'] = '--- 1 ---\ntitle="Other song"'
+        self.assertEqual(connector.current()['title'], "Other song")
+        self.server.responses['out.remaining'] = "170.00"
+        connector.current()
+        self.assertEqual(5, self.server.received.count("out.metadata"))
+
+        # multiple RIDs are not cached
+        self.server.responses['request.on_air'] = "5 9"
+        connector.current()
+        connector.current()
+        self.assertEqual(7, self.server.received.count("out.metadata"))
+
+        # no request on air: metadata is fetched every time
+        self.server.responses['request.on_air'] = ""
+        connector.current()
+        connector.current()
+        self.assertEqual(9, self.server.received.count("out.metadata"))
+
+    def test_batch(self):
+        connector = self.connect()
+        responses = connector.batch(["version", "out.status", "nope", "uptime"])
+        self.assertListEqual(responses, [
+            ["Liquidsoap 2.1.4"],
+            ["on"],
+            [UNKNOWN_COMMAND],
+            ["0d 01h 02m 03s"],
+        ])
+        self.assertListEqual(self.server.received[-4:], ["version", "out.status", "nope", "uptime"])
+
+    def test_priority_lane(self):
+        connector = self.connect(pool_size=1)
+        self.server.delays['out.metadata'] = 1.
+        slow = Thread(target=connector.command, args=("out.metadata",))
+        slow.start()
+        sleep(0.1)
+        started = monotonic()
+        connector.skip()
+        self.assertLess(monotonic() - started, 0.5)
+        self.assertIn('out.skip', self.server.received)
+        slow.join()
+
+    def test_restart_detection(self):
+        connector = self.connect(uptime_interval=3600)
+        connector.current()
+        connector.current()
+        self.assertEqual(1, self.server.received.count("uptime"))
+        self.assertEqual(1, self.server.received.count("help"))
+
+        # Liquidsoap restarted
+        self.server.responses['uptime'] = "0d 00h 00m 10s"
+        connector._uptime_interval = 0.
+        current = connector.current()
+        self.assertEqual(current['uptime'], "0:00:10")
+        self.assertEqual(2, self.server.received.count("help"))
+
+    def test_catalogue_cache(self):
+        engine = create_engine("sqlite:///:memory:",
+            connect_args={'check_same_thread': False}, poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        connector = self.connect(engine)
+        self.assertEqual(1, self.server.received.count("help"))
+        # Showergel restarts, but not Liquidsoap
+        other = self.connect(engine)
+        self.assertEqual(1, self.server.received.count("help"))
+        self.assertListEqual(connector.commands, other.commands)
+        self.assertEqual(other.connected_liquidsoap_version, "Liquidsoap 2.1.4")
+        self.assertEqual(other.current()['title'], "Stubbed song")
+        # a new Liquidsoap process with the same version
+        self.server.responses['uptime'] = "0d 00h 00m 10s"
+        self.connect(engine)
+        self.assertEqual(2, self.server.received.count("help"))
+
+    def test_stats(self):
+        connector = self.connect()
+        connector.current()
+        connector.skip()
+        stats = connector.stats.to_dict()
+        metadata = stats['commands']['*.metadata']
+        self.assertEqual(metadata['rtt']['count'], 1)
+        self.assertEqual(metadata['size']['count'], 1)
+        self.assertEqual(metadata['errors'], 0)
+        self.assertIn('*.skip', stats['commands'])
+        self.assertIn('uptime', stats['commands'])
+        self.assertEqual(stats['waits']['connector lock']['count'], 2) # current() and initial uptime()
+        self.assertIn('pooled session', stats['waits'])
+        self.assertIn('priority session', stats['waits'])
+
+        self.server.stop()
+        connector.command("version")
+        connector.command("version")
+        stats = connector.stats.to_dict()
+        self.assertEqual(stats['commands']['version']['errors'], 2)
+
+    def test_close(self):
+        connector = self.connect()
+        connector.current()
+        connector.close()
+        self.assertFalse(connector.available)
+        self.assertIsNone(connector.command("version"))
+        # Liquidsoap sees all sessions closed
+        deadline = monotonic() + 2
+        while self.server.clients and monotonic() < deadline:
+            sleep(0.01)
+        self.assertListEqual(self.server.clients, [])
+
+    def test_session_failure(self):
+        connector = self.connect()
+        self.server.disconnect()
+        # the failed session is re-opened in background, not by the caller
+        started = monotonic()
+        self.assertIsNone(connector.command("version"))
+        self.assertLess(monotonic() - started, 0.5)
+        self.assertTrue(connector.wait_available(2))
+        self.assertListEqual(connector.command("version"), ["Liquidsoap 2.1.4"])
+        self.assertListEqual(connector.command("version", priority=True), ["Liquidsoap 2.1.4"])
+        self.assertEqual(connector.stats.to_dict()['commands']['version']['errors'], 1)
+
+    def test_circuit_breaker(self):
+        connector = self.connect()
+        address = self.server.server_address
+        self.server.stop()
+        self.assertIsNone(connector.command("version"))
+        self.assertFalse(connector.available)
+        # fail fast while Liquidsoap is down
+        started = monotonic()
+        self.assertIsNone(connector.command("version"))
+        self.assertEqual(connector.current()['status'], "can't reach Liquidsoap")
+        self.assertLess(monotonic() - started, 0.1)
+
+        self.server = self.start_server(address)
+        self.assertTrue(connector.wait_available(5))
+        self.assertListEqual(connector.command("version"), ["Liquidsoap 2.1.4"])
+
+
+class TestAsyncTelnetConnector(TestTelnetConnector):
+
+    connector_class = AsyncTelnetConnector
+
+    def test_async_command(self):
+        connector = self.connect()
+        future = asyncio.run_coroutine_threadsafe(
+            connector.async_command("version"), connector._loop)
+        self.assertListEqual(future.result(), ["Liquidsoap 2.1.4"])
+
+    def test_async_methods(self):
+        connector = self.connect()
+
+        async def poll():
+            # concurrent calls, from the event loop
+            return await asyncio.gather(
+                connector.async_current(),
+                connector.async_current(),
+                connector.async_uptime(),
+                connector.async_remaining(),
+                connector.async_skip(),
+            )
+        current, again, uptime, remaining, _ = asyncio.run_coroutine_threadsafe(
+            poll(), connector._loop).result()
+        self.assertEqual(current['title'], "Stubbed song")
+        self.assertEqual(again['title'], "Stubbed song")
+        self.assertEqual(str(uptime), "1:02:03")
+        self.assertEqual(remaining, 42.)
+        self.assertIn('out.skip', self.server.received)
+        self.assertEqual(1, self.server.received.count("out.metadata"))
+
+
+class TestSocketConnector(TestTelnetConnector):
+
+    connector_class = SocketConnector
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp_dir.cleanup()
+
+    def start_server(self, address=None):
+        if address is None:
+            address = os.path.join(self.tmp_dir.name, "liquidsoap.sock")
+        return FakeLiquidsoapSocket(address, responses=RESPONSES)
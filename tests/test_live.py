@@ -1,4 +1,10 @@
+import json
+
 import arrow
+
+from showergel import app
+from showergel.liquidsoap_connector import Connection
+from showergel.rest.live import live_events
 from . import ShowergelTestCase, APP_CONFIG
 
 
@@ -14,6 +20,7 @@ class TestLive(ShowergelTestCase):
         self.assertIn('source', resp)
         self.assertIn('on_air', resp)
         self.assertIn('status', resp)
+        self.assertTrue(resp['liquidsoap_connected'])
 
     def test_get_parameters(self):
         resp = self.app.get('/parameters').json
@@ -29,3 +36,66 @@ class TestLive(ShowergelTestCase):
         self.app.delete('/live')
         resp = self.app.get('/live').json
         self.assertNotEqual(resp['source'], previous_source)
+
+    def test_instances(self):
+        self.assertListEqual(self.app.get('/parameters').json['liquidsoap_instances'], ['default'])
+        Connection.setup({
+            'liquidsoap.fm.method': "demo",
+            'liquidsoap.web.method': "demo",
+        })
+        try:
+            self.assertListEqual(Connection.instances(), ['fm', 'web'])
+            all_live = self.app.get('/live/all').json
+            self.assertListEqual(sorted(all_live.keys()), ['fm', 'web'])
+            self.assertEqual(all_live['web']['title'], Connection.now_playing(instance='web').metadata['title'])
+            resp = self.app.get('/live', {'instance': 'web'}).json
+            self.assertEqual(resp['title'], all_live['web']['title'])
+            # fm is the default instance
+            self.assertEqual(self.app.get('/live').json['title'], all_live['fm']['title'])
+            self.app.get('/live', {'instance': 'nope'}, status=404)
+            self.app.delete('/live?instance=nope', status=404)
+            self.assertEqual(self.app.get('/parameters', {'instance': 'web'}).json['liquidsoap_version'], "Demo")
+
+            when = arrow.now().shift(days=2)
+            resp = self.app.put_json('/schedule/command', {
+                'command': 'out.skip',
+                'when': when.isoformat(),
+                'instance': 'web',
+            }).json
+            self.assertEqual(resp['instance'], 'web')
+            self.app.delete('/schedule/' + resp['event_id'])
+            self.app.put_json('/schedule/command', {
+                'command': 'out.skip',
+                'when': when.isoformat(),
+                'instance': 'nope',
+            }, status=400)
+        finally:
+            Connection.setup(app.config, app.get_engine())
+
+    def test_link_stats(self):
+        # tests use a fake connector, which does not talk to Liquidsoap
+        self.assertDictEqual(self.app.get('/live/link_stats').json, {})
+
+    def test_now_playing_snapshot(self):
+        snapshot = Connection.now_playing()
+        with self.assertRaises(TypeError):
+            snapshot.metadata['title'] = "altered"
+        resp = self.app.get('/live').json
+        self.assertEqual(resp['title'], Connection.now_playing().metadata['title'])
+
+    def test_live_stream(self):
+        # WebTest is mono-threaded, so the stream closes after the first event
+        resp = self.app.get('/live/stream')
+        self.assertEqual(resp.content_type, 'text/event-stream')
+        data = [line for line in resp.text.splitlines() if line.startswith('data: ')]
+        self.assertEqual(1, len(data))
+        first = json.loads(data[0][len('data: '):])
+        self.assertIn('server_time', first)
+
+        events = live_events(heartbeat=0.1, duration=60.)
+        first = json.loads(next(events).split('data: ')[1])
+        self.assertTrue(next(events).startswith('event: heartbeat\n'))
+        Connection.skip()
+        changed = json.loads(next(events).split('data: ')[1])
+        self.assertNotEqual(first['on_air'], changed['on_air'])
+        events.close()
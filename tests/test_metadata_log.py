@@ -1,6 +1,19 @@
+import csv
+import gzip
+import io
+import json
+import os.path
+import tempfile
+
 import arrow
+from click.testing import CliRunner
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
 
-from showergel.metadata import LogExtra, FieldFilter
+from showergel.commands.import_log import import_log
+from showergel.db import Base
+from showergel.log_archive import LogArchive
+from showergel.metadata import Log, LogExtra, LogRollup, LogSearch, FieldFilter, MetadataWriter, LatestTrack
 from showergel.demo import artistic_generator
 from showergel.liquidsoap_connector import Connection
 from . import ShowergelTestCase, app
@@ -11,6 +24,13 @@ FIELD_FILTER_CONFIG = {
 
 class TestMetadataLog(ShowergelTestCase):
 
+    def post_metadata(self, data):
+        """
+        POST /metadata_log, and wait until the background writer saved it
+        """
+        self.app.post_json('/metadata_log', data)
+        MetadataWriter.get().join()
+
     def test_field_filter(self):
         """
         this should be the first test running in this case
@@ -42,9 +62,51 @@ class TestMetadataLog(ShowergelTestCase):
             "lyrics": "lorem ipsum",
         }, only_extra=False)
 
+        # wildcards are combined, decisions are cached per key
+        FieldFilter.setup({'metadata_log.extra_fields': ["genre", "mb*", "*_gain"]})
+        data = {
+            "title": "Greatest song in the world",
+            "genre": "Test",
+            "mb_trackid": "cb4c28fe-0cfb-4f9f-8546-209088441c92",
+            "replaygain_track_gain": "-3 dB",
+            "lyrics": "lorem ipsum",
+            "empty": "",
+        }
+        for _ in range(2):
+            self.assertEqual([key for key, _ in FieldFilter.filter(data)],
+                ["genre", "mb_trackid", "replaygain_track_gain"])
+        for i in range(FieldFilter._DECISIONS_CACHE_SIZE + 10):
+            FieldFilter.filter({f"mb{i}": "x"})
+        self.assertLessEqual(len(FieldFilter._decisions), FieldFilter._DECISIONS_CACHE_SIZE)
+
         # leave the normal conf for other tests
         FieldFilter.setup(app.config)
 
+    def test_latest_track(self):
+        self.assertIsNone(LatestTrack.get(self.session))
+
+        self.post_metadata({'artist': "Artist", 'title': "Title"})
+        self.assertEqual(LatestTrack.get(self.session)['title'], "Title")
+
+        # other insertions count, as they would when querying the log
+        self.session.add(Log(
+            on_air=arrow.utcnow().datetime,
+            source="showergel_scheduler",
+            initial_uri="out.skip",
+        ))
+        self.session.commit()
+        self.assertIsNone(LatestTrack.get(self.session)['title'])
+        self.post_metadata({'artist': "Artist", 'title': "Title"})
+        self.assertEqual(len(self.app.get('/metadata_log').json['metadata_log']), 3)
+
+        # older entries don't replace the latest one
+        self.post_metadata({'artist': "Old", 'title': "Old", 'on_air': "2020-01-01T00:00:00Z"})
+        self.assertEqual(LatestTrack.get(self.session)['title'], "Title")
+
+        self.session.query(Log).delete(synchronize_session=False)
+        self.session.commit()
+        self.assertIsNone(LatestTrack.get(self.session))
+
     def test_metadata_log(self):
         """
         This also test the coupling with (stubbed) ``LiquidsoapConnector.current()``.
@@ -54,16 +116,17 @@ class TestMetadataLog(ShowergelTestCase):
         # don't crash when no JSON is provided or empty
         resp = self.app.post_json('/metadata_log', {}, status=400)
         resp = self.app.post('/metadata_log', status=400)
+        resp = self.app.post_json('/metadata_log', {'title': "x", 'on_air': "not a date"}, status=400)
 
         first_track = {
             'artist': artistic_generator(),
             'title': artistic_generator(),
             'source': 'test',
         }
-        resp = self.app.post_json('/metadata_log', first_track)
+        self.post_metadata(first_track)
 
         # make it robust to repeated posts...
-        resp = self.app.post_json('/metadata_log', first_track)
+        self.post_metadata(first_track)
         # we take care of this because many operators (switch, fallback,...)
         # default `replay_metadata` to true
 
@@ -75,8 +138,10 @@ class TestMetadataLog(ShowergelTestCase):
 
         current = connection.current()
         del(current['initial_uri'])
+        # the line above also altered the stub's state: refresh the snapshot
+        Connection.now_playing(refresh=True)
         current['source_url'] = "http://check.its.renamed/to/initial_uri"
-        resp = self.app.post_json('/metadata_log', current)
+        self.post_metadata(current)
 
         logged = self.app.get('/metadata_log').json['metadata_log']
         self.assertEqual(2, len(logged))
@@ -90,7 +155,7 @@ class TestMetadataLog(ShowergelTestCase):
         before_track3 = arrow.get(current['on_air'], tzinfo='local').to('utc')
         connection.skip()
         current = connection.current()
-        resp = self.app.post_json('/metadata_log', current)
+        self.post_metadata(current)
 
         logged = self.app.get('/metadata_log', {
             "chronological": True,
@@ -128,7 +193,7 @@ class TestMetadataLog(ShowergelTestCase):
         # this is tied to the configuration in tests/__init__.py
         connection.skip()
         current = connection.current()
-        resp = self.app.post_json('/metadata_log', current)
+        self.post_metadata(current)
 
         logged = self.app.get('/metadata_log', {
             "limit": 1,
@@ -143,7 +208,7 @@ class TestMetadataLog(ShowergelTestCase):
             'on_air': current['on_air'],
             'artist': artistic_generator(),
         }
-        resp = self.app.post_json('/metadata_log', last)
+        self.post_metadata(last)
 
         # check there's no crash when a field is missing and doesn't match our connector's metadata
         connection.skip()
@@ -152,7 +217,7 @@ class TestMetadataLog(ShowergelTestCase):
             'on_air': current['on_air'],
             'title': artistic_generator(),
         }
-        resp = self.app.post_json('/metadata_log', last)
+        self.post_metadata(last)
 
         connection.skip()
         current = connection.current()
@@ -161,11 +226,530 @@ class TestMetadataLog(ShowergelTestCase):
             'artist': artistic_generator(),
             'title': artistic_generator(),
         }
-        resp = self.app.post_json('/metadata_log', last)
+        self.post_metadata(last)
 
         # sometimes Liquidsoap lets huge fields get in the query
         # in that case Bottle blocks and returns 413 Request Entity Too Large
         connection.skip()
         current = connection.current()
         current['apic'] = "like a big big picture in metadata" * 100000
-        resp = self.app.post_json('/metadata_log', last)
+        self.post_metadata(last)
+
+    def test_metadata_log_bulk(self):
+        entries = [{
+            'on_air': f"2019-06-01T12:{minute:02d}:00Z",
+            'artist': "Bulk",
+            'title': f"Track {minute}",
+            'tracknumber': minute,
+            'editor': "not kept",
+        } for minute in range(10)]
+        # entries don't all have the same fields
+        for entry in entries[1::2]:
+            entry['album'] = "Sometimes"
+        entries[2]['source_url'] = "http://example.com/track2.mp3"
+        body = "\n".join(json.dumps(entry) for entry in entries)
+        body += "\nnot JSON\n\n[1, 2]\n" + json.dumps({'title': "no on_air"}) + "\n"
+        body += json.dumps(entries[0]) # duplicate in the same request
+
+        summary = self.app.post('/metadata_log/bulk', body,
+            content_type="application/x-ndjson").json
+        self.assertEqual(summary['inserted'], 10)
+        self.assertEqual(summary['skipped'], 1)
+        self.assertEqual(summary['invalid'], 3)
+        self.assertEqual(len(summary['errors']), 3)
+        self.assertTrue(summary['errors'][0].startswith("line 11:"))
+
+        logged = self.app.get('/metadata_log', {
+            'start': "2019-06-01T12:00:00Z",
+            'end': "2019-06-01T13:00:00Z",
+            'chronological': 1,
+        }).json['metadata_log']
+        self.assertEqual([entry['title'] for entry in logged], [f"Track {minute}" for minute in range(10)])
+        self.assertEqual(logged[3]['tracknumber'], "3")
+        self.assertNotIn('editor', logged[3])
+        self.assertEqual([entry['album'] for entry in logged[:3]], [None, "Sometimes", None])
+        self.assertEqual(logged[2]['initial_uri'], "http://example.com/track2.mp3")
+
+        # posting again is harmless
+        summary = self.app.post('/metadata_log/bulk', body,
+            content_type="application/x-ndjson").json
+        self.assertEqual(summary['inserted'], 0)
+        self.assertEqual(summary['skipped'], 11)
+
+        # bulk inserts don't hide the latest track from save_metadata
+        latest = self.app.get('/metadata_log', {'limit': 1}).json['metadata_log'][0]
+        self.post_metadata({'artist': latest['artist'], 'title': latest['title']})
+        self.assertEqual(self.app.get('/metadata_log', {'limit': 1}).json['metadata_log'][0]['on_air'],
+            latest['on_air'])
+
+    def test_metadata_log_bulk_chunk(self):
+        # one chunk takes a few statements
+        def body(minutes):
+            return "\n".join(json.dumps({
+                'on_air': arrow.get("2016-01-01T00:00:00Z").shift(minutes=minute).isoformat(),
+                'title': f"Minute {minute}",
+                'tracknumber': str(minute),
+            }) for minute in minutes)
+        summary = self.app.post('/metadata_log/bulk', body(range(0, 400, 2)),
+            content_type="application/x-ndjson").json
+        self.assertEqual(summary['inserted'], 200)
+        summary = self.app.post('/metadata_log/bulk', body(range(400)),
+            content_type="application/x-ndjson").json
+        self.assertEqual(summary['inserted'], 200)
+        self.assertEqual(summary['skipped'], 200)
+        logged = self.app.get('/metadata_log', {
+            'start': "2016-01-01T00:00:00Z",
+            'end': "2016-01-02T00:00:00Z",
+            'chronological': 1,
+        }).json['metadata_log']
+        self.assertEqual(len(logged), 400)
+        self.assertTrue(all(entry['tracknumber'] == entry['title'][7:] for entry in logged))
+
+    def test_metadata_log_pages(self):
+        body = "\n".join(json.dumps({
+            'on_air': f"2018-03-{day:02d}T12:00:00Z",
+            'artist': "Paginated",
+            'title': f"Day {day}",
+        }) for day in range(1, 26))
+        self.app.post('/metadata_log/bulk', body, content_type="application/x-ndjson")
+        bounds = {'start': "2018-03-01T00:00:00Z", 'end': "2018-03-31T00:00:00Z"}
+
+        titles = []
+        params = dict(bounds, page_size=10, chronological=1)
+        while True:
+            response = self.app.get('/metadata_log', params).json
+            self.assertLessEqual(len(response['metadata_log']), 10)
+            titles += [entry['title'] for entry in response['metadata_log']]
+            if not response['next']:
+                break
+            params['after'] = response['next']
+        self.assertEqual(titles, [f"Day {day}" for day in range(1, 26)])
+
+        response = self.app.get('/metadata_log', dict(bounds, page_size=10)).json
+        self.assertEqual(response['metadata_log'][0]['title'], "Day 25")
+        response = self.app.get('/metadata_log', dict(bounds, page_size=10, before=response['next'])).json
+        self.assertEqual([entry['title'] for entry in response['metadata_log']],
+            [f"Day {day}" for day in range(15, 5, -1)])
+
+        # exactly one page
+        response = self.app.get('/metadata_log', dict(bounds, page_size=25)).json
+        self.assertEqual(len(response['metadata_log']), 25)
+        self.assertIsNone(response['next'])
+
+        self.app.get('/metadata_log', {'page_size': 0}, status=400)
+        self.app.get('/metadata_log', {'page_size': "many"}, status=400)
+        self.app.get('/metadata_log', {'page_size': 10, 'before': "yesterday"}, status=400)
+
+
+    def test_metadata_log_export(self):
+        body = "\n".join(json.dumps({
+            'on_air': f"2017-05-{day:02d}T12:00:00Z",
+            'artist': "Exported, with a comma",
+            'title': f"Day {day}",
+            'tracknumber': str(day) if day % 2 else "",
+        }) for day in range(1, 21))
+        self.app.post('/metadata_log/bulk', body, content_type="application/x-ndjson")
+        bounds = {'start': "2017-05-01", 'end': "2017-05-31"}
+
+        exported = self.app.get('/metadata_log/export.ndjson', bounds)
+        self.assertTrue(exported.content_type.startswith("application/x-ndjson"))
+        entries = [json.loads(line) for line in exported.text.splitlines()]
+        self.assertEqual(entries, self.app.get('/metadata_log',
+            dict(bounds, chronological=1)).json['metadata_log'])
+        self.assertEqual(entries[2]['tracknumber'], "3")
+
+        exported = self.app.get('/metadata_log/export.csv', bounds)
+        self.assertIn("attachment", exported.headers['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(exported.text)))
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(list(rows[0].keys()),
+            ['on_air', 'artist', 'title', 'album', 'source', 'initial_uri', 'tracknumber'])
+        self.assertEqual(rows[0]['artist'], "Exported, with a comma")
+        self.assertEqual(rows[0]['tracknumber'], "1")
+        self.assertEqual(rows[1]['tracknumber'], "")
+        self.assertEqual(rows[19]['title'], "Day 20")
+
+        self.app.get('/metadata_log/export.csv', {'start': "not a date"}, status=400)
+        self.app.get('/metadata_log/export.xml', status=404)
+
+    def test_export_while_writing(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_engine("sqlite:///" + os.path.join(tmp_dir, "showergel.db"),
+                connect_args={'timeout': 0.1})
+            Base.metadata.create_all(engine)
+            def logged(minute):
+                return {
+                    'on_air': arrow.get("2017-06-01T12:00:00Z").shift(minutes=minute).datetime,
+                    'title': f"Minute {minute}",
+                }
+            with engine.begin() as connection:
+                connection.execute(Log.__table__.insert(), [logged(minute) for minute in range(5)])
+            entries = Log.iter_entries(sessionmaker(bind=engine), chunk_size=2)
+            self.assertEqual(next(entries)['title'], "Minute 0")
+            # an export in progress does not lock the DB
+            with engine.begin() as connection:
+                connection.execute(Log.__table__.insert(), logged(10))
+            self.assertEqual([entry['title'] for entry in entries],
+                ["Minute 1", "Minute 2", "Minute 3", "Minute 4", "Minute 10"])
+            engine.dispose()
+
+
+LIQUIDSOAP_LOG = """2023/03/01 10:00:00 [main:3] Liquidsoap 2.1.4
+2023/03/01 10:00:01 [playlist:3] Prepared "/music/first.mp3" (RID 0).
+2023/03/01 10:00:01 [decoder:3] Method "FFMPEG" accepted "/music/first.mp3".
+2023/03/01 10:00:02 [now_playing:3] /music/first.mp3
+2023/03/01 10:03:12 [playlist:3] Prepared "/music/second.mp3" (RID 1).
+"""
+
+class TestImportLog(ShowergelTestCase):
+
+    def test_import_log(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "showergel.db")
+            engine = create_engine("sqlite:///" + db_path)
+            Base.metadata.create_all(engine)
+            config_path = os.path.join(tmp_dir, "showergel.toml")
+            with open(config_path, 'w') as config_file:
+                config_file.write(f'[db.sqlalchemy]\nurl = "sqlite:///{db_path}"\n'
+                    '[metadata_log]\nextra_fields = ["rid"]\n')
+            log_path = os.path.join(tmp_dir, "liquidsoap.log")
+            with open(log_path, 'w') as log_file:
+                log_file.write(LIQUIDSOAP_LOG)
+            with gzip.open(log_path + ".1.gz", 'wt') as log_file:
+                log_file.write(LIQUIDSOAP_LOG.replace("2023/03/01", "2023/02/28"))
+
+            runner = CliRunner()
+            result = runner.invoke(import_log, [config_path, log_path, log_path + ".1.gz"])
+            self.assertNotEqual(result.exit_code, 0)
+            result = runner.invoke(import_log, [config_path, log_path, log_path + ".1.gz",
+                '--pattern', "prepared"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("4 entries imported", result.output)
+            # again: nothing new
+            result = runner.invoke(import_log, [config_path, log_path, '--pattern', "prepared"])
+            self.assertIn("0 entries imported, 2 were already logged", result.output)
+
+            # custom pattern, extra fields are filtered as usual
+            with open(log_path, 'w') as log_file:
+                log_file.write(LIQUIDSOAP_LOG.replace("2023/03/01", "2023/02/27"))
+            result = runner.invoke(import_log, [config_path, log_path,
+                '--pattern', r'^(?P<on_air>\S+ \S+) .* Prepared "(?P<initial_uri>.*)" \(RID (?P<rid>\d+)\)',
+            ])
+            self.assertIn("2 entries imported", result.output)
+            result = runner.invoke(import_log, [config_path, log_path, '--pattern', "no on_air group"])
+            self.assertNotEqual(result.exit_code, 0)
+
+            with open(log_path, 'w') as log_file:
+                log_file.write(LIQUIDSOAP_LOG.replace("2023/03/01", "2023/03/02"))
+            result = runner.invoke(import_log, [config_path, log_path, '--pattern', "now_playing"])
+            self.assertIn("1 entries imported", result.output)
+
+            db = sessionmaker(bind=engine)()
+            logged = Log.get(db, limit=10, chronological=True)
+            self.assertEqual(len(logged), 7)
+            self.assertEqual(logged[6]['initial_uri'], "/music/first.mp3")
+            self.assertEqual(arrow.get(logged[6]['on_air']).to('local').format("HH:mm:ss"), "10:00:02")
+            self.assertEqual(logged[0]['rid'], "0")
+            self.assertEqual(logged[2]['initial_uri'], "/music/first.mp3")
+            self.assertEqual(logged[2]['source'], "playlist")
+            self.assertEqual(arrow.get(logged[2]['on_air']), arrow.get("2023-02-28T10:00:01", tzinfo='local'))
+            db.close()
+            engine.dispose()
+        FieldFilter.setup(app.config)
+
+
+class TestLogArchive(ShowergelTestCase):
+
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = LogArchive(os.path.join(tmp_dir, "archives"), 2)
+            cutoff = archive.cutoff()
+            old = cutoff.shift(months=-1, days=3)
+            for hour in range(5):
+                self.session.add(Log(
+                    on_air=old.shift(hours=hour).datetime,
+                    artist="Archived",
+                    title=f"Track {hour}",
+                    extra=[LogExtra(key="tracknumber", value=str(hour))],
+                ))
+            older = cutoff.shift(months=-3)
+            self.session.add(Log(on_air=older.datetime, artist="Archived", title="Older"))
+            recent = cutoff.shift(days=1)
+            self.session.add(Log(on_air=recent.datetime, artist="Kept", title="Recent"))
+            self.session.commit()
+
+            archive.BATCH_SIZE = 2
+            self.assertEqual(archive.archive(self.session, cutoff), 6)
+            self.assertEqual(self.session.query(Log).count(), 1)
+            self.assertEqual(self.session.query(LogExtra).count(), 0)
+            self.assertTrue(os.path.exists(archive.path(old.floor('month'))))
+            archived = list(archive.read(old.floor('day'), cutoff))
+            self.assertEqual([entry['title'] for entry in archived], [f"Track {hour}" for hour in range(5)])
+            self.assertEqual(archived[3]['tracknumber'], "3")
+            self.assertEqual(archive.archive(self.session, cutoff), 0)
+
+            LogArchive._instance = archive
+            try:
+                logged = self.app.get('/metadata_log', {
+                    'start': old.shift(hours=1).isoformat(),
+                    'end': recent.isoformat(),
+                    'chronological': 1,
+                }).json['metadata_log']
+                self.assertEqual([entry['title'] for entry in logged],
+                    ["Track 1", "Track 2", "Track 3", "Track 4", "Recent"])
+                logged = self.app.get('/metadata_log', {
+                    'start': old.isoformat(),
+                    'limit': 2,
+                }).json['metadata_log']
+                self.assertEqual([entry['title'] for entry in logged], ["Recent", "Track 4"])
+
+                # pages continue into archives, reading only the months they need
+                read_months = []
+                read_month = archive._read_month
+                def counting_read_month(month, *args):
+                    read_months.append(month)
+                    return read_month(month, *args)
+                archive._read_month = counting_read_month
+                response = self.app.get('/metadata_log', {'page_size': 3}).json
+                self.assertEqual([entry['title'] for entry in response['metadata_log']],
+                    ["Recent", "Track 4", "Track 3"])
+                self.assertNotIn(older.floor('month'), read_months)
+                response = self.app.get('/metadata_log', {'page_size': 3, 'before': response['next']}).json
+                self.assertEqual([entry['title'] for entry in response['metadata_log']],
+                    ["Track 2", "Track 1", "Track 0"])
+                response = self.app.get('/metadata_log', {'page_size': 3, 'before': response['next']}).json
+                self.assertEqual([entry['title'] for entry in response['metadata_log']], ["Older"])
+                self.assertIsNone(response['next'])
+                logged = self.app.get('/metadata_log', {
+                    'page_size': 2,
+                    'chronological': 1,
+                    'after': older.isoformat(),
+                }).json['metadata_log']
+                self.assertEqual([entry['title'] for entry in logged], ["Track 0", "Track 1"])
+                self.assertEqual(read_months[-1], old.floor('month'))
+                del archive._read_month
+
+                exported = self.app.get('/metadata_log/export.csv').text.splitlines()
+                self.assertEqual(len(exported), 8)
+                self.assertTrue(exported[0].endswith(",tracknumber"))
+                self.assertTrue(exported[-1].endswith("Kept,Recent,,,,"))
+            finally:
+                LogArchive._instance = None
+            self.session.query(Log).delete(synchronize_session=False)
+            self.session.commit()
+
+
+    def test_bulk_insert_archived(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = LogArchive(tmp_dir, 2)
+            day = archive.cutoff().shift(months=-1, days=5)
+            body = "\n".join(json.dumps({
+                'on_air': day.shift(hours=hour).isoformat(), 'artist': "Again", 'title': f"Track {hour}",
+            }) for hour in range(3))
+            LogArchive._instance = archive
+            try:
+                summary = self.app.post('/metadata_log/bulk', body, content_type="application/x-ndjson").json
+                self.assertEqual(summary['inserted'], 3)
+                self.assertEqual(archive.archive(self.session, archive.cutoff()), 3)
+                # posting the same file again does not log archived entries twice
+                summary = self.app.post('/metadata_log/bulk', body, content_type="application/x-ndjson").json
+                self.assertEqual(summary['inserted'], 0)
+                self.assertEqual(summary['skipped'], 3)
+                self.assertEqual(self.session.query(Log).count(), 0)
+            finally:
+                LogArchive._instance = None
+            self.session.query(LogRollup).delete(synchronize_session=False)
+            self.session.commit()
+
+class TestLogRollup(ShowergelTestCase):
+
+    def test_stats(self):
+        played = [
+            ("2016-04-01T10:00:00Z", "A", "One", "playlist"),
+            ("2016-04-01T10:03:00Z", "A", "Two", "playlist"),
+            ("2016-04-01T10:05:00Z", "B", "Three", "live"),
+            ("2016-04-01T10:06:00Z", None, None, "showergel_scheduler"),
+            ("2016-04-01T10:07:00Z", "A", "One", "playlist"),
+            ("2016-04-02T10:00:00Z", "B", "Three", "live"),
+        ]
+        for on_air, artist, title, source in played:
+            self.session.add(Log(on_air=arrow.get(on_air).datetime,
+                artist=artist, title=title, source=source))
+            self.session.commit()
+
+        def stats(**params):
+            return self.app.get('/metadata_log/stats', params).json['stats']
+
+        self.assertEqual(stats(), [
+            {'artist': "A", 'plays': 3, 'airtime': 180 + 120 + 3600},
+            {'artist': "B", 'plays': 2, 'airtime': 60},
+        ])
+        self.assertEqual(stats(by='source', order='airtime', end="2016-04-01"), [
+            {'source': "playlist", 'plays': 3, 'airtime': 3900},
+            {'source': "live", 'plays': 1, 'airtime': 60},
+        ])
+        self.assertEqual(stats(by='title', start="2016-04-02"), [
+            {'artist': "B", 'title': "Three", 'plays': 1, 'airtime': 0},
+        ])
+        self.assertEqual(stats(by='day'), [
+            {'day': "2016-04-01", 'plays': 4, 'airtime': 3960},
+            {'day': "2016-04-02", 'plays': 1, 'airtime': 0},
+        ])
+        self.assertEqual(len(stats(limit=1)), 1)
+        self.app.get('/metadata_log/stats', {'by': "album"}, status=400)
+        self.app.get('/metadata_log/stats', {'order': "random"}, status=400)
+
+        # rollups computed from the log are the same
+        incremental = stats(by='title')
+        LogRollup.rebuild(self.session)
+        self.assertEqual(stats(by='title'), incremental)
+        LogRollup.rebuild(self.session, arrow.get("2016-04-01").date(), arrow.get("2016-04-01").date())
+        self.assertEqual(stats(by='title'), incremental)
+
+        # bulk inserts are counted too
+        self.app.post('/metadata_log/bulk', json.dumps({
+            'on_air': "2016-04-02T10:02:00Z", 'artist': "C", 'title': "Four",
+        }), content_type="application/x-ndjson")
+        self.assertEqual(stats(start="2016-04-02"), [
+            {'artist': "B", 'plays': 1, 'airtime': 120},
+            {'artist': "C", 'plays': 1, 'airtime': 0},
+        ])
+
+    def test_bulk_insert_archived_day(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = LogArchive(tmp_dir, 2)
+            day = archive.cutoff().shift(months=-1, days=3, hours=10)
+            for minutes, title in ((0, "One"), (3, "Two")):
+                self.session.add(Log(on_air=day.shift(minutes=minutes).datetime, artist="A", title=title))
+                self.session.commit()
+            self.assertEqual(archive.archive(self.session, archive.cutoff()), 2)
+
+            LogArchive._instance = archive
+            try:
+                body = "\n".join(json.dumps({
+                    'on_air': day.shift(minutes=minutes).isoformat(), 'artist': "B", 'title': title,
+                }) for minutes, title in ((10, "Three"), (12, "Four")))
+                self.app.post('/metadata_log/bulk', body, content_type="application/x-ndjson")
+            finally:
+                LogArchive._instance = None
+            stats = self.app.get('/metadata_log/stats', {
+                'by': "title",
+                'start': day.date().isoformat(),
+                'end': day.date().isoformat(),
+            }).json['stats']
+            self.assertEqual(stats, [
+                {'artist': "A", 'title': "One", 'plays': 1, 'airtime': 180},
+                {'artist': "B", 'title': "Three", 'plays': 1, 'airtime': 120},
+                {'artist': "A", 'title': "Two", 'plays': 1, 'airtime': 0},
+                {'artist': "B", 'title': "Four", 'plays': 1, 'airtime': 0},
+            ])
+
+            # only new entries are counted, even across chunks
+            summary = Log.insert_many(app.config, self.session, [{
+                'on_air': day.shift(minutes=minutes).isoformat(), 'artist': "B", 'title': title,
+            } for minutes, title in ((10, "Three"), (12, "Four"), (14, "Five"), (15, "Six"))],
+                chunk_size=1, archive=archive)
+            self.assertEqual(summary, {'inserted': 2, 'skipped': 2})
+            stats = self.app.get('/metadata_log/stats', {
+                'by': "title",
+                'start': day.date().isoformat(),
+                'end': day.date().isoformat(),
+            }).json['stats']
+            self.assertEqual(stats, [
+                {'artist': "A", 'title': "One", 'plays': 1, 'airtime': 180},
+                {'artist': "B", 'title': "Three", 'plays': 1, 'airtime': 120},
+                {'artist': "B", 'title': "Five", 'plays': 1, 'airtime': 60},
+                {'artist': "A", 'title': "Two", 'plays': 1, 'airtime': 0},
+                {'artist': "B", 'title': "Four", 'plays': 1, 'airtime': 0},
+                {'artist': "B", 'title': "Six", 'plays': 1, 'airtime': 0},
+            ])
+            self.session.query(Log).delete(synchronize_session=False)
+            self.session.query(LogRollup).delete(synchronize_session=False)
+            self.session.commit()
+
+
+class TestLogSearch(ShowergelTestCase):
+
+    def search(self, q, **params):
+        params['q'] = q
+        return self.app.get('/metadata_log/search', params).json
+
+    def titles(self, q, **params):
+        return [entry['title'] for entry in self.search(q, **params)['metadata_log']]
+
+    def test_search(self):
+        LogSearch.setup({'metadata_log.search_fields': ["tracknumber", "composer"]})
+        try:
+            for day, (artist, title, composer) in enumerate([
+                ("Neil Young", "Harvest Moon", None),
+                ("AC/DC", "Back in Black", "Angus Young"),
+                ("Daft Punk", "One More Time", None),
+                ("Daft Punk", "Around the World", None),
+                ("The Black Keys", "Lonely Boy", "Dan Auerbach"),
+            ], start=1):
+                entry = Log(on_air=arrow.get(f"2019-03-0{day}T10:00:00Z").datetime,
+                    artist=artist, title=title, source="playlist")
+                if composer:
+                    entry.extra = [LogExtra(key="composer", value=composer),
+                        LogExtra(key="label", value="Hidden Records")]
+                self.session.add(entry)
+                self.session.commit()
+
+            self.assertEqual(self.titles("daft punk", order="recent"), ["Around the World", "One More Time"])
+            self.assertEqual(self.titles("daft pu"), ["Around the World", "One More Time"])
+            self.assertEqual(self.titles("ac/dc"), ["Back in Black"])
+            self.assertEqual(self.titles("auerbach"), ["Lonely Boy"])
+            self.assertEqual(self.titles("hidden"), [])
+            self.assertEqual(self.titles('"-'), [])
+            # the artist match ranks higher than the more recent composer match
+            self.assertEqual(self.titles("young"), ["Harvest Moon", "Back in Black"])
+            self.assertEqual(self.titles("young", order="recent"), ["Back in Black", "Harvest Moon"])
+            found = self.search("back black")['metadata_log'][0]
+            self.assertEqual(found, {
+                'on_air': "2019-03-02T10:00:00+00:00",
+                'artist': "AC/DC",
+                'title': "Back in Black",
+                'album': None,
+                'source': "playlist",
+                'initial_uri': None,
+            })
+
+            response = self.search("daft", page_size=1, order="recent")
+            self.assertEqual(response['next'], 1)
+            response = self.search("daft", page_size=1, order="recent", offset=response['next'])
+            self.assertEqual([entry['title'] for entry in response['metadata_log']], ["One More Time"])
+            self.assertIsNone(response['next'])
+
+            # bulk inserts are indexed too, with their extra fields
+            self.app.post('/metadata_log/bulk', json.dumps({
+                'on_air': "2019-02-06T10:00:00Z", 'artist': "Nina Simone",
+                'title': "Feeling Good", 'tracknumber': "7",
+            }), content_type="application/x-ndjson")
+            self.assertEqual(self.titles("nina 7"), ["Feeling Good"])
+
+            # archived entries are still found, even if their id is reused
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                archive = LogArchive(tmp_dir, 1)
+                self.assertEqual(archive.archive(self.session, arrow.get("2019-03-01T00:00:00Z")), 1)
+            self.app.post('/metadata_log/bulk', json.dumps({
+                'on_air': "2019-03-07T10:00:00Z", 'artist': "Nina Simone", 'title': "Feeling Better",
+            }), content_type="application/x-ndjson")
+            self.assertEqual(self.titles("nina", order="recent"), ["Feeling Better", "Feeling Good"])
+
+            # deleted entries are not
+            self.session.query(Log).filter(Log.title == "Feeling Better").delete(synchronize_session=False)
+            self.session.commit()
+            self.assertEqual(self.titles("nina"), ["Feeling Good"])
+
+            # an existing log can be indexed
+            self.session.execute(text("DELETE FROM log_search"))
+            self.session.commit()
+            self.assertEqual(LogSearch.fill(self.session), 5)
+            self.assertEqual(LogSearch.fill(self.session), 0)
+            self.assertEqual(self.titles("angus"), ["Back in Black"])
+
+            for params in ({'q': " "}, {'q': "daft", 'order': "random"},
+                    {'q': "daft", 'page_size': 0}, {'q': "daft", 'offset': -1}):
+                self.app.get('/metadata_log/search', params, status=400)
+        finally:
+            LogSearch.setup(app.config)